@@ -0,0 +1,119 @@
+import resource
+import sys
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from time import perf_counter, process_time
+from typing import Iterator
+
+PROC_STATUS = Path("/proc/self/status")
+PROC_CLEAR_REFS = Path("/proc/self/clear_refs")
+
+# ru_maxrss is in KiB on Linux and in bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+# (stage, output, seconds) timings of the task running in this context,
+# while they are collected
+stages: ContextVar[list | None] = ContextVar("stages", default=None)
+
+
+def memory_status() -> dict[str, int]:
+    """Resident (VmRSS) and peak resident (VmHWM) memory in bytes."""
+    try:
+        lines = PROC_STATUS.read_text().splitlines()
+    except OSError:
+        return {}
+    status = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        if name in ("VmRSS", "VmHWM"):
+            status[name] = int(value.split()[0]) * 1024
+    return status
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak resident memory of the process, where supported."""
+    try:
+        PROC_CLEAR_REFS.write_text("5")
+    except OSError:
+        return False
+    return True
+
+
+def max_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+
+
+class Usage:
+    """
+    Wall time, CPU time and peak memory of the process from its creation.
+
+    CPU time covers every thread of the process, so render threads count
+    towards the task that started them. The peak memory is reset at
+    creation on Linux; elsewhere only the growth of the lifetime peak of
+    the process is seen, so tasks staying below an earlier peak report 0.
+    """
+
+    def __init__(self):
+        self.start_wall = perf_counter()
+        self.start_cpu = process_time()
+        self.reset = reset_peak_rss()
+        self.start_rss = memory_status().get("VmRSS", 0)
+        self.start_max_rss = max_rss()
+
+    def peak_rss(self) -> int:
+        """Peak resident memory above the resident memory at creation."""
+        if self.reset:
+            peak = memory_status().get("VmHWM", self.start_rss)
+            return max(0, peak - self.start_rss)
+        return max(0, max_rss() - self.start_max_rss)
+
+    def totals(self) -> dict:
+        return {
+            "wall_time": perf_counter() - self.start_wall,
+            "cpu_time": process_time() - self.start_cpu,
+            "peak_rss": self.peak_rss(),
+        }
+
+
+def record_stage(stage: str, duration: float, output: str | None = None):
+    """Adds a stage timing to those collected in this context, if any."""
+    timings = stages.get()
+    if timings is not None:
+        timings.append((stage, output, duration))
+
+
+@contextmanager
+def timed(stage: str, output: str | None = None) -> Iterator[None]:
+    """Records the time spent in the block as a stage."""
+    start_time = perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, perf_counter() - start_time, output)
+
+
+@contextmanager
+def collect_stages() -> Iterator[list]:
+    """
+    Collects the stage timings recorded in the block.
+
+    Threads only see the collection when they run in a copy of the
+    context of the block, as the render threads of a task do.
+    """
+    timings = []
+    token = stages.set(timings)
+    try:
+        yield timings
+    finally:
+        stages.reset(token)
+
+
+def take_stages() -> list:
+    """Removes and returns the stage timings collected so far."""
+    timings = stages.get()
+    if not timings:
+        return []
+    taken = timings[:]
+    del timings[: len(taken)]
+    return taken
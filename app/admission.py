@@ -0,0 +1,88 @@
+from math import ceil
+from time import time
+
+from fastapi import HTTPException
+
+from app.celery import QUEUES
+from app.limits import redis_client
+from app.scheduling import drained_key, queue_keys
+from app.settings import celery_settings
+
+# Wait suggested to clients while a full queue shows no progress to
+# estimate from
+UNKNOWN_WAIT = 60
+
+
+async def queue_backlog(queue: str) -> dict:
+    """
+    Depth, drain rate and estimated drain time of a queue.
+
+    The drain rate is the number of tasks finished from the queue per
+    second over the last DRAIN_MINUTES whole minutes. The drain time is
+    None when nothing was drained, as no estimate can be made then.
+    """
+    minute = int(time() // 60)
+    minutes = range(minute - celery_settings.DRAIN_MINUTES, minute)
+    async with redis_client.pipeline(transaction=False) as pipeline:
+        for key in queue_keys(queue):
+            pipeline.llen(key)
+        pipeline.mget([drained_key(queue, past) for past in minutes])
+        *depths, drained = await pipeline.execute()
+    depth = sum(depths)
+    rate = sum(int(count or 0) for count in drained) / (
+        celery_settings.DRAIN_MINUTES * 60
+    )
+    drain_seconds = None
+    if rate:
+        drain_seconds = depth / rate
+    elif not depth:
+        drain_seconds = 0.0
+    return {
+        "depth": depth,
+        "drain_rate": rate,
+        "drain_seconds": drain_seconds,
+    }
+
+
+async def backlog() -> dict:
+    """Backlog of every queue."""
+    return {queue: await queue_backlog(queue) for queue in QUEUES}
+
+
+async def admit(queues: set[str]) -> None:
+    """
+    Refuses new work for queues that are too far behind.
+
+    Raises a 503 when a queue holds more than MAX_QUEUE_DEPTH tasks and a
+    429 when it needs more than MAX_DRAIN_SECONDS to drain. Retry-After is
+    the estimated time until the queue is back under its limit.
+    """
+    for queue in sorted(queues, key=QUEUES.index):
+        state = await queue_backlog(queue)
+        depth, rate = state["depth"], state["drain_rate"]
+        drain_seconds = state["drain_seconds"]
+        if depth > celery_settings.MAX_QUEUE_DEPTH:
+            wait = UNKNOWN_WAIT
+            if rate:
+                wait = (depth - celery_settings.MAX_QUEUE_DEPTH) / rate
+            raise HTTPException(
+                status_code=503,
+                detail=(
+                    f"The {queue} queue is full with {depth} tasks, "
+                    f"estimated wait {ceil(wait)} seconds"
+                ),
+                headers={"Retry-After": str(max(1, ceil(wait)))},
+            )
+        if (
+            drain_seconds is not None
+            and drain_seconds > celery_settings.MAX_DRAIN_SECONDS
+        ):
+            wait = drain_seconds - celery_settings.MAX_DRAIN_SECONDS
+            raise HTTPException(
+                status_code=429,
+                detail=(
+                    f"The {queue} queue needs {ceil(drain_seconds)} seconds "
+                    f"to drain, estimated wait {ceil(wait)} seconds"
+                ),
+                headers={"Retry-After": str(max(1, ceil(wait)))},
+            )
@@ -96,3 +96,15 @@ async def get_current_user(
 
 
 UserAuthorization = Annotated[User, Depends(get_current_user)]
+
+
+async def get_admin_user(user: UserAuthorization) -> User:
+    if not user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required",
+        )
+    return user
+
+
+AdminAuthorization = Annotated[User, Depends(get_admin_user)]
@@ -0,0 +1,220 @@
+from time import perf_counter
+from typing import Callable, Iterator
+
+import numpy as np
+from PIL import Image
+
+from app.schemas import Grayscale, Operation, OutputSpec, Resize, Rotate
+from app.transforms import (
+    DecodePlan,
+    Node,
+    Plan,
+    downscale_factor,
+    normalize,
+    resized_size,
+    transform_key,
+)
+
+# Modes whose pixels stack into plain uint8 arrays
+BATCH_MODES = ("RGB", "L")
+
+# Fixed-point weights of the ITU-R 601-2 luma transform, the same Pillow
+# uses to convert RGB to L. Weighted sums of 8-bit pixels stay below 2**24,
+# so they are exact in float32, which is faster than integer arithmetic.
+LUMA_WEIGHTS = np.array([19595, 38470, 7471], dtype=np.float32)
+
+
+def batchable(operation: Operation) -> bool:
+    """Whether an operation has a vectorized implementation."""
+    match operation:
+        case Rotate(degrees=degrees):
+            return degrees % 90 == 0
+        case Resize():
+            return downscale_factor(operation) is not None
+        case Grayscale():
+            return True
+    return False
+
+
+def batchable_outputs(outputs: list[OutputSpec]) -> bool:
+    return all(
+        batchable(operation)
+        for output in outputs
+        for operation in normalize(output.operations)
+    )
+
+
+def downscale(pixels: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Averages blocks of factor x factor pixels of every image of a stack.
+
+    Rows are summed before columns, so every pass reads whole rows.
+    """
+    count, height, width = pixels.shape[:3]
+    height, width = height // factor, width // factor
+    rows = pixels[:, : height * factor, : width * factor].reshape(
+        count, height, factor, width * factor, *pixels.shape[3:]
+    )
+    total = rows[:, :, 0].astype(np.uint32 if factor > 16 else np.uint16)
+    for offset in range(1, factor):
+        total += rows[:, :, offset]
+    columns = total.reshape(count, height, width, factor, *pixels.shape[3:])
+    # Wide enough for the fixed-point reciprocal Image.reduce divides by
+    total = columns[:, :, :, 0].astype(np.uint32)
+    for offset in range(1, factor):
+        total += columns[:, :, :, offset]
+    total += factor**2 // 2
+    total *= (1 << 24) // factor**2
+    total >>= 24
+    return total.astype(np.uint8)
+
+
+def apply_batch(operation: Operation, pixels: np.ndarray) -> np.ndarray:
+    """
+    Applies an operation to every image of a (count, height, width[,
+    channels]) stack at once.
+
+    Every operation matches the per-image path exactly, downscales
+    averaging blocks of pixels like Image.reduce. Results are contiguous,
+    so images are made from them without copying.
+    """
+    match operation:
+        case Rotate(degrees=degrees):
+            return np.ascontiguousarray(
+                np.rot90(pixels, int(degrees) // 90 % 4, axes=(1, 2))
+            )
+        case Resize():
+            return downscale(pixels, downscale_factor(operation))
+        case Grayscale() if pixels.ndim == 4:
+            luma = pixels.astype(np.float32) @ LUMA_WEIGHTS
+            luma += 0x8000
+            luma *= 2**-16
+            return luma.astype(np.uint8)
+        case Grayscale():
+            return pixels
+
+
+class BatchPlan(Plan):
+    """
+    Execution plan of a set of outputs over a stack of same-shape images.
+
+    Shares intermediate results like Plan, but every operation runs once
+    over the whole stack. The processing time of an output is split
+    evenly between the images of the stack.
+    """
+
+    def descend(
+        self, node: Node, pixels: np.ndarray, elapsed: float
+    ) -> Iterator[tuple[str, np.ndarray, float]]:
+        start_time = perf_counter()
+        result = apply_batch(node.operation, pixels)
+        yield from self.walk(
+            node,
+            result,
+            elapsed + (perf_counter() - start_time) / len(pixels),
+        )
+
+
+def batch_decodes(
+    image: Image.Image, outputs: list[OutputSpec]
+) -> dict[int, list[OutputSpec]] | None:
+    """
+    Outputs of an image by the decode reduction they are rendered from, or
+    None if the image or any output has no vectorized implementation.
+
+    Decodes are planned by DecodePlan like on the per-image path, so a
+    transform key renders the same pixels on both. A leading resize to the
+    size of a reduced decode is only a copy, and is dropped.
+    """
+    if image.mode not in BATCH_MODES:
+        return None
+    width, height = image.size
+    decodes = {}
+    plans = DecodePlan(outputs, image.size, image.format).plans
+    for reduction, plan in plans.items():
+        decoded = (-(-width // reduction), -(-height // reduction))
+        decodes[reduction] = []
+        for output in plan.outputs.values():
+            operations = normalize(output.operations)
+            if (
+                reduction > 1
+                and isinstance(operations[0], Resize)
+                and resized_size(operations[0], decoded) == decoded
+            ):
+                operations = operations[1:]
+            if not all(batchable(operation) for operation in operations):
+                return None
+            decodes[reduction].append(
+                output.model_copy(update={"operations": operations})
+            )
+    return decodes
+
+
+def stack_key(image: Image.Image, outputs: list[OutputSpec]) -> tuple:
+    return (
+        image.mode,
+        image.size,
+        image.format,
+        tuple((output.name, transform_key(output)) for output in outputs),
+    )
+
+
+def render_batch(
+    open_images: list[Callable[[], Image.Image]],
+    outputs: list[list[OutputSpec]],
+) -> list[dict[str, tuple[Image.Image, float]]]:
+    """
+    Renders the outputs of several images with vectorized operations.
+
+    Images of the same mode, size and format with the same outputs are
+    decoded into stacked arrays and rendered together, one stack per
+    decode their outputs are planned on. open_images return a new, not
+    yet loaded image on every call, like for DecodePlan.execute. Returns,
+    for each image, a dict mapping output names to (image, processing
+    time). The dict is empty for images that could not be stacked with
+    any other, or whose mode or operations have no vectorized
+    implementation, and which are left to the per-image path.
+    """
+    groups = {}
+    decodes = {}
+    for index, (open_image, image_outputs) in enumerate(
+        zip(open_images, outputs)
+    ):
+        image = open_image()
+        image_decodes = batch_decodes(image, image_outputs)
+        if image_decodes is not None:
+            decodes[index] = image_decodes
+            key = stack_key(image, image_outputs)
+            groups.setdefault(key, []).append(index)
+
+    results = [{} for _ in open_images]
+    for indices in groups.values():
+        if len(indices) < 2:
+            continue
+        for reduction, decode_outputs in sorted(decodes[indices[0]].items()):
+            start_time = perf_counter()
+            pixels = None
+            for position, index in enumerate(indices):
+                image = open_images[index]()
+                if reduction > 1:
+                    width, height = image.size
+                    image.draft(
+                        image.mode, (width // reduction, height // reduction)
+                    )
+                image_pixels = np.asarray(image)
+                if pixels is None:
+                    pixels = np.empty(
+                        (len(indices), *image_pixels.shape), dtype=np.uint8
+                    )
+                pixels[position] = image_pixels
+            elapsed = (perf_counter() - start_time) / len(indices)
+            plan = BatchPlan(decode_outputs)
+            for name, rendered, processing_time in plan.execute(
+                pixels, elapsed
+            ):
+                for index, image_pixels in zip(indices, rendered):
+                    results[index][name] = (
+                        Image.fromarray(image_pixels),
+                        processing_time,
+                    )
+    return results
@@ -1,6 +1,22 @@
-from celery import Celery
+from time import time
 
+from celery import Celery, states
+from celery.signals import (
+    task_postrun,
+    task_prerun,
+    task_revoked,
+    worker_init,
+)
+
+from app.accounting import Usage
+from app.database import sync_sessionmaker
+from app.models import TaskUsage
+from app.scheduling import PRIORITY_STEPS, record_drained, release_task
 from app.settings import celery_settings
+from app.storage import storage
+
+# Queues of worker pools sized for small, large and huge images
+QUEUES = ("small", "large", "huge")
 
 celery_app = Celery(
     "image_augmentation",
@@ -8,4 +24,91 @@ celery_app = Celery(
     backend=celery_settings.url,
 )
 
+celery_app.conf.task_track_started = True
+celery_app.conf.task_default_queue = QUEUES[0]
+# Messages are consumed by priority and one at a time, so a worker never
+# holds prefetched tasks back from a higher priority
+celery_app.conf.broker_transport_options = {
+    "priority_steps": PRIORITY_STEPS,
+    "sep": ":",
+    "queue_order_strategy": "priority",
+}
+celery_app.conf.worker_prefetch_multiplier = 1
+celery_app.conf.beat_schedule = {
+    "rollup": {
+        "task": "app.tasks.rollup",
+        "schedule": celery_settings.ROLLUP_INTERVAL,
+    },
+}
+
 celery_app.autodiscover_tasks(["app"])
+
+# Resource usage of the tasks running in this worker process, by task id
+usages: dict[str, Usage] = {}
+
+
+@worker_init.connect
+def bootstrap_storage(**kwargs):
+    storage.bootstrap()
+
+
+@task_prerun.connect
+def start_usage(task_id, **kwargs):
+    usages[task_id] = Usage()
+
+
+@task_postrun.connect
+def record_usage(task_id, task, state=None, **kwargs):
+    """
+    Records the wall time, CPU time and peak memory of a task.
+
+    Retries run under the id of their task, each attempt replacing the
+    row of the one before.
+    """
+    usage = usages.pop(task_id, None)
+    if usage is None:
+        return
+    delivery_info = task.request.delivery_info or {}
+    with sync_sessionmaker() as session:
+        try:
+            session.merge(
+                TaskUsage(
+                    task_id=task_id,
+                    task_name=task.name,
+                    queue=delivery_info.get("routing_key"),
+                    state=state or "UNKNOWN",
+                    **usage.totals(),
+                )
+            )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+
+
+@task_postrun.connect
+def release_backlog(kwargs=None, state=None, **extra):
+    """Removes a finished task from the backlog of its user."""
+    if state == states.RETRY:
+        return
+    user_id = (kwargs or {}).get("user_id")
+    if user_id is not None:
+        release_task(celery_app.backend.client, user_id)
+
+
+@task_revoked.connect
+def release_revoked(request=None, **extra):
+    """Removes a revoked task from the backlog of its user."""
+    user_id = (getattr(request, "kwargs", None) or {}).get("user_id")
+    if user_id is not None:
+        release_task(celery_app.backend.client, user_id)
+
+
+@task_postrun.connect
+def count_drained(task, state=None, **extra):
+    """Counts a finished task towards the drain rate of its queue."""
+    if state == states.RETRY:
+        return
+    queue = (task.request.delivery_info or {}).get("routing_key")
+    if queue is not None:
+        record_drained(celery_app.backend.client, queue, time())
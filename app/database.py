@@ -1,7 +1,9 @@
 from typing import AsyncIterator
 
 from fastapi import Depends
-from sqlalchemy import create_engine
+from sqlalchemy import Insert, create_engine
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import (
     AsyncEngine,
     AsyncSession,
@@ -13,9 +15,11 @@ from typing_extensions import Annotated
 from app.settings import database_settings
 
 async_engine: AsyncEngine = create_async_engine(
-    database_settings.async_url, echo=True
+    database_settings.async_url, echo=database_settings.ECHO
+)
+sync_engine = create_engine(
+    database_settings.sync_url, echo=database_settings.ECHO
 )
-sync_engine = create_engine(database_settings.sync_url, echo=True)
 
 
 def get_async_sessionmaker():
@@ -41,6 +45,16 @@ async_sessionmaker = get_async_sessionmaker()
 sync_sessionmaker = get_sync_sessionmaker()
 
 
+def dialect_insert(session, model) -> Insert:
+    """
+    INSERT into a model in the dialect of the session, for the ON
+    CONFLICT clauses PostgreSQL and the SQLite of the tests share.
+    """
+    if session.get_bind().dialect.name == "sqlite":
+        return sqlite_insert(model)
+    return postgresql_insert(model)
+
+
 async def get_session() -> AsyncIterator[AsyncSession]:
     async with async_sessionmaker() as session:
         try:
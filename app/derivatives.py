@@ -0,0 +1,96 @@
+import asyncio
+import hashlib
+import io
+from typing import Awaitable, Callable, TypeVar
+
+from fastapi import HTTPException
+from PIL import Image
+from pydantic import ValidationError
+
+from app.models import ImageTask
+from app.schemas import Encoding, OutputSpec
+from app.settings import image_settings, storage_settings
+from app.storage import storage
+from app.transforms import FORMAT_EXTENSIONS, parse_operation, transform_key
+
+MEDIA_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "AVIF": "image/avif",
+}
+
+# Prefix of the object names of derivatives, under which objects are
+# addressed by content and only ever written once
+DERIVED_PREFIX = "derived/"
+
+T = TypeVar("T")
+
+# Renders in progress in this process, by the object name of their output
+renders: dict[str, asyncio.Future] = {}
+
+
+def parse_render(
+    operations: list[str], image_format: str | None, preset: str | None
+) -> OutputSpec:
+    """Output of a render request, with operations given by their keys."""
+    try:
+        return OutputSpec(
+            name="render",
+            operations=[parse_operation(key) for key in operations],
+            format=image_format,
+            encoding=None if preset is None else Encoding(preset=preset),
+        )
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=422, detail=e.errors(include_url=False)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+async def output_format(original: ImageTask, output: OutputSpec) -> str:
+    """
+    Format of an output, the format of the original unless given.
+
+    The format of the original is read from the header of its stored
+    object, as its name keeps whatever extension it was uploaded under.
+    """
+    if output.format is not None:
+        return output.format
+    head = await storage.aread_head(
+        storage_settings.BUCKET, original.img_link, image_settings.SNIFF_BYTES
+    )
+    with Image.open(io.BytesIO(head)) as image:
+        return image.format
+
+
+def derivative_name(source, output: OutputSpec, original_format: str) -> str:
+    """
+    Canonical object name of an output of an original.
+
+    source is the content hash of the original, or its id when it has
+    none. The name depends only on the content of the original and the
+    transform key of the output, never on the names clients upload under,
+    so every request for the same derivative of the same content maps to
+    the same object and the object never changes once written.
+    """
+    digest = hashlib.sha256(transform_key(output).encode()).hexdigest()
+    extension = FORMAT_EXTENSIONS[output.format or original_format]
+    return f"{DERIVED_PREFIX}{source}/{digest[:32]}.{extension}"
+
+
+async def coalesce(key: str, render: Callable[[], Awaitable[T]]) -> T:
+    """
+    Awaits the render in progress for a key, or starts one.
+
+    Concurrent calls for the same key share a single render. The render
+    is shielded, so a caller going away does not cancel it for the
+    others.
+    """
+    future = renders.get(key)
+    if future is None:
+        future = asyncio.ensure_future(render())
+        renders[key] = future
+        future.add_done_callback(lambda _: renders.pop(key, None))
+    return await asyncio.shield(future)
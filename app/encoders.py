@@ -0,0 +1,111 @@
+import io
+
+from PIL import Image
+
+from app.schemas import Encoding
+
+# Settings filled in by each preset. fast keeps encode time lowest, small
+# spends it on the fewest bytes and archival keeps quality and metadata.
+PRESETS = {
+    "fast": {
+        "quality": 80,
+        "effort": 1,
+        "progressive": False,
+        "optimize": False,
+        "strip_metadata": True,
+    },
+    "small": {
+        "quality": 70,
+        "effort": 9,
+        "progressive": True,
+        "optimize": True,
+        "strip_metadata": True,
+    },
+    "archival": {
+        "quality": 95,
+        "effort": 6,
+        "lossless": True,
+        "strip_metadata": False,
+    },
+}
+
+# Slowest method of the WebP encoder, and fastest and slowest speeds of the
+# AVIF encoder effort is mapped to. AVIF speeds below 4 take tens of
+# seconds per megapixel for little gain.
+WEBP_METHODS = 6
+AVIF_SPEEDS = (10, 4)
+
+
+def encoder_settings(encoding: Encoding) -> dict:
+    """Settings of the preset, overridden by those given explicitly."""
+    settings = dict(PRESETS.get(encoding.preset, {}))
+    settings.update(encoding.model_dump(exclude={"preset"}, exclude_none=True))
+    return settings
+
+
+def encoding_key(encoding: Encoding) -> str:
+    """Canonical key of the resolved settings of an encoding."""
+    settings = encoder_settings(encoding)
+    return ",".join(
+        f"{name}={int(value) if isinstance(value, bool) else value}"
+        for name, value in sorted(settings.items())
+    )
+
+
+def save_options(
+    image: Image.Image, image_format: str, settings: dict
+) -> dict:
+    """Pillow save arguments of the settings for a format."""
+    quality = settings.get("quality")
+    effort = settings.get("effort")
+    options = {}
+    match image_format:
+        case "JPEG":
+            options["quality"] = quality
+            options["optimize"] = settings.get("optimize")
+            options["progressive"] = settings.get("progressive")
+        case "PNG":
+            options["compress_level"] = effort
+            options["optimize"] = settings.get("optimize")
+        case "WEBP":
+            options["quality"] = quality
+            options["lossless"] = settings.get("lossless")
+            if effort is not None:
+                options["method"] = round(effort * WEBP_METHODS / 9)
+        case "AVIF":
+            options["quality"] = quality
+            if effort is not None:
+                fastest, slowest = AVIF_SPEEDS
+                options["speed"] = fastest - round(
+                    effort * (fastest - slowest) / 9
+                )
+    options = {
+        name: value for name, value in options.items() if value is not None
+    }
+    if settings.get("strip_metadata"):
+        # An explicit None keeps Pillow from copying the profile
+        options["icc_profile"] = None
+    elif settings.get("strip_metadata") is False:
+        for name in ("exif", "icc_profile"):
+            if name in image.info:
+                options[name] = image.info[name]
+    return options
+
+
+def encode(
+    image: Image.Image, image_format: str, encoding: Encoding | None = None
+) -> io.BytesIO:
+    """
+    Encodes an image in a format, with Pillow defaults without encoding.
+
+    Stripping metadata drops EXIF and the ICC profile, keeping it copies
+    both from the decoded original.
+    """
+    if image_format == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+        image = image.convert("RGB")
+    options = {}
+    if encoding is not None:
+        options = save_options(image, image_format, encoder_settings(encoding))
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format=image_format, **options)
+    return img_byte_arr
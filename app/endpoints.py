@@ -1,20 +1,100 @@
 import asyncio
 import io
 import zipfile
+from datetime import datetime
 from pathlib import Path
-from typing import Annotated, List
+from typing import Annotated, List, Literal
+from uuid import UUID
 
+from celery.exceptions import TimeoutError as CeleryTimeoutError
 from celery.result import AsyncResult
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    Form,
+    HTTPException,
+    Path as PathParam,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+)
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
-from sqlalchemy import select
+from sqlalchemy import func, select
+from sqlalchemy.orm import selectinload
 
-from app.auth import UserAuthorization, get_password_hash, user_authorization
+from app.admission import admit, backlog
+from app.auth import (
+    AdminAuthorization,
+    UserAuthorization,
+    get_password_hash,
+    user_authorization,
+)
 from app.database import DatabaseSession
-from app.minio_client import minio_client, upload_to_minio
-from app.models import ImageTask, User
-from app.schemas import UserLogin, UserRegister
-from app.tasks import augmentation
+from app.derivatives import (
+    DERIVED_PREFIX,
+    MEDIA_TYPES,
+    coalesce,
+    derivative_name,
+    output_format,
+    parse_render,
+)
+from app.history import (
+    EXPORT_MEDIA_TYPES,
+    ExportFormat,
+    OutputKind,
+    export_history,
+    history_page,
+    history_query,
+)
+from app.ingest import (
+    ALLOWED_CONTENT_TYPES,
+    ALLOWED_EXTENSIONS,
+    batch_progress,
+    build_filenames,
+    check_outputs,
+    dump_outputs,
+    dump_variants,
+    eager_outputs,
+    parse_outputs,
+    parse_upload_name,
+    parse_variants,
+    size_queue,
+    sniff_image,
+    sniff_stored,
+    sniff_upload,
+    store_upload,
+    submit_batch,
+    task_queue,
+    upload_prefix,
+)
+from app.limits import (
+    DownloadLimited,
+    UploadLimited,
+    charge_quota,
+    metered,
+    record_download,
+    usage,
+)
+from app.models import ImageTask, Stats, UploadPart, UploadSession, User
+from app.schemas import (
+    HistoryPage,
+    OutputSpec,
+    PresignedUpload,
+    UploadFiles,
+    UploadSessionCreate,
+    UploadSessionInfo,
+    UploadSessionPart,
+    UserLogin,
+    UserRegister,
+    Variants,
+)
+from app.settings import celery_settings, image_settings, storage_settings
+from app.storage import storage
+from app.tasks import render_derivative
+from app.transforms import transform_key
 
 router = APIRouter(tags=["API"])
 
@@ -42,73 +122,562 @@ async def login_user(
     return await user_authorization(session=session, form_data=form_data)
 
 
+async def batch_response(
+    files: list[str], uploads: list[dict], user_id, lane: str | None = None
+) -> dict:
+    batch_result, task_ids = await run_in_threadpool(
+        submit_batch, uploads, user_id, lane
+    )
+    return {
+        "batch_id": batch_result.id,
+        "tasks": [
+            {"file": file, "augmentation_task_id": task_id}
+            for file, task_id in zip(files, task_ids)
+        ],
+    }
+
+
 @router.post("/upload")
 async def upload_images(
-    user: UserAuthorization, files: List[UploadFile] = File(...)
-) -> list[dict]:
-    async def handle_file(file: UploadFile):
-        path = Path(file.filename)
-        filename, file_extension = path.stem, path.suffix.lower().lstrip(".")
-        filenames = {
-            "original": f"{filename}_original.{file_extension}",
-            "rotated": f"{filename}_rotated.{file_extension}",
-            "gray": f"{filename}_gray.{file_extension}",
-            "scaled": f"{filename}_scaled.{file_extension}",
-        }
-        original_minio_path = upload_to_minio(
-            file=file.file, filename=filenames["original"]
+    user: UploadLimited,
+    files: List[UploadFile] = File(...),
+    outputs: str | None = Form(None),
+    variants: str | None = Form(None),
+    eager: bool = Form(True),
+    lane: Literal["interactive", "bulk"] | None = Form(None),
+) -> dict:
+    variant_specs = parse_variants(variants)
+    output_specs = eager_outputs(parse_outputs(outputs), variant_specs, eager)
+
+    async def handle_file(file: UploadFile, image_info: dict):
+        filenames = build_filenames(
+            file.filename, output_specs, variant_specs, upload_prefix(user.id)
         )
-        augmentation_task = augmentation.delay(
-            minio_path=original_minio_path,
-            filenames=filenames,
-            user_id=user.id,
+        original_minio_path, content_hash = await store_upload(
+            file=file, object_name=filenames["original"]
         )
         return {
-            "file": file.filename,
-            "augmentation_task_id": augmentation_task.id,
+            "minio_path": original_minio_path,
+            "filenames": filenames,
+            "content_hash": content_hash,
+            "image_info": image_info,
+            "outputs": dump_outputs(output_specs),
+            "variants": dump_variants(variant_specs),
         }
 
-    tasks = []
-    allowed_content_types = {"image/jpeg", "image/png"}
     for file in files:
-        if file.content_type not in allowed_content_types:
+        if file.content_type not in ALLOWED_CONTENT_TYPES:
             raise HTTPException(
                 status_code=400,
                 detail=f"Invalid file type: {file.filename}. Only JPG and PNG files are allowed.",
             )
-        tasks.append(handle_file(file))
-    results = await asyncio.gather(*tasks)
+    image_infos = await asyncio.gather(
+        *(sniff_upload(file, output_specs, variant_specs) for file in files)
+    )
+    await admit({task_queue(image_info) for image_info in image_infos})
+    await charge_quota(
+        user.id,
+        images=len(files),
+        upload_bytes=sum(file.size or 0 for file in files),
+    )
+    uploads = await asyncio.gather(
+        *(
+            handle_file(file, image_info)
+            for file, image_info in zip(files, image_infos)
+        )
+    )
+    return await batch_response(
+        files=[file.filename for file in files],
+        uploads=uploads,
+        user_id=user.id,
+        lane=lane,
+    )
+
+
+@router.post("/upload/presign")
+async def presign_images(
+    user: UploadLimited, form_data: UploadFiles
+) -> list[PresignedUpload]:
+    results = []
+    for filename in form_data.files:
+        extension = Path(filename).suffix.lower().lstrip(".")
+        if extension not in ALLOWED_EXTENSIONS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid file type: {filename}. Only JPG and PNG files are allowed.",
+            )
+        object_name = build_filenames(
+            filename, prefix=upload_prefix(user.id)
+        )["original"]
+        try:
+            url = await storage.apresign(storage_settings.BUCKET, object_name)
+        except NotImplementedError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+        results.append(
+            PresignedUpload(file=filename, object_name=object_name, url=url)
+        )
     return results
 
 
+@router.post("/upload/complete")
+async def complete_images(
+    user: UploadLimited, form_data: UploadFiles
+) -> dict:
+    outputs = eager_outputs(
+        form_data.outputs, form_data.variants, form_data.eager
+    )
+    # Uploads are completed by the object names they were presigned under
+    filenames = {}
+    for object_name in form_data.files:
+        prefix, filename = parse_upload_name(user.id, object_name)
+        filenames[object_name] = build_filenames(
+            filename, outputs, form_data.variants, prefix
+        )
+    sizes = await asyncio.gather(
+        *(
+            storage.astat(storage_settings.BUCKET, names["original"])
+            for names in filenames.values()
+        )
+    )
+    missing = [name for name, size in zip(filenames, sizes) if size is None]
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Files were not uploaded: {', '.join(missing)}",
+        )
+    image_infos = await asyncio.gather(
+        *(
+            sniff_stored(name, names["original"], outputs, form_data.variants)
+            for name, names in filenames.items()
+        )
+    )
+    await admit({task_queue(image_info) for image_info in image_infos})
+    await charge_quota(user.id, images=len(sizes), upload_bytes=sum(sizes))
+    uploads = [
+        {
+            "minio_path": f"{storage_settings.BUCKET}/{names['original']}",
+            "filenames": names,
+            "image_info": image_info,
+            "outputs": dump_outputs(outputs),
+            "variants": dump_variants(form_data.variants),
+        }
+        for names, image_info in zip(filenames.values(), image_infos)
+    ]
+    return await batch_response(
+        files=list(filenames),
+        uploads=uploads,
+        user_id=user.id,
+        lane=form_data.lane,
+    )
+
+
+async def get_upload_session(
+    session: DatabaseSession, user: UserAuthorization, session_id: UUID
+) -> UploadSession:
+    upload_session = await session.get(
+        UploadSession,
+        session_id,
+        options=[selectinload(UploadSession.parts)],
+    )
+    if upload_session is None or upload_session.user_id != user.id:
+        raise HTTPException(
+            status_code=404, detail="No upload session found for the given ID"
+        )
+    return upload_session
+
+
+UserUploadSession = Annotated[UploadSession, Depends(get_upload_session)]
+
+
+def upload_session_info(upload_session: UploadSession) -> UploadSessionInfo:
+    return UploadSessionInfo(
+        session_id=upload_session.id,
+        filename=upload_session.filename,
+        part_size=storage_settings.PART_SIZE,
+        parts=[
+            UploadSessionPart(part_number=part.part_number, size=part.size)
+            for part in upload_session.parts
+        ],
+    )
+
+
+def upload_session_specs(
+    upload_session: UploadSession,
+) -> tuple[list[OutputSpec] | None, Variants | None]:
+    """Outputs and variants an upload session was created with."""
+    output_specs = variant_specs = None
+    if upload_session.outputs is not None:
+        output_specs = [
+            OutputSpec.model_validate(output)
+            for output in upload_session.outputs
+        ]
+    if upload_session.variants is not None:
+        variant_specs = Variants.model_validate(upload_session.variants)
+    return output_specs, variant_specs
+
+
+@router.post("/upload/sessions")
+async def create_upload_session(
+    session: DatabaseSession,
+    user: UploadLimited,
+    form_data: UploadSessionCreate,
+) -> UploadSessionInfo:
+    extension = Path(form_data.filename).suffix.lower().lstrip(".")
+    if extension not in ALLOWED_EXTENSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type: {form_data.filename}. Only JPG and PNG files are allowed.",
+        )
+    outputs = eager_outputs(
+        form_data.outputs, form_data.variants, form_data.eager
+    )
+    object_name = build_filenames(
+        form_data.filename, prefix=upload_prefix(user.id)
+    )["original"]
+    upload_id = await storage.acreate_multipart(
+        storage_settings.BUCKET, object_name
+    )
+    upload_session = UploadSession(
+        user_id=user.id,
+        filename=form_data.filename,
+        object_name=object_name,
+        upload_id=upload_id,
+        outputs=dump_outputs(outputs),
+        variants=dump_variants(form_data.variants),
+        parts=[],
+    )
+    session.add(upload_session)
+    await session.flush()
+    return upload_session_info(upload_session)
+
+
+@router.get("/upload/sessions/{session_id}")
+async def get_upload_session_info(
+    upload_session: UserUploadSession,
+) -> UploadSessionInfo:
+    return upload_session_info(upload_session)
+
+
+@router.put("/upload/sessions/{session_id}/parts/{part_number}")
+async def upload_session_part(
+    request: Request,
+    session: DatabaseSession,
+    upload_session: UserUploadSession,
+    part_number: Annotated[int, PathParam(ge=1, le=10000)],
+) -> UploadSessionPart:
+    data = bytearray()
+    async for chunk in request.stream():
+        data.extend(chunk)
+        if len(data) > storage_settings.MAX_PART_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Part is larger than {storage_settings.MAX_PART_SIZE} bytes",
+            )
+    if part_number == 1:
+        sniff_image(
+            upload_session.filename,
+            bytes(data[: image_settings.SNIFF_BYTES]),
+            None,
+            *upload_session_specs(upload_session),
+        )
+    etag = await storage.aupload_part(
+        storage_settings.BUCKET,
+        upload_session.object_name,
+        upload_session.upload_id,
+        part_number,
+        bytes(data),
+    )
+    await session.merge(
+        UploadPart(
+            session_id=upload_session.id,
+            part_number=part_number,
+            etag=etag,
+            size=len(data),
+        )
+    )
+    return UploadSessionPart(part_number=part_number, size=len(data))
+
+
+@router.post("/upload/sessions/{session_id}/complete")
+async def complete_upload_session(
+    session: DatabaseSession,
+    user: UploadLimited,
+    upload_session: UserUploadSession,
+) -> dict:
+    if not upload_session.parts:
+        raise HTTPException(
+            status_code=400, detail="No parts were uploaded for this session"
+        )
+    size = sum(part.size for part in upload_session.parts)
+    # Pixels are only known once the parts are assembled, which cannot be
+    # undone, so the queue is estimated from the bytes alone
+    await admit({size_queue(0, size)})
+    original_minio_path = await storage.acomplete_multipart(
+        storage_settings.BUCKET,
+        upload_session.object_name,
+        upload_session.upload_id,
+        [(part.part_number, part.etag) for part in upload_session.parts],
+    )
+    # The parts are assembled now, which cannot be undone, so the session
+    # is gone even when the object is rejected below
+    await session.delete(upload_session)
+    await session.commit()
+    output_specs, variant_specs = upload_session_specs(upload_session)
+    image_info = await sniff_stored(
+        upload_session.filename,
+        upload_session.object_name,
+        output_specs,
+        variant_specs,
+    )
+    try:
+        await charge_quota(user.id, images=1, upload_bytes=size)
+    except HTTPException as e:
+        # Without its session the object could never be completed again
+        await storage.adelete(
+            storage_settings.BUCKET, upload_session.object_name
+        )
+        raise e
+    prefix = upload_session.object_name.removesuffix(
+        build_filenames(upload_session.filename)["original"]
+    )
+    return await batch_response(
+        files=[upload_session.filename],
+        uploads=[
+            {
+                "minio_path": original_minio_path,
+                "filenames": build_filenames(
+                    upload_session.filename,
+                    output_specs,
+                    variant_specs,
+                    prefix,
+                ),
+                "image_info": image_info,
+                "outputs": upload_session.outputs,
+                "variants": upload_session.variants,
+            }
+        ],
+        user_id=user.id,
+    )
+
+
+@router.delete("/upload/sessions/{session_id}")
+async def abort_upload_session(
+    session: DatabaseSession, upload_session: UserUploadSession
+) -> None:
+    await storage.aabort_multipart(
+        storage_settings.BUCKET,
+        upload_session.object_name,
+        upload_session.upload_id,
+    )
+    await session.delete(upload_session)
+
+
+async def render_on_worker(
+    original: dict, output: OutputSpec, object_name: str, queue: str
+) -> None:
+    """
+    Renders a derivative on a worker of a queue and waits for it.
+
+    Renders decode whole originals, so they run on the worker pool sized
+    for the original rather than in the API process.
+    """
+    result = render_derivative.apply_async(
+        kwargs={
+            "original": original,
+            "output": output.model_dump(),
+            "object_name": object_name,
+        },
+        queue=queue,
+    )
+    try:
+        await run_in_threadpool(
+            result.get, timeout=celery_settings.RENDER_TIMEOUT
+        )
+    except MemoryError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except CeleryTimeoutError:
+        raise HTTPException(status_code=504, detail="Render timed out")
+
+
+@router.get("/images/{image_id}/render")
+async def render_image(
+    session: DatabaseSession,
+    user: DownloadLimited,
+    image_id: UUID,
+    op: Annotated[list[str], Query()] = [],
+    format: Literal["JPEG", "PNG", "WEBP", "AVIF"] | None = None,
+    preset: Literal["fast", "small", "archival"] | None = None,
+) -> Response:
+    original = await session.get(ImageTask, image_id)
+    if (
+        original is None
+        or original.user_id != user.id
+        or original.transform != "original"
+    ):
+        raise HTTPException(
+            status_code=404, detail="No image found for the given ID"
+        )
+    output = parse_render(op, format, preset)
+    stats = (
+        await session.execute(
+            select(Stats.width, Stats.height, Stats.size).where(
+                Stats.image_id == original.id
+            )
+        )
+    ).first()
+    image_info = None
+    if stats is not None:
+        image_info = dict(stats._mapping)
+        check_outputs(
+            Path(original.img_link).name,
+            (stats.width, stats.height),
+            [output],
+        )
+    image_format = await output_format(original, output)
+    headers = {"Cache-Control": "private, max-age=31536000, immutable"}
+
+    if original.content_hash is not None:
+        result = await session.execute(
+            select(ImageTask.img_link, Stats.size)
+            .join(Stats, Stats.image_id == ImageTask.id)
+            .where(
+                ImageTask.content_hash == original.content_hash,
+                ImageTask.transform == transform_key(output),
+                ImageTask.img_link.startswith(
+                    f"{DERIVED_PREFIX}{original.content_hash}/"
+                ),
+            )
+            .limit(1)
+        )
+        row = result.first()
+        if row is not None:
+            img_link, size = row
+            await record_download(user.id, size)
+            return StreamingResponse(
+                storage.astream(storage_settings.BUCKET, img_link),
+                media_type=MEDIA_TYPES[image_format],
+                headers=headers,
+            )
+
+    # Rendered before, but not recorded under this content hash
+    object_name = derivative_name(
+        original.content_hash or original.id, output, image_format
+    )
+    size = await storage.astat(storage_settings.BUCKET, object_name)
+    if size is None:
+        source = {
+            "task_id": original.task_id,
+            "user_id": original.user_id,
+            "img_link": original.img_link,
+            "content_hash": original.content_hash,
+        }
+        await coalesce(
+            object_name,
+            lambda: render_on_worker(
+                source, output, object_name, task_queue(image_info)
+            ),
+        )
+        size = await storage.astat(storage_settings.BUCKET, object_name)
+    await record_download(user.id, size)
+    return StreamingResponse(
+        storage.astream(storage_settings.BUCKET, object_name),
+        media_type=MEDIA_TYPES[image_format],
+        headers=headers,
+    )
+
+
+@router.get("/usage")
+async def get_usage(user: UserAuthorization) -> dict:
+    return await usage(user.id)
+
+
+@router.get("/ops/backlog")
+async def get_backlog(user: AdminAuthorization) -> dict:
+    return await backlog()
+
+
 @router.get("/status/{task_id}")
 async def get_task_status(task_id: str, user: UserAuthorization) -> dict:
     task_result = AsyncResult(task_id)
     return {"status": task_result.state}
 
 
+@router.get("/batch/{batch_id}")
+async def get_batch_status(batch_id: str, user: UserAuthorization) -> dict:
+    progress = await run_in_threadpool(batch_progress, batch_id, user.id)
+    if progress is None:
+        raise HTTPException(
+            status_code=404, detail="No batch found for the given batch ID"
+        )
+    return progress
+
+
+@router.get("/stats/deduplication")
+async def get_deduplication_stats(
+    session: DatabaseSession, user: UserAuthorization
+) -> dict:
+    result = await session.execute(
+        select(
+            func.count(ImageTask.id),
+            func.count(ImageTask.id).filter(ImageTask.deduplicated),
+        ).where(ImageTask.transform == "original")
+    )
+    uploads, deduplicated = result.one()
+    return {
+        "uploads": uploads,
+        "deduplicated": deduplicated,
+        "hit_rate": deduplicated / uploads if uploads else 0.0,
+    }
+
+
+@router.get("/history/export")
+async def export_user_history(
+    user: DownloadLimited,
+    export_format: ExportFormat = Query("ndjson", alias="format"),
+    cursor: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    kind: OutputKind | None = None,
+) -> StreamingResponse:
+    query = history_query(user.id, cursor, since, until, kind)
+    return StreamingResponse(
+        metered(user.id, export_history(query, export_format, cursor is None)),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={
+            "Content-Disposition": (
+                f"attachment; filename=history.{export_format}"
+            )
+        },
+    )
+
+
 @router.get("/history/{user_id}")
 async def get_user_history(
     session: DatabaseSession,
     user: UserAuthorization,
-    user_id: str,
-) -> list[dict]:
-    result = await session.execute(select(ImageTask).where(User.id == user_id))
-    images = result.scalars().all()
-
-    if not images:
+    user_id: UUID,
+    cursor: str | None = None,
+    limit: int = Query(50, ge=1, le=500),
+    since: datetime | None = None,
+    until: datetime | None = None,
+    kind: OutputKind | None = None,
+) -> HistoryPage:
+    if user_id != user.id:
         raise HTTPException(
-            status_code=404, detail="No history found for the given user ID"
+            status_code=403, detail="Not allowed to read this history"
         )
-    return images
+    result = await session.execute(
+        history_query(user_id, cursor, since, until, kind).limit(limit + 1)
+    )
+    return history_page(result.all(), limit)
 
 
 @router.get("/task/{task_id}")
 async def get_task_images(
     session: DatabaseSession,
-    user: UserAuthorization,
+    user: DownloadLimited,
     task_id: str,
-    bucket_name="images",
+    bucket_name=storage_settings.BUCKET,
 ) -> StreamingResponse:
     result = await session.execute(
         select(ImageTask).where(ImageTask.task_id == task_id)
@@ -122,14 +691,12 @@ async def get_task_images(
     zip_buffer = io.BytesIO()
     with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
         for image in images:
-            response = minio_client.get_object(
-                bucket_name=bucket_name, object_name=image.img_link
+            file_data = await storage.aget(bucket_name, image.img_link)
+            zip_file.writestr(
+                Path(image.output or image.img_link).name, file_data
             )
-            file_data = response.read()
-            response.close()
-            response.release_conn()
-            zip_file.writestr(image.img_link, file_data)
     zip_buffer.seek(0)
+    await record_download(user.id, zip_buffer.getbuffer().nbytes)
 
     return StreamingResponse(
         zip_buffer,
@@ -0,0 +1,154 @@
+import base64
+import csv
+import io
+import json
+from datetime import datetime
+from typing import AsyncIterator, Literal
+from uuid import UUID
+
+from fastapi import HTTPException
+from sqlalchemy import Select, select, tuple_
+
+from app.database import async_sessionmaker
+from app.models import ImageTask, Stats
+
+# Kinds of rows in a history: uploaded originals, requested outputs and
+# random variants
+OutputKind = Literal["original", "output", "variant"]
+
+ExportFormat = Literal["ndjson", "csv"]
+
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Rows fetched from the server-side cursor and sent to the client at once
+EXPORT_ROWS = 1000
+
+# Columns of a history item, the rows of a task and the stats of each
+HISTORY_COLUMNS = (
+    ImageTask.id,
+    ImageTask.task_id,
+    ImageTask.img_link,
+    ImageTask.transform,
+    ImageTask.deduplicated,
+    ImageTask.seed,
+    ImageTask.created_at,
+    Stats.width,
+    Stats.height,
+    Stats.size,
+    Stats.processing_time,
+)
+
+
+def encode_cursor(created_at: datetime, image_id: UUID) -> str:
+    """Opaque cursor continuing a history after the given row."""
+    key = f"{created_at.isoformat()}|{image_id}"
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        created_at, image_id = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        )
+        return datetime.fromisoformat(created_at), UUID(image_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid history cursor")
+
+
+def history_query(
+    user_id: UUID,
+    cursor: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    kind: OutputKind | None = None,
+) -> Select:
+    """
+    Rows of the history of a user with their stats, newest first.
+
+    Rows are ordered by (created_at, id), the keyset a cursor continues
+    after, so every page is a range scan of the
+    ix_imagetask_user_id_created_at index however long the history is.
+    since is inclusive and until exclusive.
+    """
+    query = (
+        select(*HISTORY_COLUMNS)
+        .outerjoin(Stats, Stats.image_id == ImageTask.id)
+        .where(ImageTask.user_id == user_id)
+        .order_by(ImageTask.created_at.desc(), ImageTask.id.desc())
+    )
+    if cursor is not None:
+        query = query.where(
+            tuple_(ImageTask.created_at, ImageTask.id)
+            < tuple_(*decode_cursor(cursor))
+        )
+    if since is not None:
+        query = query.where(ImageTask.created_at >= since)
+    if until is not None:
+        query = query.where(ImageTask.created_at < until)
+    if kind == "original":
+        query = query.where(ImageTask.transform == "original")
+    elif kind == "output":
+        query = query.where(
+            ImageTask.transform != "original", ImageTask.seed.is_(None)
+        )
+    elif kind == "variant":
+        query = query.where(ImageTask.seed.is_not(None))
+    return query
+
+
+def history_page(rows: list, limit: int) -> dict:
+    """
+    A page of history items from up to limit + 1 rows of history_query.
+
+    The extra row only tells whether another page follows.
+    """
+    items = [row._asdict() for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor(last["created_at"], last["id"])
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def export_record(row) -> dict:
+    """A history item with the cursor resuming an export after it."""
+    return {
+        **row._asdict(),
+        "cursor": encode_cursor(row.created_at, row.id),
+    }
+
+
+def format_rows(
+    records: list[dict], export_format: ExportFormat, header: bool = False
+) -> str:
+    if export_format == "ndjson":
+        return "".join(
+            json.dumps(record, default=str) + "\n" for record in records
+        )
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(records[0]))
+    if header:
+        writer.writeheader()
+    writer.writerows(records)
+    return buffer.getvalue()
+
+
+async def export_history(
+    query: Select, export_format: ExportFormat = "ndjson", header: bool = True
+) -> AsyncIterator[bytes]:
+    """
+    Streams the rows of a history_query as NDJSON or CSV.
+
+    Rows come from a server-side cursor EXPORT_ROWS at a time, and the
+    next ones are only fetched once the client took the previous ones,
+    so memory stays constant however long the history is. Every record
+    carries the cursor resuming an interrupted export after it. header
+    starts CSV exports with the column names.
+    """
+    query = query.execution_options(yield_per=EXPORT_ROWS)
+    async with async_sessionmaker() as session:
+        result = await session.stream(query)
+        async for rows in result.partitions():
+            records = [export_record(row) for row in rows]
+            yield format_rows(records, export_format, header).encode()
+            header = False
@@ -0,0 +1,494 @@
+import io
+import re
+import secrets
+from pathlib import Path
+from uuid import uuid4
+
+from celery import group, states
+from celery.result import GroupResult
+from fastapi import HTTPException, UploadFile
+from PIL import Image, UnidentifiedImageError
+from pydantic import TypeAdapter, ValidationError
+
+from app.batching import BATCH_MODES, batchable_outputs
+from app.celery import QUEUES, celery_app
+from app.schemas import Outputs, OutputSpec, Rotate, Variants
+from app.scheduling import Lane, reserve_priorities, upload_lane
+from app.settings import celery_settings, image_settings, storage_settings
+from app.storage import HashingReader, storage
+from app.tasks import augmentation, augmentation_batch
+from app.transforms import (
+    FORMAT_EXTENSIONS,
+    default_outputs,
+    normalize,
+    peak_pixels,
+    transform_key,
+    variant_name,
+)
+
+ALLOWED_CONTENT_TYPES = {"image/jpeg", "image/png"}
+ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png"}
+ALLOWED_FORMATS = {"JPEG", "PNG"}
+
+BATCH_STATES = {
+    states.PENDING: "queued",
+    states.RECEIVED: "queued",
+    states.STARTED: "running",
+    states.RETRY: "running",
+    states.SUCCESS: "done",
+    states.FAILURE: "failed",
+    states.REVOKED: "failed",
+}
+
+
+OUTPUTS_ADAPTER = TypeAdapter(Outputs)
+
+# Object names of originals issued by upload_prefix and build_filenames
+UPLOAD_NAME = re.compile(
+    r"(?P<prefix>uploads/(?P<user_id>[^/]+)/[0-9a-f]{32}/)"
+    r"(?P<stem>[^/]+)_original\.(?P<extension>[^./]+)"
+)
+
+
+def upload_prefix(user_id) -> str:
+    """
+    Prefix of the objects of one upload of a user.
+
+    The prefix is unique and unguessable, so no upload overwrites the
+    objects of another, and it names the user, so an upload can only be
+    completed by the user it was issued to.
+    """
+    return f"uploads/{user_id}/{uuid4().hex}/"
+
+
+def parse_upload_name(user_id, object_name: str) -> tuple[str, str]:
+    """
+    Prefix and filename of the original object name of an upload.
+
+    Only names issued to the given user are accepted, any other name is
+    reported as not uploaded.
+    """
+    match = UPLOAD_NAME.fullmatch(object_name)
+    if match is None or match["user_id"] != str(user_id):
+        raise HTTPException(
+            status_code=404,
+            detail=f"Files were not uploaded: {object_name}",
+        )
+    return match["prefix"], f"{match['stem']}.{match['extension']}"
+
+
+def build_filenames(
+    filename: str,
+    outputs: list[OutputSpec] | None = None,
+    variants: Variants | None = None,
+    prefix: str = "",
+) -> dict:
+    """
+    Object names of the original image and its outputs.
+
+    The default outputs are only used when neither outputs nor variants
+    are requested. Names start with prefix, the upload_prefix of the
+    upload they belong to.
+    """
+    path = Path(filename)
+    stem, file_extension = path.stem, path.suffix.lower().lstrip(".")
+    filenames = {"original": f"{prefix}{stem}_original.{file_extension}"}
+    if outputs is None and variants is None:
+        outputs = default_outputs()
+    for output in outputs or []:
+        extension = FORMAT_EXTENSIONS.get(output.format, file_extension)
+        filenames[output.name] = f"{prefix}{stem}_{output.name}.{extension}"
+    if variants is not None:
+        extension = FORMAT_EXTENSIONS.get(
+            variants.policy.format, file_extension
+        )
+        for index in range(variants.count):
+            name = variant_name(index)
+            filenames[name] = f"{prefix}{stem}_{name}.{extension}"
+    return filenames
+
+
+def parse_outputs(outputs: str | None) -> list[OutputSpec] | None:
+    """Validates outputs sent as a JSON form field."""
+    if outputs is None:
+        return None
+    try:
+        return OUTPUTS_ADAPTER.validate_json(outputs)
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=422, detail=e.errors(include_url=False)
+        )
+
+
+def parse_variants(variants: str | None) -> Variants | None:
+    """Validates variants sent as a JSON form field."""
+    if variants is None:
+        return None
+    try:
+        return Variants.model_validate_json(variants)
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=422, detail=e.errors(include_url=False)
+        )
+
+
+def eager_outputs(
+    outputs: list[OutputSpec] | None, variants: Variants | None, eager: bool
+) -> list[OutputSpec] | None:
+    """
+    Outputs rendered at upload.
+
+    Without eager generation only the original is stored at upload and
+    derivatives are rendered on demand, so no outputs or variants can be
+    requested with it.
+    """
+    if eager:
+        return outputs
+    if outputs is not None or variants is not None:
+        raise HTTPException(
+            status_code=422,
+            detail="Outputs and variants require eager generation",
+        )
+    return []
+
+
+def dump_variants(variants: Variants | None) -> dict | None:
+    """
+    Variants as augmentation task arguments.
+
+    Without a seed every call draws a new one, so each image gets its own
+    variants while the seed recorded with them still reproduces them.
+    """
+    if variants is None:
+        return None
+    if variants.seed is None:
+        variants = variants.model_copy(update={"seed": secrets.randbits(63)})
+    return variants.model_dump()
+
+
+def dump_outputs(outputs: list[OutputSpec] | None) -> list[dict] | None:
+    """Outputs as augmentation task arguments."""
+    if outputs is None:
+        return None
+    return [output.model_dump() for output in outputs]
+
+
+def check_outputs(
+    filename: str,
+    size: tuple[int, int],
+    outputs: list[OutputSpec] | None,
+    variants: Variants | None = None,
+) -> None:
+    """
+    Rejects outputs that go through images above the pixel limit.
+
+    Operations are bounded one by one when they are validated, but a
+    chain of them can grow the image at every step, so every chain is
+    checked from the size of the image it applies to. Variants are
+    checked at their largest rotation, as the bounding box of a rotated
+    image grows up to 45 degrees.
+    """
+    chains = [normalize(output.operations) for output in outputs or []]
+    if variants is not None:
+        chains.append([Rotate(degrees=min(variants.policy.rotation, 45))])
+    if any(
+        peak_pixels(operations, size) > image_settings.MAX_PIXELS
+        for operations in chains
+    ):
+        raise HTTPException(
+            status_code=413,
+            detail=f"Output too large: {filename}. Outputs are limited to {image_settings.MAX_PIXELS} pixels.",
+        )
+
+
+def sniff_image(
+    filename: str,
+    head: bytes,
+    size: int | None,
+    outputs: list[OutputSpec] | None = None,
+    variants: Variants | None = None,
+) -> dict:
+    """
+    Reads format, mode, dimensions and frame count from the image header.
+
+    Only the first bytes of the file are needed, so images over the
+    configured byte, pixel or frame limits, images whose outputs or
+    variants would exceed the pixel limit and files that are not images
+    are rejected before anything is stored or queued.
+    """
+    too_large = HTTPException(
+        status_code=413,
+        detail=f"Image too large: {filename}. The limits are {image_settings.MAX_PIXELS} pixels and {image_settings.MAX_BYTES} bytes.",
+    )
+    if size is not None and size > image_settings.MAX_BYTES:
+        raise too_large
+    try:
+        with Image.open(io.BytesIO(head)) as image:
+            image_info = {
+                "format": image.format,
+                "mode": image.mode,
+                "width": image.width,
+                "height": image.height,
+                "frames": getattr(image, "n_frames", 1),
+                "size": size,
+            }
+    except Image.DecompressionBombError:
+        raise too_large
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid image: {filename}. The file is truncated or corrupt.",
+        )
+    if image_info["format"] not in ALLOWED_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type: {filename}. Only JPG and PNG files are allowed.",
+        )
+    if image_info["frames"] > image_settings.MAX_FRAMES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid image: {filename}. Animated images are not supported.",
+        )
+    if image_info["width"] * image_info["height"] > image_settings.MAX_PIXELS:
+        raise too_large
+    check_outputs(
+        filename,
+        (image_info["width"], image_info["height"]),
+        outputs,
+        variants,
+    )
+    return image_info
+
+
+async def sniff_upload(
+    file: UploadFile,
+    outputs: list[OutputSpec] | None = None,
+    variants: Variants | None = None,
+) -> dict:
+    """Sniffs the header of an uploaded file and rewinds it."""
+    head = await file.read(image_settings.SNIFF_BYTES)
+    await file.seek(0)
+    return sniff_image(file.filename, head, file.size, outputs, variants)
+
+
+async def sniff_stored(
+    filename: str,
+    object_name: str,
+    outputs: list[OutputSpec] | None = None,
+    variants: Variants | None = None,
+) -> dict:
+    """
+    Sniffs the header of an object uploaded directly to storage.
+
+    Rejected objects are deleted so they are never processed.
+    """
+    bucket_name = storage_settings.BUCKET
+    head = await storage.aread_head(
+        bucket_name, object_name, image_settings.SNIFF_BYTES
+    )
+    size = await storage.astat(bucket_name, object_name)
+    try:
+        return sniff_image(filename, head, size, outputs, variants)
+    except HTTPException as e:
+        await storage.adelete(bucket_name, object_name)
+        raise e
+
+
+async def store_upload(file: UploadFile, object_name: str) -> tuple[str, str]:
+    """
+    Streams an uploaded file to storage without blocking the event loop and
+    returns its storage path together with the SHA-256 of its content.
+
+    The known upload size is passed as the object length, so the backend
+    reads the spooled file part by part instead of buffering it to discover
+    its size. The content is hashed as it is read, so no extra pass over
+    the file is needed.
+    """
+    length = file.size if file.size is not None else -1
+    reader = HashingReader(file.file)
+    path = await storage.aput(
+        storage_settings.BUCKET, object_name, reader, length
+    )
+    return path, reader.hexdigest()
+
+
+def batch_key(upload: dict) -> tuple | None:
+    """
+    Key of the uploads the batch engine can render together.
+
+    Uploads need the same sniffed mode and size and the same outputs, all
+    with vectorized operations. Returns None for uploads left to their own
+    task.
+    """
+    image_info = upload.get("image_info")
+    if (
+        image_info is None
+        or image_info["mode"] not in BATCH_MODES
+        or upload.get("variants") is not None
+    ):
+        return None
+    outputs = upload.get("outputs")
+    if outputs is None:
+        outputs = default_outputs()
+    else:
+        outputs = [OutputSpec.model_validate(output) for output in outputs]
+    if not batchable_outputs(outputs):
+        return None
+    return (
+        image_info["mode"],
+        image_info["width"],
+        image_info["height"],
+        tuple((output.name, transform_key(output)) for output in outputs),
+    )
+
+
+def size_queue(pixels: int, size: int) -> str:
+    """Queue of images above the pixel or byte threshold of its class."""
+    if (
+        pixels > celery_settings.HUGE_PIXELS
+        or size > celery_settings.HUGE_BYTES
+    ):
+        return "huge"
+    if (
+        pixels > celery_settings.LARGE_PIXELS
+        or size > celery_settings.LARGE_BYTES
+    ):
+        return "large"
+    return "small"
+
+
+def task_queue(image_info: dict | None) -> str:
+    """
+    Queue of the worker pool sized for an image.
+
+    Images of unknown size go to the large queue.
+    """
+    if image_info is None:
+        return "large"
+    return size_queue(
+        image_info["width"] * image_info["height"],
+        image_info.get("size") or 0,
+    )
+
+
+def chunk_queue(uploads: list[dict]) -> str:
+    """Queue of a task augmenting several uploads, that of the largest."""
+    return max(
+        (task_queue(upload.get("image_info")) for upload in uploads),
+        key=QUEUES.index,
+    )
+
+
+def chunk_uploads(uploads: list[dict]) -> list[list[int]]:
+    """
+    Splits uploads into the indices of the uploads of each task.
+
+    Uploads with the same batch key are chunked by the configured batch
+    size, every other upload gets a task of its own.
+    """
+    chunks = []
+    stacks = {}
+    for index, upload in enumerate(uploads):
+        key = batch_key(upload)
+        if key is None:
+            chunks.append([index])
+            continue
+        stack = stacks.get(key)
+        if stack is None or len(stack) == image_settings.BATCH_SIZE:
+            stack = stacks[key] = []
+            chunks.append(stack)
+        stack.append(index)
+    return chunks
+
+
+def submit_batch(
+    uploads: list[dict], user_id, lane: Lane | None = None
+) -> tuple[GroupResult, list[str]]:
+    """
+    Enqueues augmentation of several stored originals as one Celery group.
+
+    All messages are published through a single producer connection and the
+    group is saved in the result backend, so its id can be used to query
+    the progress of the whole batch. Each upload is a dict of augmentation
+    arguments: minio_path, filenames, content_hash, image_info and
+    outputs.
+
+    Same-shape uploads with the same outputs are augmented together by
+    one augmentation_batch task. Each task is routed to the queue of the
+    size class of its images, with a priority from its lane and from the
+    backlog of the user, so users share workers fairly. Returns the group
+    and the id of the task of each upload.
+    """
+    chunks = chunk_uploads(uploads)
+    priorities = reserve_priorities(
+        celery_app.backend.client,
+        user_id,
+        upload_lane(lane, len(uploads)),
+        len(chunks),
+    )
+    batch = group(
+        (
+            augmentation.s(user_id=user_id, **uploads[chunk[0]])
+            if len(chunk) == 1
+            else augmentation_batch.s(
+                uploads=[uploads[index] for index in chunk], user_id=user_id
+            )
+        ).set(
+            queue=chunk_queue([uploads[index] for index in chunk]),
+            priority=priority,
+        )
+        for chunk, priority in zip(chunks, priorities)
+    )
+    with celery_app.producer_or_acquire() as producer:
+        batch_result = batch.apply_async(producer=producer)
+    batch_result.save()
+    # Batches are only shown to the user who submitted them
+    celery_app.backend.client.set(
+        batch_owner_key(batch_result.id),
+        str(user_id),
+        ex=celery_app.conf.result_expires,
+    )
+    task_ids = [None] * len(uploads)
+    for chunk, task in zip(chunks, batch_result.results):
+        for index in chunk:
+            task_ids[index] = task.id
+    return batch_result, task_ids
+
+
+def batch_owner_key(batch_id: str) -> str:
+    return f"batch:{batch_id}"
+
+
+def batch_progress(batch_id: str, user_id) -> dict | None:
+    """
+    Counts the tasks of a batch of a user by state, reading all states at
+    once.
+
+    Returns None for unknown or expired batches, and rejects batches of
+    other users with a 403.
+    """
+    backend = celery_app.backend
+    owner = backend.client.get(batch_owner_key(batch_id))
+    if owner is None:
+        return None
+    if owner.decode() != str(user_id):
+        raise HTTPException(
+            status_code=403, detail="Not allowed to read this batch"
+        )
+    batch_result = GroupResult.restore(batch_id, app=celery_app)
+    if batch_result is None:
+        return None
+    metas = backend.mget(
+        [backend.get_key_for_task(task.id) for task in batch_result.results]
+    )
+    progress = {
+        "total": len(metas),
+        "queued": 0,
+        "running": 0,
+        "done": 0,
+        "failed": 0,
+    }
+    for meta in metas:
+        state = backend.decode_result(meta)["status"] if meta else None
+        progress[BATCH_STATES.get(state, "queued")] += 1
+    return progress
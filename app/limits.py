@@ -0,0 +1,229 @@
+from datetime import datetime, timedelta, timezone
+from math import ceil
+from typing import Annotated, AsyncIterator
+
+from fastapi import Depends, HTTPException
+from redis.asyncio import Redis
+
+from app.auth import UserAuthorization
+from app.models import User
+from app.settings import celery_settings, limit_settings
+
+redis_client = Redis.from_url(celery_settings.url)
+
+# Takes cost tokens from a bucket refilled at rate tokens per second up to
+# burst tokens. Returns 1 and the tokens left, or 0 and the seconds until
+# enough tokens are available. Time comes from the Redis server, so API
+# replicas with skewed clocks share buckets correctly.
+TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(state[1]) or burst
+local time = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - time) * rate)
+local allowed = 0
+local result = (cost - tokens) / rate
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+    result = tokens
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'time', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(result)}
+"""
+
+# Adds ARGV[i + 1] to every counter KEYS[i] if none of them would exceed
+# its limit ARGV[i + 1 + #KEYS], and nothing otherwise. Returns 0 on
+# success or the index of the first counter over its limit. A zero amount
+# only checks that its counter is not exhausted.
+QUOTA = """
+local count = #KEYS
+for i, key in ipairs(KEYS) do
+    local used = tonumber(redis.call('GET', key) or '0')
+    local amount = tonumber(ARGV[i + 1])
+    if used + math.max(amount, 1) > tonumber(ARGV[i + 1 + count]) then
+        return i
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('INCRBY', key, ARGV[i + 1])
+    redis.call('EXPIRE', key, ARGV[1])
+end
+return 0
+"""
+
+token_bucket = redis_client.register_script(TOKEN_BUCKET)
+quota = redis_client.register_script(QUOTA)
+
+# Daily quotas, by the name of their counter
+QUOTAS = ("images", "upload_bytes", "download_bytes")
+
+# Daily counters outlive their day by this many seconds, so a request
+# right at midnight still finds the counter it was charged to
+QUOTA_GRACE = 60 * 60
+
+
+def bucket_key(user_id, name: str) -> str:
+    return f"rate:{user_id}:{name}"
+
+
+def quota_key(user_id, name: str, day: str) -> str:
+    return f"quota:{user_id}:{name}:{day}"
+
+
+def today() -> tuple[str, int]:
+    """The UTC date and the seconds left until it ends."""
+    now = datetime.now(timezone.utc)
+    midnight = datetime.combine(
+        now.date() + timedelta(days=1), datetime.min.time(), timezone.utc
+    )
+    return now.date().isoformat(), ceil((midnight - now).total_seconds())
+
+
+def rates() -> dict[str, tuple[float, int]]:
+    """Refill rate per second and burst of each rate limit."""
+    return {
+        "upload": (limit_settings.UPLOAD_RATE, limit_settings.UPLOAD_BURST),
+        "download": (
+            limit_settings.DOWNLOAD_RATE,
+            limit_settings.DOWNLOAD_BURST,
+        ),
+    }
+
+
+def quota_limits() -> dict[str, int]:
+    return {
+        "images": limit_settings.DAILY_IMAGES,
+        "upload_bytes": limit_settings.DAILY_UPLOAD_BYTES,
+        "download_bytes": limit_settings.DAILY_DOWNLOAD_BYTES,
+    }
+
+
+def too_many_requests(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, ceil(retry_after)))},
+    )
+
+
+async def take_token(user_id, name: str) -> None:
+    """Takes a token from a rate limit of a user, or raises a 429."""
+    rate, burst = rates()[name]
+    allowed, result = await token_bucket(
+        keys=[bucket_key(user_id, name)], args=[rate, burst, 1]
+    )
+    if not allowed:
+        raise too_many_requests(
+            f"Too many {name} requests, retry later", float(result)
+        )
+
+
+async def charge_quota(user_id, **amounts: int) -> None:
+    """
+    Charges amounts to the daily quotas of a user, or raises a 429.
+
+    Either every amount is charged or, when any quota would be exceeded,
+    none is.
+    """
+    day, left = today()
+    limits = quota_limits()
+    names = list(amounts)
+    exceeded = await quota(
+        keys=[quota_key(user_id, name, day) for name in names],
+        args=[
+            left + QUOTA_GRACE,
+            *(amounts[name] for name in names),
+            *(limits[name] for name in names),
+        ],
+    )
+    if exceeded:
+        name = names[exceeded - 1]
+        raise too_many_requests(
+            f"Daily {name.replace('_', ' ')} quota of {limits[name]} exceeded",
+            left,
+        )
+
+
+async def record_download(user_id, nbytes: int) -> None:
+    """Adds downloaded bytes to the daily quota of a user, past its limit."""
+    day, left = today()
+    key = quota_key(user_id, "download_bytes", day)
+    async with redis_client.pipeline() as pipeline:
+        pipeline.incrby(key, nbytes)
+        pipeline.expire(key, left + QUOTA_GRACE)
+        await pipeline.execute()
+
+
+async def metered(
+    user_id, chunks: AsyncIterator[bytes]
+) -> AsyncIterator[bytes]:
+    """
+    Passes a streamed download through, recording its bytes when it ends.
+
+    Interrupted downloads are recorded for the bytes that were sent.
+    """
+    nbytes = 0
+    try:
+        async for chunk in chunks:
+            nbytes += len(chunk)
+            yield chunk
+    finally:
+        await record_download(user_id, nbytes)
+
+
+async def usage(user_id) -> dict:
+    """Current rate limit tokens and daily quota usage of a user."""
+    day, left = today()
+    seconds, microseconds = await redis_client.time()
+    now = seconds + microseconds / 1_000_000
+    result = {"rates": {}, "quotas": {}, "resets_in": left}
+    for name, (rate, burst) in rates().items():
+        tokens, time = await redis_client.hmget(
+            bucket_key(user_id, name), "tokens", "time"
+        )
+        available = burst
+        if tokens is not None:
+            available = min(
+                burst, float(tokens) + max(0.0, now - float(time)) * rate
+            )
+        result["rates"][name] = {
+            "tokens": available,
+            "burst": burst,
+            "rate": rate,
+        }
+    used = await redis_client.mget(
+        [quota_key(user_id, name, day) for name in QUOTAS]
+    )
+    limits = quota_limits()
+    for name, value in zip(QUOTAS, used):
+        result["quotas"][name] = {
+            "used": int(value or 0),
+            "limit": limits[name],
+        }
+    return result
+
+
+async def limit_uploads(user: UserAuthorization) -> User:
+    """Current user, after taking a token from their upload rate limit."""
+    await take_token(user.id, "upload")
+    return user
+
+
+async def limit_downloads(user: UserAuthorization) -> User:
+    """
+    Current user, after taking a token from their download rate limit and
+    checking their download quota is not exhausted.
+    """
+    await take_token(user.id, "download")
+    await charge_quota(user.id, download_bytes=0)
+    return user
+
+
+UploadLimited = Annotated[User, Depends(limit_uploads)]
+DownloadLimited = Annotated[User, Depends(limit_downloads)]
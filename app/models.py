@@ -2,7 +2,19 @@ from datetime import datetime
 from typing import List
 from uuid import uuid4
 
-from sqlalchemy import DateTime, ForeignKey, Integer, String
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    JSON,
+    String,
+    UniqueConstraint,
+    false,
+)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import (
     Mapped,
@@ -25,14 +37,33 @@ class ImageTask(Base):
         ForeignKey("user.id", ondelete="CASCADE"), nullable=False
     )
     img_link: Mapped[str] = mapped_column(String, nullable=False)
+    # Object name the output was requested under, unique within its task
+    output: Mapped[str] = mapped_column(String, nullable=True)
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=True)
+    transform: Mapped[str] = mapped_column(String, nullable=True)
+    deduplicated: Mapped[bool] = mapped_column(
+        Boolean, default=False, server_default=false()
+    )
+    seed: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    params: Mapped[dict] = mapped_column(JSON, nullable=True)
     created_at: Mapped[datetime] = mapped_column(
-        DateTime, default=datetime.utcnow
+        DateTime, default=datetime.utcnow, index=True
     )
     stats: Mapped["Stats"] = relationship(
         "Stats", back_populates="image", uselist=False
     )
     user: Mapped["User"] = relationship("User", back_populates="tasks")
 
+    __table_args__ = (
+        Index(
+            "ix_imagetask_content_hash_transform", "content_hash", "transform"
+        ),
+        UniqueConstraint("task_id", "output", name="uq_imagetask_task_output"),
+        Index(
+            "ix_imagetask_user_id_created_at", "user_id", "created_at", "id"
+        ),
+    )
+
 
 class User(Base):
     __tablename__ = "user"
@@ -47,6 +78,10 @@ class User(Base):
     )
     first_name: Mapped[str] = mapped_column(String, nullable=False)
     last_name: Mapped[str] = mapped_column(String, nullable=False)
+    # Admins may read the operations endpoints, granted in the database only
+    is_admin: Mapped[bool] = mapped_column(
+        Boolean, default=False, server_default=false()
+    )
     tasks: Mapped[List["ImageTask"]] = relationship(
         "ImageTask", back_populates="user"
     )
@@ -59,7 +94,9 @@ class Stats(Base):
         UUID(as_uuid=True), primary_key=True, default=uuid4, index=True
     )
     image_id: Mapped[UUID] = mapped_column(
-        ForeignKey("imagetask.id", ondelete="CASCADE"), nullable=False
+        ForeignKey("imagetask.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
     )
     image: Mapped["ImageTask"] = relationship(
         "ImageTask", back_populates="stats"
@@ -67,4 +104,130 @@ class Stats(Base):
     width: Mapped[int] = mapped_column(Integer, nullable=False)
     height: Mapped[int] = mapped_column(Integer, nullable=False)
     size: Mapped[int] = mapped_column(Integer, nullable=False)
-    processing_time: Mapped[float] = mapped_column(Integer, nullable=False)
+    processing_time: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+class UploadSession(Base):
+    __tablename__ = "uploadsession"
+
+    id: Mapped[UUID] = mapped_column(
+        UUID(as_uuid=True), primary_key=True, default=uuid4, index=True
+    )
+    user_id: Mapped[UUID] = mapped_column(
+        ForeignKey("user.id", ondelete="CASCADE"), nullable=False
+    )
+    filename: Mapped[str] = mapped_column(String, nullable=False)
+    object_name: Mapped[str] = mapped_column(String, nullable=False)
+    upload_id: Mapped[str] = mapped_column(String, nullable=False)
+    outputs: Mapped[list] = mapped_column(JSON, nullable=True)
+    variants: Mapped[dict] = mapped_column(JSON, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow
+    )
+    parts: Mapped[List["UploadPart"]] = relationship(
+        "UploadPart",
+        back_populates="session",
+        order_by="UploadPart.part_number",
+        cascade="all, delete-orphan",
+    )
+
+
+class UploadPart(Base):
+    __tablename__ = "uploadpart"
+
+    session_id: Mapped[UUID] = mapped_column(
+        ForeignKey("uploadsession.id", ondelete="CASCADE"), primary_key=True
+    )
+    part_number: Mapped[int] = mapped_column(Integer, primary_key=True)
+    etag: Mapped[str] = mapped_column(String, nullable=False)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    session: Mapped["UploadSession"] = relationship(
+        "UploadSession", back_populates="parts"
+    )
+
+
+class TaskUsage(Base):
+    __tablename__ = "taskusage"
+
+    task_id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), primary_key=True)
+    task_name: Mapped[str] = mapped_column(String, nullable=False)
+    queue: Mapped[str] = mapped_column(String, nullable=True)
+    state: Mapped[str] = mapped_column(String, nullable=False)
+    wall_time: Mapped[float] = mapped_column(Float, nullable=False)
+    cpu_time: Mapped[float] = mapped_column(Float, nullable=False)
+    peak_rss: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow
+    )
+
+
+class StageTiming(Base):
+    __tablename__ = "stagetiming"
+
+    id: Mapped[UUID] = mapped_column(
+        UUID(as_uuid=True), primary_key=True, default=uuid4
+    )
+    task_id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), index=True)
+    # download, decode, transform:{op}, render, encode, upload, db_write
+    # or batch_render
+    stage: Mapped[str] = mapped_column(String, nullable=False)
+    # Name of the output the stage worked on, None for shared stages
+    output: Mapped[str] = mapped_column(String, nullable=True)
+    # Seconds, from perf_counter
+    duration: Mapped[float] = mapped_column(Float, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow, index=True
+    )
+
+
+class RollupWatermark(Base):
+    __tablename__ = "rollupwatermark"
+
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    # Rows created before this time are in the rollups
+    watermark: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+# Images recorded per minute and kind: original, output or variant
+class ImageRollup(Base):
+    __tablename__ = "imagerollup"
+
+    minute: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    kind: Mapped[str] = mapped_column(String, primary_key=True)
+    images: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    deduplicated: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    # Sums over the images, in bytes and seconds
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    processing_time: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+# Images recorded per minute by size bucket, its upper bound in bytes
+class SizeRollup(Base):
+    __tablename__ = "sizerollup"
+
+    minute: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    bucket: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    images: Mapped[int] = mapped_column(BigInteger, nullable=False)
+
+
+# Images recorded per minute by width and height
+class DimensionRollup(Base):
+    __tablename__ = "dimensionrollup"
+
+    minute: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    width: Mapped[int] = mapped_column(Integer, primary_key=True)
+    height: Mapped[int] = mapped_column(Integer, primary_key=True)
+    images: Mapped[int] = mapped_column(BigInteger, nullable=False)
+
+
+# Stage timings per minute and stage by duration bucket, its upper bound
+# in microseconds
+class StageRollup(Base):
+    __tablename__ = "stagerollup"
+
+    minute: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    stage: Mapped[str] = mapped_column(String, primary_key=True)
+    bucket: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    count: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    # Sum of the durations, in seconds
+    duration: Mapped[float] = mapped_column(Float, nullable=False)
@@ -0,0 +1,195 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import DateTime, case, func, literal, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+from app.database import dialect_insert
+from app.models import (
+    DimensionRollup,
+    ImageRollup,
+    ImageTask,
+    RollupWatermark,
+    SizeRollup,
+    StageRollup,
+    StageTiming,
+    Stats,
+)
+from app.settings import celery_settings
+
+# Name of the watermark of the dashboard rollups
+WATERMARK = "dashboards"
+
+# Upper bounds of the size buckets in bytes, by powers of 2 from 1 KiB to
+# 4 GiB, the last bucket taking every larger image
+SIZE_BUCKETS = [2**power for power in range(10, 33)]
+
+# Upper bounds of the duration buckets in microseconds, by half powers of
+# 2 from 1 µs to about 2 minutes, so percentiles read from them are
+# within 41% of the exact ones
+DURATION_BUCKETS = sorted({round(2 ** (power / 2)) for power in range(55)})
+
+
+class minute(FunctionElement):
+    """Start of the minute of a timestamp."""
+
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(minute)
+def compile_minute(element, compiler, **kwargs):
+    return "date_trunc('minute', %s)" % compiler.process(
+        element.clauses, **kwargs
+    )
+
+
+@compiles(minute, "sqlite")
+def compile_minute_sqlite(element, compiler, **kwargs):
+    # In the format SQLAlchemy stores DateTime in on SQLite
+    return "strftime('%%Y-%%m-%%d %%H:%%M:00.000000', %s)" % (
+        compiler.process(element.clauses, **kwargs)
+    )
+
+
+def bucket(value, bounds: list[int]):
+    """Smallest of the bounds not below value, or the largest one."""
+    return case(
+        *((value <= bound, bound) for bound in bounds[:-1]),
+        else_=bounds[-1],
+    )
+
+
+def upsert(session, model, columns: list[str], query, sums: list[str]):
+    """
+    Inserts the rows of a query into a rollup, adding the sums to those
+    of rows already there for the same key.
+    """
+    statement = dialect_insert(session, model).from_select(columns, query)
+    key = [column for column in columns if column not in sums]
+    return statement.on_conflict_do_update(
+        index_elements=key,
+        set_={
+            name: getattr(model, name) + statement.excluded[name]
+            for name in sums
+        },
+    )
+
+
+def rollups(session, start: datetime, until: datetime) -> list:
+    """Statements adding the rows created in [start, until) to the rollups."""
+    image_minute = minute(ImageTask.created_at)
+    images = (
+        select(ImageTask, Stats)
+        .join(Stats, Stats.image_id == ImageTask.id)
+        .where(ImageTask.created_at >= start, ImageTask.created_at < until)
+    )
+    kind = case(
+        (ImageTask.transform == "original", literal("original")),
+        (ImageTask.seed.is_not(None), literal("variant")),
+        else_=literal("output"),
+    )
+    size_bucket = bucket(Stats.size, SIZE_BUCKETS)
+    stage_minute = minute(StageTiming.created_at)
+    duration_bucket = bucket(StageTiming.duration * 1e6, DURATION_BUCKETS)
+    return [
+        upsert(
+            session,
+            ImageRollup,
+            [
+                "minute",
+                "kind",
+                "images",
+                "deduplicated",
+                "size",
+                "processing_time",
+            ],
+            images.with_only_columns(
+                image_minute,
+                kind,
+                func.count(),
+                func.count().filter(ImageTask.deduplicated),
+                func.sum(Stats.size),
+                func.sum(Stats.processing_time),
+            ).group_by(image_minute, kind),
+            ["images", "deduplicated", "size", "processing_time"],
+        ),
+        upsert(
+            session,
+            SizeRollup,
+            ["minute", "bucket", "images"],
+            images.with_only_columns(
+                image_minute, size_bucket, func.count()
+            ).group_by(image_minute, size_bucket),
+            ["images"],
+        ),
+        upsert(
+            session,
+            DimensionRollup,
+            ["minute", "width", "height", "images"],
+            images.with_only_columns(
+                image_minute, Stats.width, Stats.height, func.count()
+            ).group_by(image_minute, Stats.width, Stats.height),
+            ["images"],
+        ),
+        upsert(
+            session,
+            StageRollup,
+            ["minute", "stage", "bucket", "count", "duration"],
+            select(
+                stage_minute,
+                StageTiming.stage,
+                duration_bucket,
+                func.count(),
+                func.sum(StageTiming.duration),
+            )
+            .where(
+                StageTiming.created_at >= start,
+                StageTiming.created_at < until,
+            )
+            .group_by(stage_minute, StageTiming.stage, duration_bucket),
+            ["count", "duration"],
+        ),
+    ]
+
+
+def roll_up(session, now: datetime) -> bool:
+    """
+    Adds the rows created since the watermark to the rollups.
+
+    Rows are taken up to ROLLUP_LAG seconds before now, whole minutes at
+    a time and at most ROLLUP_WINDOW seconds of them, and the watermark
+    moves past them in the same transaction, so every row is counted
+    exactly once. The watermark row is locked meanwhile, so concurrent
+    runs wait for each other. Without a watermark the rollups start from
+    the oldest row. Returns whether the watermark moved, and more rows
+    may be left to roll up.
+    """
+    until = (now - timedelta(seconds=celery_settings.ROLLUP_LAG)).replace(
+        second=0, microsecond=0
+    )
+    watermark = session.get(RollupWatermark, WATERMARK, with_for_update=True)
+    if watermark is not None:
+        start = watermark.watermark
+    else:
+        oldest = [
+            session.scalar(select(func.min(ImageTask.created_at))),
+            session.scalar(select(func.min(StageTiming.created_at))),
+        ]
+        oldest = [created_at for created_at in oldest if created_at]
+        if not oldest:
+            return False
+        start = min(oldest).replace(second=0, microsecond=0)
+        watermark = RollupWatermark(name=WATERMARK, watermark=start)
+        session.add(watermark)
+    until = min(
+        until, start + timedelta(seconds=celery_settings.ROLLUP_WINDOW)
+    )
+    if until <= start:
+        session.rollback()
+        return False
+    for statement in rollups(session, start, until):
+        session.execute(statement)
+    watermark.watermark = until
+    session.commit()
+    return True
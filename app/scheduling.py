@@ -0,0 +1,86 @@
+from typing import Literal
+
+from app.settings import celery_settings
+
+Lane = Literal["interactive", "bulk"]
+
+# First broker priority of each lane, 0 being served first
+LANES = {"interactive": 0, "bulk": 5}
+
+# Priorities within a lane, from a user's first tasks to a long backlog
+LANE_LEVELS = 5
+
+# Broker priorities, each stored by the Redis transport in a list of its own
+PRIORITY_STEPS = list(range(max(LANES.values()) + LANE_LEVELS))
+
+# Backlog counters expire when a user submits nothing for this long, so
+# counts of tasks that never finished (lost workers) do not stick forever
+BACKLOG_TTL = 24 * 60 * 60
+
+
+def backlog_key(user_id) -> str:
+    return f"backlog:{user_id}"
+
+
+def upload_lane(lane: Lane | None, count: int) -> Lane:
+    """Lane of a batch of uploads, interactive for small batches unless given."""
+    if lane is not None:
+        return lane
+    if count <= celery_settings.INTERACTIVE_UPLOADS:
+        return "interactive"
+    return "bulk"
+
+
+def task_priority(lane: Lane, position: int) -> int:
+    """
+    Broker priority of a task with position tasks of its user ahead of it.
+
+    The first FAIR_SHARE tasks of a user get the first level of their
+    lane, and each further level covers twice as many tasks as the one
+    before. A user with a long backlog therefore never holds more than
+    FAIR_SHARE tasks ahead of the first tasks of another user in the same
+    lane, which bounds their queueing latency, while tasks of one user
+    keep their order.
+    """
+    level = (position // celery_settings.FAIR_SHARE).bit_length()
+    return LANES[lane] + min(LANE_LEVELS - 1, level)
+
+
+def reserve_priorities(client, user_id, lane: Lane, count: int) -> list[int]:
+    """
+    Counts count new tasks in the backlog of a user and returns their
+    priorities, reserving their positions in one atomic increment.
+    """
+    key = backlog_key(user_id)
+    with client.pipeline() as pipeline:
+        pipeline.incrby(key, count)
+        pipeline.expire(key, BACKLOG_TTL)
+        end, _ = pipeline.execute()
+    return [
+        task_priority(lane, position) for position in range(end - count, end)
+    ]
+
+
+def release_task(client, user_id) -> None:
+    """Removes a finished task from the backlog of its user."""
+    key = backlog_key(user_id)
+    if client.decr(key) < 0:
+        client.delete(key)
+
+
+def queue_keys(queue: str) -> list[str]:
+    """Redis lists holding the messages of a queue, one per priority."""
+    return [queue] + [f"{queue}:{step}" for step in PRIORITY_STEPS[1:]]
+
+
+def drained_key(queue: str, minute: int) -> str:
+    return f"drained:{queue}:{minute}"
+
+
+def record_drained(client, queue: str, now: float) -> None:
+    """Counts a task finished from a queue in the current minute."""
+    key = drained_key(queue, int(now // 60))
+    with client.pipeline() as pipeline:
+        pipeline.incr(key)
+        pipeline.expire(key, (celery_settings.DRAIN_MINUTES + 1) * 60)
+        pipeline.execute()
@@ -1,4 +1,17 @@
-from pydantic import BaseModel, EmailStr
+from datetime import datetime
+from typing import Annotated, Literal, Union
+from uuid import UUID
+
+from PIL import features
+from pydantic import (
+    AfterValidator,
+    BaseModel,
+    EmailStr,
+    Field,
+    model_validator,
+)
+
+from app.settings import image_settings
 
 
 class UserLogin(BaseModel):
@@ -9,3 +22,220 @@ class UserLogin(BaseModel):
 class UserRegister(UserLogin):
     first_name: str
     last_name: str
+
+
+class Rotate(BaseModel):
+    op: Literal["rotate"] = "rotate"
+    degrees: float
+
+
+class Resize(BaseModel):
+    op: Literal["resize"] = "resize"
+    width: int | None = Field(default=None, gt=0)
+    height: int | None = Field(default=None, gt=0)
+    scale: float | None = Field(default=None, gt=0, le=1)
+
+    @model_validator(mode="after")
+    def check_size(self) -> "Resize":
+        if (self.scale is None) == (
+            self.width is None and self.height is None
+        ):
+            raise ValueError("Either scale or width/height must be set")
+        if (self.width or 1) * (self.height or 1) > image_settings.MAX_PIXELS:
+            raise ValueError(
+                f"Resize must be to at most {image_settings.MAX_PIXELS} pixels"
+            )
+        return self
+
+
+class Crop(BaseModel):
+    op: Literal["crop"] = "crop"
+    left: int = Field(ge=0)
+    top: int = Field(ge=0)
+    right: int = Field(gt=0)
+    bottom: int = Field(gt=0)
+
+    @model_validator(mode="after")
+    def check_box(self) -> "Crop":
+        if self.right <= self.left or self.bottom <= self.top:
+            raise ValueError("Crop box must have a positive size")
+        if (self.right - self.left) * (
+            self.bottom - self.top
+        ) > image_settings.MAX_PIXELS:
+            raise ValueError(
+                f"Crop box must be at most {image_settings.MAX_PIXELS} pixels"
+            )
+        return self
+
+
+class Flip(BaseModel):
+    op: Literal["flip"] = "flip"
+    direction: Literal["horizontal", "vertical"]
+
+
+class Grayscale(BaseModel):
+    op: Literal["grayscale"] = "grayscale"
+
+
+class Blur(BaseModel):
+    op: Literal["blur"] = "blur"
+    radius: float = Field(default=2, gt=0, le=100)
+
+
+class ColorJitter(BaseModel):
+    op: Literal["color_jitter"] = "color_jitter"
+    brightness: float = Field(default=1, ge=0)
+    contrast: float = Field(default=1, ge=0)
+    saturation: float = Field(default=1, ge=0)
+
+
+class Noise(BaseModel):
+    op: Literal["noise"] = "noise"
+    sigma: float = Field(gt=0, le=128)
+    seed: int = Field(ge=0, lt=2**63)
+
+
+Operation = Annotated[
+    Union[Rotate, Resize, Crop, Flip, Grayscale, Blur, ColorJitter, Noise],
+    Field(discriminator="op"),
+]
+
+
+def check_format(image_format: str | None) -> str | None:
+    if image_format == "AVIF" and not features.check("avif"):
+        raise ValueError("AVIF encoding is not available on this server")
+    return image_format
+
+
+Format = Annotated[
+    Literal["JPEG", "PNG", "WEBP", "AVIF"] | None,
+    AfterValidator(check_format),
+]
+
+
+class Encoding(BaseModel):
+    """
+    Encoder settings of an output.
+
+    A preset fills in every setting not given explicitly. effort trades
+    encode time against size from 0 (fastest) to 9 (smallest), and is
+    mapped to the compression level, method or speed of each format.
+    Settings a format has no use for are ignored.
+    """
+
+    preset: Literal["fast", "small", "archival"] | None = None
+    quality: int | None = Field(default=None, ge=1, le=100)
+    effort: int | None = Field(default=None, ge=0, le=9)
+    progressive: bool | None = None
+    optimize: bool | None = None
+    lossless: bool | None = None
+    strip_metadata: bool | None = None
+
+
+class OutputSpec(BaseModel):
+    name: str = Field(pattern=r"^[a-z0-9_]{1,32}$")
+    operations: list[Operation] = Field(max_length=32)
+    format: Format = None
+    encoding: Encoding | None = None
+
+    @model_validator(mode="after")
+    def check_name(self) -> "OutputSpec":
+        if self.name == "original" or self.name.startswith("variant_"):
+            raise ValueError(
+                "Output names 'original' and 'variant_*' are reserved"
+            )
+        return self
+
+
+def check_unique_names(outputs: list[OutputSpec]) -> list[OutputSpec]:
+    names = [output.name for output in outputs]
+    if len(set(names)) != len(names):
+        raise ValueError("Output names must be unique")
+    return outputs
+
+
+Outputs = Annotated[
+    list[OutputSpec],
+    Field(min_length=1, max_length=16),
+    AfterValidator(check_unique_names),
+]
+
+
+class VariantPolicy(BaseModel):
+    """
+    Ranges random variants are sampled from.
+
+    rotation is the largest angle in degrees either way, crop the smallest
+    fraction of each side that is kept, flip the probability of a
+    horizontal flip, brightness and contrast the largest relative change
+    and noise the largest standard deviation of added Gaussian noise.
+    """
+
+    rotation: float = Field(default=15, ge=0, le=180)
+    crop: float = Field(default=0.8, gt=0, le=1)
+    flip: float = Field(default=0.5, ge=0, le=1)
+    brightness: float = Field(default=0.2, ge=0, le=1)
+    contrast: float = Field(default=0.2, ge=0, le=1)
+    noise: float = Field(default=0, ge=0, le=128)
+    format: Format = None
+    encoding: Encoding | None = None
+
+
+class Variants(BaseModel):
+    count: int = Field(ge=1, le=500)
+    seed: int | None = Field(default=None, ge=0, lt=2**63)
+    policy: VariantPolicy = VariantPolicy()
+
+
+class UploadFiles(BaseModel):
+    # Filenames to presign, or the object names they were presigned under
+    # to complete
+    files: list[str] = Field(min_length=1)
+    outputs: Outputs | None = None
+    variants: Variants | None = None
+    eager: bool = True
+    lane: Literal["interactive", "bulk"] | None = None
+
+
+class PresignedUpload(BaseModel):
+    file: str
+    object_name: str
+    url: str
+
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    outputs: Outputs | None = None
+    variants: Variants | None = None
+    eager: bool = True
+
+
+class UploadSessionPart(BaseModel):
+    part_number: int
+    size: int
+
+
+class UploadSessionInfo(BaseModel):
+    session_id: UUID
+    filename: str
+    part_size: int
+    parts: list[UploadSessionPart]
+
+
+class HistoryItem(BaseModel):
+    id: UUID
+    task_id: UUID
+    img_link: str
+    transform: str | None
+    deduplicated: bool
+    seed: int | None
+    created_at: datetime
+    width: int | None
+    height: int | None
+    size: int | None
+    processing_time: float | None
+
+
+class HistoryPage(BaseModel):
+    items: list[HistoryItem]
+    next_cursor: str | None
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -16,6 +18,8 @@ class DatabaseSettings(BaseSettings):
     PORT: str
     NAME: str
     TESTNAME: str
+    # Logs every statement the engines run
+    ECHO: bool = False
 
     @property
     def async_url(self) -> str:
@@ -54,6 +58,10 @@ class MinioSettings(BaseSettings):
     ROOT_PASSWORD: str
     PORT_API: str
     PORT_CONSOLE: str
+    PART_SIZE: int = 10 * 1024 * 1024
+    PUBLIC_URL: str | None = None
+    REGION: str = "us-east-1"
+    PRESIGN_EXPIRE_MINUTES: int = 15
 
     @property
     def url(self) -> str:
@@ -64,6 +72,42 @@ class MinioSettings(BaseSettings):
         return f"{host}:{port}"
 
 
+class StorageSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="STORAGE_",
+        env_file=".env",
+        env_file_encoding="utf-8",
+        extra="ignore",
+    )
+    BACKEND: Literal["minio", "local", "memory"] = "minio"
+    LOCAL_ROOT: str = "/data/storage"
+    BUCKET: str = "images"
+    CONCURRENCY: int = 8
+    PART_SIZE: int = 16 * 1024 * 1024
+    MAX_PART_SIZE: int = 64 * 1024 * 1024
+
+
+class ImageSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="IMAGE_",
+        env_file=".env",
+        env_file_encoding="utf-8",
+        extra="ignore",
+    )
+    MAX_PIXELS: int = 100_000_000
+    MAX_BYTES: int = 1024 * 1024 * 1024
+    MAX_FRAMES: int = 1
+    SNIFF_BYTES: int = 64 * 1024
+    RENDER_THREADS: int = 4
+    # Same-shape uploads rendered together by one batch task, 1 disables
+    # the batch engine
+    BATCH_SIZE: int = 1
+    # Images above this many pixels are rendered in strips, one output at
+    # a time. Renders of any size are estimated to fit in TASK_MEMORY bytes
+    TILED_PIXELS: int = 50_000_000
+    TASK_MEMORY: int = 4 * 1024 * 1024 * 1024
+
+
 class CelerySettings(BaseSettings):
     model_config = SettingsConfigDict(
         env_prefix="CELERY_",
@@ -75,6 +119,37 @@ class CelerySettings(BaseSettings):
     HOST: str
     PORT: str
     NAME: str
+    # Tasks of images above either threshold go to the large or huge queue,
+    # all other tasks to the small one
+    LARGE_PIXELS: int = 12_000_000
+    LARGE_BYTES: int = 16 * 1024 * 1024
+    HUGE_PIXELS: int = 50_000_000
+    HUGE_BYTES: int = 128 * 1024 * 1024
+    # Tasks of a user served at full priority before their next tasks
+    # yield to other users
+    FAIR_SHARE: int = 8
+    # Uploads of at most this many files go to the interactive lane
+    INTERACTIVE_UPLOADS: int = 10
+    # Uploads are refused while the queue they would join holds more tasks
+    # than this, or needs longer than MAX_DRAIN_SECONDS to drain at the
+    # rate measured over the last DRAIN_MINUTES minutes
+    MAX_QUEUE_DEPTH: int = 20_000
+    MAX_DRAIN_SECONDS: int = 30 * 60
+    DRAIN_MINUTES: int = 5
+    # Tasks failing on storage or database errors are retried this many
+    # times, with exponential backoff of at most RETRY_BACKOFF_MAX seconds
+    MAX_RETRIES: int = 5
+    RETRY_BACKOFF_MAX: int = 10 * 60
+    # The dashboard rollups are updated every ROLLUP_INTERVAL seconds with
+    # the rows older than ROLLUP_LAG seconds, so rows of transactions
+    # still running are not missed, at most ROLLUP_WINDOW seconds of rows
+    # per step
+    ROLLUP_INTERVAL: int = 60
+    ROLLUP_LAG: int = 2 * 60
+    ROLLUP_WINDOW: int = 6 * 60 * 60
+    # On-demand renders are answered with a 504 when no worker finished
+    # them within RENDER_TIMEOUT seconds
+    RENDER_TIMEOUT: int = 60
 
     @property
     def url(self) -> str:
@@ -87,6 +162,24 @@ class CelerySettings(BaseSettings):
         return f"{driver}://{host}:{port}/{name}"
 
 
+class LimitSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="LIMIT_",
+        env_file=".env",
+        env_file_encoding="utf-8",
+        extra="ignore",
+    )
+    # Requests per second and burst of the token bucket of each user
+    UPLOAD_RATE: float = 1.0
+    UPLOAD_BURST: int = 20
+    DOWNLOAD_RATE: float = 5.0
+    DOWNLOAD_BURST: int = 50
+    # Quotas of each user per UTC day
+    DAILY_IMAGES: int = 10_000
+    DAILY_UPLOAD_BYTES: int = 20 * 1024 * 1024 * 1024
+    DAILY_DOWNLOAD_BYTES: int = 50 * 1024 * 1024 * 1024
+
+
 class AuthSettings(BaseSettings):
     model_config = SettingsConfigDict(
         env_prefix="AUTH_",
@@ -101,5 +194,8 @@ class AuthSettings(BaseSettings):
 
 database_settings = DatabaseSettings()
 minio_settings = MinioSettings()
+storage_settings = StorageSettings()
+image_settings = ImageSettings()
 celery_settings = CelerySettings()
+limit_settings = LimitSettings()
 auth_settings = AuthSettings()
@@ -0,0 +1,565 @@
+import asyncio
+import hashlib
+import io
+import shutil
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Iterator
+
+import urllib3
+from minio import Minio
+from minio.datatypes import Part
+from minio.error import S3Error
+
+from app.settings import minio_settings, storage_settings
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ObjectNotFoundError(LookupError):
+    pass
+
+
+class HashingReader:
+    """File wrapper computing the SHA-256 of everything read through it."""
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.hash.update(data)
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        self.hash = hashlib.sha256()
+        return self.file.seek(offset, whence)
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+class Storage(ABC):
+    """
+    Object storage backend.
+
+    Objects are addressed by bucket and object name, and every method
+    returning a location uses the "{bucket_name}/{object_name}" form.
+    Buckets are created once by bootstrap(), not on every write. Blocking
+    methods have async counterparts running them on a bounded executor,
+    so the API can call them without blocking the event loop.
+    """
+
+    def __init__(self, concurrency: int = storage_settings.CONCURRENCY):
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="storage"
+        )
+
+    @abstractmethod
+    def make_bucket(self, bucket_name: str) -> None: ...
+
+    @abstractmethod
+    def put(
+        self,
+        bucket_name: str,
+        object_name: str,
+        data: BinaryIO,
+        length: int = -1,
+    ) -> str: ...
+
+    @abstractmethod
+    def get(self, bucket_name: str, object_name: str) -> bytes: ...
+
+    @abstractmethod
+    def stat(self, bucket_name: str, object_name: str) -> int | None:
+        """Size of an object in bytes or None when it does not exist."""
+
+    @abstractmethod
+    def presign(self, bucket_name: str, object_name: str) -> str:
+        """URL a client can PUT the object to without going through the API."""
+
+    @abstractmethod
+    def delete(self, bucket_name: str, object_name: str) -> None: ...
+
+    @abstractmethod
+    def stream(
+        self, bucket_name: str, object_name: str, chunk_size: int = CHUNK_SIZE
+    ) -> Iterator[bytes]: ...
+
+    @abstractmethod
+    def create_multipart(self, bucket_name: str, object_name: str) -> str:
+        """Starts a multipart upload and returns its upload id."""
+
+    @abstractmethod
+    def upload_part(
+        self,
+        bucket_name: str,
+        object_name: str,
+        upload_id: str,
+        part_number: int,
+        data: bytes,
+    ) -> str:
+        """Stores one part of a multipart upload and returns its ETag."""
+
+    @abstractmethod
+    def complete_multipart(
+        self,
+        bucket_name: str,
+        object_name: str,
+        upload_id: str,
+        parts: list[tuple[int, str]],
+    ) -> str:
+        """Assembles the (part number, ETag) parts into the final object."""
+
+    @abstractmethod
+    def abort_multipart(
+        self, bucket_name: str, object_name: str, upload_id: str
+    ) -> None: ...
+
+    def read_head(
+        self, bucket_name: str, object_name: str, length: int
+    ) -> bytes:
+        """First bytes of an object, without reading the rest of it."""
+        chunks = self.stream(bucket_name, object_name, length)
+        try:
+            return next(chunks, b"")
+        finally:
+            chunks.close()
+
+    def bootstrap(self) -> None:
+        self.make_bucket(storage_settings.BUCKET)
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def aput(
+        self,
+        bucket_name: str,
+        object_name: str,
+        data: BinaryIO,
+        length: int = -1,
+    ) -> str:
+        return await self.run(self.put, bucket_name, object_name, data, length)
+
+    async def aget(self, bucket_name: str, object_name: str) -> bytes:
+        return await self.run(self.get, bucket_name, object_name)
+
+    async def astat(self, bucket_name: str, object_name: str) -> int | None:
+        return await self.run(self.stat, bucket_name, object_name)
+
+    async def apresign(self, bucket_name: str, object_name: str) -> str:
+        return await self.run(self.presign, bucket_name, object_name)
+
+    async def aread_head(
+        self, bucket_name: str, object_name: str, length: int
+    ) -> bytes:
+        return await self.run(self.read_head, bucket_name, object_name, length)
+
+    async def adelete(self, bucket_name: str, object_name: str) -> None:
+        return await self.run(self.delete, bucket_name, object_name)
+
+    async def acreate_multipart(
+        self, bucket_name: str, object_name: str
+    ) -> str:
+        return await self.run(self.create_multipart, bucket_name, object_name)
+
+    async def aupload_part(
+        self,
+        bucket_name: str,
+        object_name: str,
+        upload_id: str,
+        part_number: int,
+        data: bytes,
+    ) -> str:
+        return await self.run(
+            self.upload_part,
+            bucket_name,
+            object_name,
+            upload_id,
+            part_number,
+            data,
+        )
+
+    async def acomplete_multipart(
+        self,
+        bucket_name: str,
+        object_name: str,
+        upload_id: str,
+        parts: list[tuple[int, str]],
+    ) -> str:
+        return await self.run(
+            self.complete_multipart, bucket_name, object_name, upload_id, parts
+        )
+
+    async def aabort_multipart(
+        self, bucket_name: str, object_name: str, upload_id: str
+    ) -> None:
+        return await self.run(
+            self.abort_multipart, bucket_name, object_name, upload_id
+        )
+
+    async def astream(
+        self, bucket_name: str, object_name: str, chunk_size: int = CHUNK_SIZE
+    ) -> AsyncIterator[bytes]:
+        chunks = self.stream(bucket_name, object_name, chunk_size)
+        while chunk := await self.run(next, chunks, b""):
+            yield chunk
+
+
+class MinioStorage(Storage):
+    """
+    MinIO/S3 backend.
+
+    All requests share one urllib3 pool sized to the executor, so
+    concurrent calls reuse keep-alive connections instead of opening new
+    ones.
+    """
+
+    def __init__(self, concurrency: int = storage_settings.CONCURRENCY):
+        super().__init__(concurrency)
+        http_client = urllib3.PoolManager(
+            maxsize=concurrency,
+            timeout=urllib3.Timeout(connect=30, read=300),
+            retries=urllib3.Retry(
+                total=5,
+                backoff_factor=0.2,
+                status_forcelist=[500, 502, 503, 504],
+            ),
+        )
+        self.client = Minio(
+            minio_settings.url,
+            access_key=minio_settings.ROOT_USER,
+            secret_key=minio_settings.ROOT_PASSWORD,
+            secure=False,
+            http_client=http_client,
+        )
+        # Presigned URLs are signed for the host clients will actually
+        # connect to. Setting the region up front avoids a bucket-location
+        # lookup per URL.
+        self.presign_client = Minio(
+            minio_settings.PUBLIC_URL or minio_settings.url,
+            access_key=minio_settings.ROOT_USER,
+            secret_key=minio_settings.ROOT_PASSWORD,
+            secure=False,
+            region=minio_settings.REGION,
+        )
+
+    def make_bucket(self, bucket_name: str) -> None:
+        if not self.client.bucket_exists(bucket_name):
+            self.client.make_bucket(bucket_name)
+
+    def put(
+        self,
+        bucket_name: str,
+        object_name: str,
+        data: BinaryIO,
+        length: int = -1,
+    ) -> str:
+        data.seek(0)
+        self.client.put_object(
+            bucket_name,
+            object_name,
+            data,
+            length=length,
+            part_size=minio_settings.PART_SIZE,
+        )
+        return f"{bucket_name}/{object_name}"
+
+    def get(self, bucket_name: str, object_name: str) -> bytes:
+        response = self.open(bucket_name, object_name)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def stat(self, bucket_name: str, object_name: str) -> int | None:
+        try:
+            return self.client.stat_object(bucket_name, object_name).size
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchBucket"):
+                return None
+            raise e
+
+    def presign(self, bucket_name: str, object_name: str) -> str:
+        return self.presign_client.presigned_put_object(
+            bucket_name,
+            object_name,
+            expires=timedelta(minutes=minio_settings.PRESIGN_EXPIRE_MINUTES),
+        )
+
+    def delete(self, bucket_name: str, object_name: str) -> None:
+        self.client.remove_object(bucket_name, object_name)
+
+    def stream(
+        self, bucket_name: str, object_name: str, chunk_size: int = CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        response = self.open(bucket_name, object_name)
+        try:
+            yield from response.stream(chunk_size)
+        finally:
+            response.close()
+            response.release_conn()
+
+    # The client has no public API for multipart uploads driven part by
+    # part, so these use its private methods, with minio pinned exactly
+    def create_multipart(self, bucket_name: str, object_name: str) -> str:
+        return self.client._create_multipart_upload(
+            bucket_name,
+            object_name,
+            {"Content-Type": "application/octet-stream"},
+        )
+
+    def upload_part(
+        self,
+        bucket_name: str,
+        object_name: str,
+        upload_id: str,
+        part_number: int,
+        data: bytes,
+    ) -> str:
+        return self.client._upload_part(
+            bucket_name, object_name, data, None, upload_id, part_number
+        )
+
+    def complete_multipart(
+        self,
+        bucket_name: str,
+        object_name: str,
+        upload_id: str,
+        parts: list[tuple[int, str]],
+    ) -> str:
+        self.client._complete_multipart_upload(
+            bucket_name,
+            object_name,
+            upload_id,
+            [Part(part_number, etag) for part_number, etag in parts],
+        )
+        return f"{bucket_name}/{object_name}"
+
+    def abort_multipart(
+        self, bucket_name: str, object_name: str, upload_id: str
+    ) -> None:
+        self.client._abort_multipart_upload(
+            bucket_name, object_name, upload_id
+        )
+
+    def open(self, bucket_name: str, object_name: str):
+        try:
+            return self.client.get_object(
+                bucket_name=bucket_name, object_name=object_name
+            )
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchBucket"):
+                raise ObjectNotFoundError(f"{bucket_name}/{object_name}")
+            raise e
+
+
+class LocalStorage(Storage):
+    """Filesystem backend for single-node deployments."""
+
+    def __init__(
+        self,
+        root: str = storage_settings.LOCAL_ROOT,
+        concurrency: int = storage_settings.CONCURRENCY,
+    ):
+        super().__init__(concurrency)
+        self.root = Path(root)
+
+    def path(self, bucket_name: str, object_name: str) -> Path:
+        bucket = (self.root / bucket_name).resolve()
+        path = (bucket / object_name).resolve()
+        if not path.is_relative_to(bucket):
+            raise ValueError(f"Invalid object name: {object_name}")
+        return path
+
+    def make_bucket(self, bucket_name: str) -> None:
+        (self.root / bucket_name).mkdir(parents=True, exist_ok=True)
+
+    def put(
+        self,
+        bucket_name: str,
+        object_name: str,
+        data: BinaryIO,
+        length: int = -1,
+    ) -> str:
+        path = self.path(bucket_name, object_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data.seek(0)
+        partial = path.with_name(f".{path.name}.partial")
+        with open(partial, "wb") as file:
+            shutil.copyfileobj(data, file, CHUNK_SIZE)
+        partial.replace(path)
+        return f"{bucket_name}/{object_name}"
+
+    def get(self, bucket_name: str, object_name: str) -> bytes:
+        try:
+            return self.path(bucket_name, object_name).read_bytes()
+        except FileNotFoundError:
+            raise ObjectNotFoundError(f"{bucket_name}/{object_name}")
+
+    def stat(self, bucket_name: str, object_name: str) -> int | None:
+        path = self.path(bucket_name, object_name)
+        return path.stat().st_size if path.is_file() else None
+
+    def presign(self, bucket_name: str, object_name: str) -> str:
+        raise NotImplementedError(
+            "Presigned uploads require an S3 compatible storage backend"
+        )
+
+    def delete(self, bucket_name: str, object_name: str) -> None:
+        self.path(bucket_name, object_name).unlink(missing_ok=True)
+
+    def stream(
+        self, bucket_name: str, object_name: str, chunk_size: int = CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        try:
+            file = open(self.path(bucket_name, object_name), "rb")
+        except FileNotFoundError:
+            raise ObjectNotFoundError(f"{bucket_name}/{object_name}")
+        with file:
+            while chunk := file.read(chunk_size):
+                yield chunk
+
+    def multipart_path(self, upload_id: str) -> Path:
+        return self.root / ".multipart" / str(uuid.UUID(upload_id))
+
+    def create_multipart(self, bucket_name: str, object_name: str) -> str:
+        upload_id = str(uuid.uuid4())
+        self.multipart_path(upload_id).mkdir(parents=True)
+        return upload_id
+
+    def upload_part(
+        self,
+        bucket_name: str,
+        object_name: str,
+        upload_id: str,
+        part_number: int,
+        data: bytes,
+    ) -> str:
+        path = self.multipart_path(upload_id) / str(part_number)
+        path.write_bytes(data)
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart(
+        self,
+        bucket_name: str,
+        object_name: str,
+        upload_id: str,
+        parts: list[tuple[int, str]],
+    ) -> str:
+        directory = self.multipart_path(upload_id)
+        path = self.path(bucket_name, object_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f".{path.name}.partial")
+        with open(partial, "wb") as file:
+            for part_number, _ in sorted(parts):
+                with open(directory / str(part_number), "rb") as part:
+                    shutil.copyfileobj(part, file, CHUNK_SIZE)
+        partial.replace(path)
+        shutil.rmtree(directory)
+        return f"{bucket_name}/{object_name}"
+
+    def abort_multipart(
+        self, bucket_name: str, object_name: str, upload_id: str
+    ) -> None:
+        shutil.rmtree(self.multipart_path(upload_id), ignore_errors=True)
+
+
+class MemoryStorage(Storage):
+    """In-process backend for tests and benchmarks."""
+
+    def __init__(self, concurrency: int = storage_settings.CONCURRENCY):
+        super().__init__(concurrency)
+        self.buckets: dict[str, dict[str, bytes]] = {}
+        self.multipart: dict[str, dict[int, bytes]] = {}
+
+    def make_bucket(self, bucket_name: str) -> None:
+        self.buckets.setdefault(bucket_name, {})
+
+    def put(
+        self,
+        bucket_name: str,
+        object_name: str,
+        data: BinaryIO,
+        length: int = -1,
+    ) -> str:
+        data.seek(0)
+        self.buckets[bucket_name][object_name] = data.read()
+        return f"{bucket_name}/{object_name}"
+
+    def get(self, bucket_name: str, object_name: str) -> bytes:
+        try:
+            return self.buckets[bucket_name][object_name]
+        except KeyError:
+            raise ObjectNotFoundError(f"{bucket_name}/{object_name}")
+
+    def stat(self, bucket_name: str, object_name: str) -> int | None:
+        data = self.buckets.get(bucket_name, {}).get(object_name)
+        return None if data is None else len(data)
+
+    def presign(self, bucket_name: str, object_name: str) -> str:
+        return f"memory://{bucket_name}/{object_name}"
+
+    def delete(self, bucket_name: str, object_name: str) -> None:
+        self.buckets.get(bucket_name, {}).pop(object_name, None)
+
+    def stream(
+        self, bucket_name: str, object_name: str, chunk_size: int = CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        data = io.BytesIO(self.get(bucket_name, object_name))
+        while chunk := data.read(chunk_size):
+            yield chunk
+
+    def create_multipart(self, bucket_name: str, object_name: str) -> str:
+        upload_id = str(uuid.uuid4())
+        self.multipart[upload_id] = {}
+        return upload_id
+
+    def upload_part(
+        self,
+        bucket_name: str,
+        object_name: str,
+        upload_id: str,
+        part_number: int,
+        data: bytes,
+    ) -> str:
+        self.multipart[upload_id][part_number] = data
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart(
+        self,
+        bucket_name: str,
+        object_name: str,
+        upload_id: str,
+        parts: list[tuple[int, str]],
+    ) -> str:
+        stored = self.multipart.pop(upload_id)
+        self.buckets[bucket_name][object_name] = b"".join(
+            stored[part_number] for part_number, _ in sorted(parts)
+        )
+        return f"{bucket_name}/{object_name}"
+
+    def abort_multipart(
+        self, bucket_name: str, object_name: str, upload_id: str
+    ) -> None:
+        self.multipart.pop(upload_id, None)
+
+
+STORAGE_BACKENDS = {
+    "minio": MinioStorage,
+    "local": LocalStorage,
+    "memory": MemoryStorage,
+}
+
+
+def get_storage() -> Storage:
+    return STORAGE_BACKENDS[storage_settings.BACKEND]()
+
+
+storage = get_storage()
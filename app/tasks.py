@@ -1,122 +1,752 @@
+import hashlib
 import io
-from time import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from contextvars import copy_context
+from datetime import datetime
+from functools import partial
+from typing import Callable, Iterable, Iterator
+from uuid import uuid4
 
+from minio.error import ServerError
 from PIL import Image
+from pydantic import TypeAdapter
+from sqlalchemy import insert, or_, select
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from urllib3.exceptions import HTTPError
 
+from app.accounting import collect_stages, take_stages, timed
+from app.batching import render_batch
 from app.celery import celery_app
-from app.database import sync_sessionmaker
-from app.minio_client import minio_client, upload_to_minio
-from app.models import ImageTask, Stats
+from app.database import dialect_insert, sync_sessionmaker
+from app.derivatives import DERIVED_PREFIX, derivative_name
+from app.encoders import encode
+from app.models import ImageTask, StageTiming, Stats
+from app.rollups import roll_up
+from app.schemas import OutputSpec, Variants
+from app.settings import celery_settings, image_settings, storage_settings
+from app.storage import storage
+from app.tiling import check_memory, render_tiled
+from app.transforms import (
+    DecodePlan,
+    default_outputs,
+    sample_variants,
+    transform_key,
+)
 
+Image.MAX_IMAGE_PIXELS = image_settings.MAX_PIXELS
 
-@celery_app.task(bind=True)
+OUTPUTS_ADAPTER = TypeAdapter(list[OutputSpec])
+
+# Columns of ImageTask rows not every output sets, written in bulk
+IMAGE_TASK_DEFAULTS = {"deduplicated": False, "seed": None, "params": None}
+
+# Errors of storage and database connections that may pass on their own.
+# Tasks failing with them are retried, resuming after the outputs they
+# already recorded. Errors of the images themselves are never retried.
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    HTTPError,
+    ServerError,
+    OperationalError,
+)
+
+# Options of augmentation tasks, retried with exponential backoff and
+# jitter on transient errors
+RETRIED = {
+    "bind": True,
+    "autoretry_for": TRANSIENT_ERRORS,
+    "max_retries": celery_settings.MAX_RETRIES,
+    "retry_backoff": True,
+    "retry_backoff_max": celery_settings.RETRY_BACKOFF_MAX,
+    "retry_jitter": True,
+}
+
+# Threads of this worker process rendering and storing outputs of a task
+render_executor = ThreadPoolExecutor(
+    max_workers=image_settings.RENDER_THREADS, thread_name_prefix="render"
+)
+
+
+def transform_keys(outputs: list[OutputSpec]) -> dict:
+    """Canonical keys of the transform parameters behind each output."""
+    return {
+        "original": "original",
+        **{output.name: transform_key(output) for output in outputs},
+    }
+
+
+def find_derivatives(session, content_hash: str, transforms: dict) -> dict:
+    """
+    Looks up already rendered outputs of the same content and transforms.
+
+    Returns a dict mapping output names to their (ImageTask, Stats) rows.
+    Only rows that were actually rendered are considered, linked copies of
+    them never are. Derivatives are only found under their content
+    addressed object names, which no later upload can overwrite; the row
+    of an original is only used for its stats.
+    """
+    query = (
+        select(ImageTask, Stats)
+        .join(Stats, Stats.image_id == ImageTask.id)
+        .where(
+            ImageTask.content_hash == content_hash,
+            ImageTask.transform.in_(set(transforms.values())),
+            ImageTask.deduplicated.is_(False),
+            or_(
+                ImageTask.transform == "original",
+                ImageTask.img_link.startswith(
+                    f"{DERIVED_PREFIX}{content_hash}/"
+                ),
+            ),
+        )
+    )
+    rendered = {}
+    for image_task, stats in session.execute(query).all():
+        rendered.setdefault(image_task.transform, (image_task, stats))
+    return {
+        name: rendered[transform]
+        for name, transform in transforms.items()
+        if transform in rendered
+    }
+
+
+def run_branches(branches: Iterable[Callable], finish: Callable) -> Iterator:
+    """
+    Runs independent parts of a plan concurrently on the render pool.
+
+    Each output a part yields is passed to finish in the thread of the
+    part, so transforms, encodes and uploads of different parts overlap.
+    Pillow releases the GIL for most of this work. Results of finish are
+    yielded in the order of the parts, and parts not started yet are
+    cancelled when one of them fails.
+    """
+    futures = []
+    try:
+        for branch in branches:
+            # Parts run in a copy of the context, seeing its stage timings
+            futures.append(
+                render_executor.submit(
+                    copy_context().run,
+                    lambda branch=branch: [
+                        finish(*output) for output in branch()
+                    ],
+                )
+            )
+        for future in futures:
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def download(bucket_name: str, object_name: str) -> bytes:
+    with timed("download"):
+        return storage.get(bucket_name, object_name)
+
+
+def store_tiled(
+    data: bytes,
+    outputs: list[OutputSpec],
+    bucket_name: str,
+    object_names: dict,
+) -> Iterator[tuple]:
+    """
+    Renders outputs in strips and saves them to storage, one at a time.
+
+    Yields (output name, path, size, length, processing time).
+    """
+    for key, encoded, length, size, processing_time in render_tiled(
+        data, outputs
+    ):
+        with timed("upload", key):
+            path = storage.put(bucket_name, object_names[key], encoded, length)
+        yield key, path, size, length, processing_time
+
+
+def finished_outputs(session, task_id, filenames: dict) -> dict:
+    """
+    Outputs of an upload already recorded by an earlier attempt of a task.
+
+    Returns a dict mapping output names to their ImageTask rows.
+    """
+    query = select(ImageTask).where(
+        ImageTask.task_id == task_id,
+        ImageTask.output.in_(set(filenames.values())),
+    )
+    recorded = {row.output: row for row in session.execute(query).scalars()}
+    return {
+        name: recorded[filename]
+        for name, filename in filenames.items()
+        if filename in recorded
+    }
+
+
+class OutputRecorder:
+    """
+    Collects the rows of stored outputs and writes them in bulk.
+
+    Ids are generated here instead of by the database, so the ImageTask
+    and Stats rows of any number of outputs are written by one multi-row
+    insert each and one commit. Rows are unique per task and output, and
+    those already recorded by an earlier or concurrent attempt of the
+    same task are skipped along with their stats. With a task_id, the
+    stage timings collected for the task go into the same commit.
+    """
+
+    def __init__(self, session, task_id=None):
+        self.session = session
+        self.task_id = task_id
+        self.rows: list[tuple[dict, dict]] = []
+
+    def add(self, image_task: dict, **stats) -> None:
+        self.rows.append(({**IMAGE_TASK_DEFAULTS, **image_task}, stats))
+
+    def flush(self) -> None:
+        """Writes and commits the rows added so far."""
+        rows, self.rows = self.rows, []
+        timings = take_stages() if self.task_id is not None else []
+        if not rows and not timings:
+            return
+        try:
+            if rows:
+                with timed("db_write"):
+                    self.insert(rows)
+            if self.task_id is not None:
+                timings += take_stages()
+            if timings:
+                self.session.execute(
+                    insert(StageTiming),
+                    [
+                        {
+                            "task_id": self.task_id,
+                            "stage": stage,
+                            "output": output,
+                            "duration": duration,
+                        }
+                        for stage, output, duration in timings
+                    ],
+                )
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            raise e
+
+    def insert(self, rows: list[tuple[dict, dict]]) -> None:
+        for image_task, _ in rows:
+            image_task["id"] = uuid4()
+        statement = dialect_insert(self.session, ImageTask)
+        inserted = set(
+            self.session.scalars(
+                statement.on_conflict_do_nothing(
+                    index_elements=["task_id", "output"]
+                ).returning(ImageTask.id),
+                [image_task for image_task, _ in rows],
+            )
+        )
+        stats = [
+            {"image_id": image_task["id"], **stats}
+            for image_task, stats in rows
+            if image_task["id"] in inserted
+        ]
+        if stats:
+            self.session.execute(insert(Stats), stats)
+
+
+@contextmanager
+def recording(session, task_id=None) -> Iterator[OutputRecorder]:
+    """
+    Records the outputs added in the block when it ends.
+
+    When the block fails, the outputs stored before the failure are still
+    recorded if the database allows, so a retry resumes after them. With
+    a task_id, the stage timings of the block are recorded for the task.
+    """
+    recorder = OutputRecorder(session, task_id)
+    with collect_stages():
+        try:
+            yield recorder
+        except Exception:
+            with suppress(SQLAlchemyError):
+                recorder.flush()
+            raise
+        recorder.flush()
+
+
+def link_derivative(
+    recorder: OutputRecorder,
+    task_id,
+    user_id,
+    content_hash: str,
+    output: str,
+    derivative: tuple,
+) -> None:
+    """Records an existing object as an output of this task."""
+    image_task, stats = derivative
+    recorder.add(
+        {
+            "task_id": task_id,
+            "user_id": user_id,
+            "img_link": image_task.img_link,
+            "output": output,
+            "content_hash": content_hash,
+            "transform": image_task.transform,
+            "deduplicated": True,
+            "seed": image_task.seed,
+            "params": image_task.params,
+        },
+        width=stats.width,
+        height=stats.height,
+        size=stats.size,
+        processing_time=0,
+    )
+
+
+def resolve_outputs(
+    outputs: list[dict] | None, variants: dict | None, degrees: int
+) -> list[OutputSpec]:
+    """Explicit outputs, or the default ones when no variants are asked."""
+    if outputs is None:
+        return default_outputs(degrees) if variants is None else []
+    return OUTPUTS_ADAPTER.validate_python(outputs)
+
+
+def check_pixels(image_info: dict | None) -> None:
+    """Rejects images whose sniffed header exceeds the pixel limit."""
+    if (
+        image_info is not None
+        and image_info["width"] * image_info["height"]
+        > image_settings.MAX_PIXELS
+    ):
+        raise Image.DecompressionBombError(
+            f"Image of {image_info['width']}x{image_info['height']} pixels "
+            f"exceeds the limit of {image_settings.MAX_PIXELS} pixels"
+        )
+
+
+def augment(
+    session,
+    recorder: OutputRecorder,
+    task_id,
+    user_id: str,
+    minio_path: str,
+    filenames: dict,
+    degrees: int = 90,
+    content_hash: str | None = None,
+    image_info: dict | None = None,
+    outputs: list[dict] | None = None,
+    variants: dict | None = None,
+    data: bytes | None = None,
+    prerendered: dict | None = None,
+) -> dict:
+    """
+    Renders the outputs of one image and adds their rows to recorder.
+
+    Outputs already recorded for this task and upload by an earlier
+    attempt are neither rendered nor recorded again, so a retry resumes
+    where the failed attempt stopped. data is the already downloaded original, if any.
+    prerendered maps output names to (image, processing time) rendered
+    elsewhere, such as by the batch engine; it is used when it covers
+    every output left to render, the image is rendered here otherwise.
+    """
+    output_specs = resolve_outputs(outputs, variants, degrees)
+    check_pixels(image_info)
+
+    # Extract the bucket name and object name from minio_path
+    bucket_name, object_name = minio_path.split("/", 1)
+
+    variant_params = {}
+    if variants is not None:
+        # Crops of variants are drawn for the size of the image
+        if image_info is None:
+            data = download(bucket_name, object_name)
+            size = Image.open(io.BytesIO(data)).size
+        else:
+            size = (image_info["width"], image_info["height"])
+        for output, seed, params in sample_variants(
+            Variants.model_validate(variants), size
+        ):
+            output_specs.append(output)
+            variant_params[output.name] = (seed, params)
+    transforms = transform_keys(output_specs)
+
+    finished = finished_outputs(session, task_id, filenames)
+    result_paths = {
+        f"{key}_image_path": f"{bucket_name}/{row.img_link}"
+        for key, row in finished.items()
+        if key != "original"
+    }
+    pending = {
+        key: transform
+        for key, transform in transforms.items()
+        if key not in finished
+    }
+    if not pending:
+        return result_paths
+
+    if content_hash is None:
+        # Download the image from storage
+        if data is None:
+            data = download(bucket_name, object_name)
+        content_hash = hashlib.sha256(data).hexdigest()
+    derivatives = find_derivatives(session, content_hash, pending)
+
+    # The uploaded original always gets its own row
+    original = derivatives.pop("original", None)
+    rendered = [
+        spec
+        for spec in output_specs
+        if spec.name in pending and spec.name not in derivatives
+    ]
+    if rendered or original is None:
+        # Read the header, decoding is left to the plan
+        if data is None:
+            data = download(bucket_name, object_name)
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        original_format = image.format
+        original_size = len(data)
+    else:
+        _, original_stats = original
+        width, height = original_stats.width, original_stats.height
+        original_size = original_stats.size
+
+    if "original" in pending:
+        recorder.add(
+            {
+                "task_id": task_id,
+                "user_id": user_id,
+                "img_link": filenames["original"],
+                "output": filenames["original"],
+                "content_hash": content_hash,
+                "transform": transforms["original"],
+                "deduplicated": original is not None and not rendered,
+            },
+            width=width,
+            height=height,
+            size=original_size,
+            processing_time=0,
+        )
+
+    for key, derivative in derivatives.items():
+        link_derivative(
+            recorder,
+            task_id,
+            user_id,
+            content_hash,
+            filenames[key],
+            derivative,
+        )
+        result_paths[f"{key}_image_path"] = (
+            f"{bucket_name}/{derivative[0].img_link}"
+        )
+
+    # Rendered outputs are stored under the content addressed names of
+    # their derivatives, shared by every task of the same content
+    object_names = {
+        spec.name: derivative_name(content_hash, spec, original_format)
+        for spec in rendered
+    }
+
+    def store(key, output_image, processing_time):
+        output_format = plan.outputs[key].format or original_format
+        with timed("encode", key):
+            img_byte_arr = encode(
+                output_image, output_format, plan.outputs[key].encoding
+            )
+        with timed("upload", key):
+            path = storage.put(bucket_name, object_names[key], img_byte_arr)
+        size = img_byte_arr.getbuffer().nbytes
+        return key, path, output_image.size, size, processing_time
+
+    # Render the outputs that are not linked and save them to storage,
+    # running independent parts of the plan concurrently
+    stored = ()
+    if rendered:
+        plan = DecodePlan(rendered, image.size, original_format)
+        tiled = width * height > image_settings.TILED_PIXELS
+        if prerendered and all(key in prerendered for key in plan.outputs):
+            branches = [
+                partial(iter, [(key, *prerendered[key])])
+                for key in plan.outputs
+            ]
+            stored = run_branches(branches, store)
+        else:
+            check_memory(
+                image.size,
+                image.mode,
+                original_format,
+                rendered,
+                len(data),
+                tiled,
+            )
+            if tiled:
+                # Large images are rendered in strips, one output at a time
+                stored = store_tiled(
+                    data, rendered, bucket_name, object_names
+                )
+            else:
+                branches = plan.branches(
+                    lambda: Image.open(io.BytesIO(data))
+                )
+                stored = run_branches(branches, store)
+    for key, path, (width, height), size, processing_time in stored:
+        seed, params = variant_params.get(key, (None, None))
+        result_paths[f"{key}_image_path"] = path
+        recorder.add(
+            {
+                "task_id": task_id,
+                "user_id": user_id,
+                "img_link": object_names[key],
+                "output": filenames[key],
+                "content_hash": content_hash,
+                "transform": transforms[key],
+                "seed": seed,
+                "params": params,
+            },
+            width=width,
+            height=height,
+            size=size,
+            processing_time=processing_time,
+        )
+
+    return result_paths
+
+
+@celery_app.task(**RETRIED)
 def augmentation(
-    self, minio_path: str, filenames: dict, user_id: str, degrees: int = 90
+    self,
+    minio_path: str,
+    filenames: dict,
+    user_id: str,
+    degrees: int = 90,
+    content_hash: str | None = None,
+    image_info: dict | None = None,
+    outputs: list[dict] | None = None,
+    variants: dict | None = None,
 ) -> dict:
     """
-    Rotates, converts to grayscale, and resizes images, while measuring processing time for each operation.
-    Saves each transformed image to MinIO and records metadata in the database.
+    Renders the requested outputs of an image, while measuring processing time for each of them.
+    Saves each output image to storage and records metadata in the database.
+
+    The operations of all outputs are compiled into one plan, so intermediate
+    results are shared between outputs. Outputs needing full resolution share
+    one decode, while JPEG downscales may come from a reduced decode.
+    Without explicit outputs or variants the image is rotated, converted to
+    grayscale and scaled down by half.
+
+    Variants are random outputs drawn from a policy for dataset generation.
+    They are rendered by the same plan from the same decode, and the seed
+    and parameters of each of them are recorded with its row.
+
+    Images above IMAGE_TILED_PIXELS are rendered in strips, one output at a
+    time. Images of any size are rejected before decoding when their
+    estimated peak memory exceeds IMAGE_TASK_MEMORY.
+
+    Outputs already rendered for the same content and transform parameters
+    are linked instead of being rendered again. When every output is
+    known the original is not even downloaded.
+
+    The rows of all outputs are written in one bulk insert when the task
+    ends, and those stored before a failure are still written then. When
+    storage or the database fails, the task is retried with backoff and
+    resumes after the outputs recorded by earlier attempts, never
+    rendering or recording them twice.
 
     Args:
-        minio_path (str): The path to the MinIO storage where images are stored.
-        filenames (dict): A dictionary containing image filenames and their corresponding details.
+        minio_path (str): The "{bucket}/{object}" storage path of the original image.
+        filenames (dict): Object name of the original and the names its outputs are recorded under, by output name.
         user_id (str): The ID of the user who initiated the task.
-        degrees (int): The degree by which to rotate the images. Default is 90 degrees.
+        degrees (int): The degree by which to rotate the default output. Default is 90 degrees.
+        content_hash (str): SHA-256 of the original, computed here when not given.
+        image_info (dict): Format, mode, width, height and frames sniffed from the header at upload.
+        outputs (list): OutputSpec dicts with the name, operations and format of each output.
+        variants (dict): Variants dict with the count, seed and policy of random variants.
 
     Returns:
-        dict: A dictionary containing the paths of the transformed images saved in MinIO,
-              with keys formatted as "{operation}_image_path".
+        dict: A dictionary containing the paths of the output images saved in storage,
+              with keys formatted as "{output}_image_path".
     """
 
-    task_id = self.request.id
-
+    check_pixels(image_info)
     with sync_sessionmaker() as session:
         try:
-            # Extract the bucket name and object name from minio_path
-            bucket_name, object_name = minio_path.split("/", 1)
+            with recording(session, self.request.id) as recorder:
+                result_paths = augment(
+                    session,
+                    recorder,
+                    self.request.id,
+                    user_id,
+                    minio_path,
+                    filenames,
+                    degrees=degrees,
+                    content_hash=content_hash,
+                    image_info=image_info,
+                    outputs=outputs,
+                    variants=variants,
+                )
+            return result_paths
+        except Exception as e:
+            session.rollback()
+            raise e
 
-            # Download the image from MinIO
-            response = minio_client.get_object(
-                bucket_name=bucket_name, object_name=object_name
-            )
-            file_data = io.BytesIO(response.read())
-            response.close()
-            response.release_conn()
 
-            # Open the image using PIL
-            image = Image.open(file_data)
+@celery_app.task(**RETRIED)
+def augmentation_batch(self, uploads: list[dict], user_id: str) -> list[dict]:
+    """
+    Augments several images in one task with the vectorized batch engine.
 
-            width, height = image.size
-            original_format = image.format
+    Images of the same mode and size with the same outputs are rendered
+    together as stacked arrays; the others fall back to the per-image
+    path. The outputs of all images are recorded under the id of this
+    task in one bulk write, and a retry resumes after the outputs
+    recorded by earlier attempts.
 
-            # Add original image stats to database session
-            new_image = ImageTask(
-                task_id=task_id,
-                user_id=user_id,
-                img_link=filenames["original"],
-            )
-            session.add(new_image)
-            session.flush()
-            session.add(
-                Stats(
-                    image_id=new_image.id,
-                    width=width,
-                    height=height,
-                    size=file_data.tell(),
-                    processing_time=0,
-                )
-            )
+    Args:
+        uploads (list): Dicts of augmentation arguments, one per image.
+        user_id (str): The ID of the user who initiated the task.
 
-            processing_times = {}
-
-            # Perform image transformations
-            start_time = time()
-            rotated_image = image.rotate(degrees, expand=True)
-            processing_times["rotated"] = time() - start_time
-
-            start_time = time()
-            gray_image = image.convert("L")
-            processing_times["gray"] = time() - start_time
-
-            start_time = time()
-            gray_scaled = image.resize((image.width // 2, image.height // 2))
-            processing_times["scaled"] = time() - start_time
-
-            transformations = {
-                "rotated": rotated_image,
-                "gray": gray_image,
-                "scaled": gray_scaled,
-            }
-
-            # Save each transformed image to MinIO and add to the database session
-            result_paths = {}
-            for key, transformed_image in transformations.items():
-                img_byte_arr = io.BytesIO()
-                transformed_image.save(img_byte_arr, format=original_format)
-                width, height = transformed_image.size
-                img_byte_arr.seek(0)
-                result_paths[f"{key}_image_path"] = upload_to_minio(
-                    img_byte_arr, filenames[key], bucket_name=bucket_name
-                )
-                new_image = ImageTask(
-                    task_id=task_id, user_id=user_id, img_link=filenames[key]
-                )
-                session.add(new_image)
-                session.flush()
-                session.add(
-                    Stats(
-                        image_id=new_image.id,
-                        width=width,
-                        height=height,
-                        size=img_byte_arr.tell(),
-                        processing_time=processing_times[key],
+    Returns:
+        list: The result paths of each image, as returned by augmentation.
+    """
+    for upload in uploads:
+        check_pixels(upload.get("image_info"))
+    with sync_sessionmaker() as session:
+        try:
+            with recording(session, self.request.id) as recorder:
+                # Outputs recorded by an earlier attempt are not rendered
+                # again, and images without others are not downloaded
+                pending = []
+                for upload in uploads:
+                    finished = finished_outputs(
+                        session, self.request.id, upload["filenames"]
                     )
-                )
+                    pending.append(
+                        [
+                            spec
+                            for spec in resolve_outputs(
+                                upload.get("outputs"),
+                                upload.get("variants"),
+                                upload.get("degrees", 90),
+                            )
+                            if spec.name not in finished
+                        ]
+                    )
+                originals = [
+                    download(*upload["minio_path"].split("/", 1))
+                    if outputs
+                    else None
+                    for upload, outputs in zip(uploads, pending)
+                ]
+                batched = [
+                    index for index, outputs in enumerate(pending) if outputs
+                ]
+                prerendered = [{} for _ in uploads]
+                with timed("batch_render"):
+                    rendered = render_batch(
+                        [
+                            lambda data=originals[index]: Image.open(
+                                io.BytesIO(data)
+                            )
+                            for index in batched
+                        ],
+                        [pending[index] for index in batched],
+                    )
+                for index, outputs in zip(batched, rendered):
+                    prerendered[index] = outputs
+                results = [
+                    augment(
+                        session,
+                        recorder,
+                        self.request.id,
+                        user_id,
+                        data=data,
+                        prerendered=rendered,
+                        **upload,
+                    )
+                    for upload, data, rendered in zip(
+                        uploads, originals, prerendered
+                    )
+                ]
+            return results
+        except Exception as e:
+            session.rollback()
+            raise e
 
-            # Commit all changes to the database
-            session.commit()
 
-            return result_paths
+@celery_app.task
+def render_derivative(
+    original: dict, output: dict, object_name: str
+) -> None:
+    """
+    Renders one output of a stored original on demand.
+
+    The output is saved under object_name and recorded as an output of
+    the task of the original, so later requests and augmentation tasks
+    find it like any other derivative. original holds the task_id,
+    user_id, img_link and content_hash of the original row, output an
+    OutputSpec dict.
+
+    Outputs already saved under object_name, by a render of another API
+    process, are not rendered again. Originals above IMAGE_TILED_PIXELS
+    are rendered in strips, and originals are rejected before decoding
+    when their estimated peak memory exceeds IMAGE_TASK_MEMORY, like
+    augmentations.
+    """
+    output = OutputSpec.model_validate(output)
+    bucket_name = storage_settings.BUCKET
+    if storage.stat(bucket_name, object_name) is not None:
+        return
+    data = storage.get(bucket_name, original["img_link"])
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    tiled = width * height > image_settings.TILED_PIXELS
+    check_memory(
+        image.size, image.mode, image.format, [output], len(data), tiled
+    )
+    if tiled:
+        ((_, _, (width, height), size, processing_time),) = store_tiled(
+            data, [output], bucket_name, {output.name: object_name}
+        )
+    else:
+        plan = DecodePlan([output], image.size, image.format)
+        ((_, output_image, processing_time),) = plan.execute(
+            lambda: Image.open(io.BytesIO(data))
+        )
+        img_byte_arr = encode(
+            output_image, output.format or image.format, output.encoding
+        )
+        storage.put(bucket_name, object_name, img_byte_arr)
+        width, height = output_image.size
+        size = img_byte_arr.getbuffer().nbytes
+
+    with sync_sessionmaker() as session:
+        recorder = OutputRecorder(session)
+        recorder.add(
+            {
+                "task_id": original["task_id"],
+                "user_id": original["user_id"],
+                "img_link": object_name,
+                "output": object_name,
+                "content_hash": original["content_hash"],
+                "transform": transform_key(output),
+            },
+            width=width,
+            height=height,
+            size=size,
+            processing_time=processing_time,
+        )
+        recorder.flush()
+
+
+@celery_app.task
+def rollup() -> None:
+    """Brings the dashboard rollups up to date, run by celery beat."""
+    with sync_sessionmaker() as session:
+        try:
+            while roll_up(session, datetime.utcnow()):
+                pass
         except Exception as e:
             session.rollback()
             raise e
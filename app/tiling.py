@@ -0,0 +1,486 @@
+import io
+import struct
+import tempfile
+import zlib
+from math import ceil, floor
+from time import perf_counter
+from typing import BinaryIO, Iterator
+
+import numpy as np
+from PIL import Image
+
+from app.accounting import record_stage
+from app.encoders import encode, encoder_settings
+from app.schemas import (
+    ColorJitter,
+    Crop,
+    Flip,
+    Grayscale,
+    Operation,
+    OutputSpec,
+    Resize,
+    Rotate,
+)
+from app.settings import image_settings
+from app.transforms import (
+    apply,
+    crop_box,
+    draft_reduction,
+    normalize,
+    operation_size,
+    reduce_factor,
+    resized_size,
+)
+
+# Bytes Pillow stores a pixel of each mode in, four for all other modes
+BYTES_PER_PIXEL = {"1": 1, "L": 1, "P": 1, "I;16": 2}
+
+# Pixels of the source a strip is rendered from
+STRIP_PIXELS = 1 << 20
+
+# Encoded outputs larger than this are spooled to a temporary file
+SPOOL_BYTES = 16 * 1024 * 1024
+
+PNG_COLOR_TYPES = {"L": 0, "RGB": 2, "LA": 4, "RGBA": 6}
+PNG_UP_FILTER = 2
+
+# Operations whose result at a position depends only on the pixel at the
+# matching position of their input, so they can run on any strip. Color
+# jitter is one only without contrast, which blends pixels with the mean
+# of the whole image.
+STRIP_OPERATIONS = (Rotate, Flip, Grayscale, ColorJitter)
+
+
+def pixel_bytes(mode: str) -> int:
+    return BYTES_PER_PIXEL.get(mode, 4)
+
+
+class PNGWriter:
+    """
+    Encodes a PNG strip by strip, without holding the whole image.
+
+    Rows are filtered with the Up filter, computed for a whole strip at
+    once, and compressed by one zlib stream across strips.
+    """
+
+    def __init__(
+        self, file: BinaryIO, size: tuple[int, int], mode: str, level: int
+    ):
+        self.file = file
+        self.compressor = zlib.compressobj(level)
+        self.previous = None
+        width, height = size
+        file.write(b"\x89PNG\r\n\x1a\n")
+        self.chunk(
+            b"IHDR",
+            struct.pack(
+                ">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[mode], 0, 0, 0
+            ),
+        )
+
+    def chunk(self, chunk_type: bytes, data: bytes) -> None:
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(
+            struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)))
+        )
+
+    def write(self, strip: Image.Image) -> None:
+        rows = np.asarray(strip).reshape(strip.height, -1)
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), np.uint8)
+        filtered[:, 0] = PNG_UP_FILTER
+        filtered[0, 1:] = rows[0]
+        if self.previous is not None:
+            filtered[0, 1:] -= self.previous
+        np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+        self.previous = rows[-1].copy()
+        data = self.compressor.compress(filtered)
+        if data:
+            self.chunk(b"IDAT", data)
+
+    def close(self) -> None:
+        self.chunk(b"IDAT", self.compressor.flush())
+        self.chunk(b"IEND", b"")
+
+
+def pin_resize(operations: list[Operation], size: tuple[int, int]) -> None:
+    """
+    Pins a leading scale to the size it has on the full image.
+
+    A scale is relative to the decoded size, which is smaller than the
+    full image after a reduced JPEG decode.
+    """
+    if operations and isinstance(operations[0], Resize):
+        width, height = resized_size(operations[0], size)
+        operations[0] = Resize(width=width, height=height)
+
+
+def strip_operation(operation: Operation) -> bool:
+    match operation:
+        case Rotate(degrees=degrees):
+            return degrees % 90 == 0
+        case ColorJitter(contrast=contrast):
+            return contrast == 1
+    return isinstance(operation, STRIP_OPERATIONS)
+
+
+def split_operations(
+    operations: list[Operation],
+) -> tuple[Crop | None, Resize | None, list[Operation]] | None:
+    """
+    Splits operations into a leading crop, a leading resize and the rest.
+
+    Returns None if the rest is not made of strip operations only, in
+    which case the output cannot be rendered in strips.
+    """
+    operations = list(operations)
+    crop = resize = None
+    if operations and isinstance(operations[0], Crop):
+        crop = operations.pop(0)
+    if operations and isinstance(operations[0], Resize):
+        resize = operations.pop(0)
+    if not all(strip_operation(operation) for operation in operations):
+        return None
+    return crop, resize, operations
+
+
+def input_box(
+    operation: Operation, box: tuple[int, int, int, int], size: tuple
+) -> tuple[int, int, int, int]:
+    """
+    Box of the input of a strip operation the given box of its result
+    is computed from. size is the size of the input.
+    """
+    width, height = size
+    x0, y0, x1, y1 = box
+    match operation:
+        case Rotate(degrees=degrees) if degrees % 360 == 90:
+            return width - y1, x0, width - y0, x1
+        case Rotate(degrees=degrees) if degrees % 360 == 180:
+            return width - x1, height - y1, width - x0, height - y0
+        case Rotate(degrees=degrees) if degrees % 360 == 270:
+            return y0, height - x1, y1, height - x0
+        case Flip(direction="horizontal"):
+            return width - x1, y0, width - x0, y1
+        case Flip(direction="vertical"):
+            return x0, height - y1, x1, height - y0
+    return box
+
+
+class StripRenderer:
+    """
+    Renders an output of a decoded image strip of rows by strip of rows.
+
+    Each strip is computed from the smallest box of the source it depends
+    on. A resize reads a margin around its box wide enough for the support
+    of the filter, so strips match the whole-image result. A downscale by
+    an integer factor reads whole blocks of pixels instead, which it
+    averages exactly like the whole-image path.
+    """
+
+    def __init__(
+        self,
+        size: tuple[int, int],
+        mode: str,
+        crop: Crop | None,
+        resize: Resize | None,
+        operations: list[Operation],
+    ):
+        self.operations = operations
+        self.offset = (0, 0)
+        self.cropped = size
+        if crop is not None:
+            left, top, right, bottom = crop_box(crop, size)
+            self.offset = (left, top)
+            self.cropped = (right - left, bottom - top)
+        self.resized = self.cropped
+        self.factor = None
+        if resize is not None:
+            self.resized = resized_size(resize, self.cropped)
+            self.factor = reduce_factor(resize, self.cropped, mode)
+        self.sizes = [self.resized]
+        for operation in operations:
+            self.sizes.append(operation_size(operation, self.sizes[-1]))
+        self.size = self.sizes[-1]
+
+    def strips(self, image: Image.Image) -> Iterator[Image.Image]:
+        width, height = self.size
+        # A downscaled strip reads a larger box of the source
+        ratio = max(
+            1.0,
+            self.cropped[0]
+            * self.cropped[1]
+            / (self.resized[0] * self.resized[1]),
+        )
+        rows = max(1, int(STRIP_PIXELS / ratio) // width)
+        for top in range(0, height, rows):
+            yield self.render(image, (0, top, width, min(top + rows, height)))
+
+    def render(
+        self, image: Image.Image, box: tuple[int, int, int, int]
+    ) -> Image.Image:
+        for operation, size in zip(
+            reversed(self.operations), reversed(self.sizes[:-1])
+        ):
+            box = input_box(operation, box, size)
+        strip = self.read(image, box)
+        for operation in self.operations:
+            strip = apply(operation, strip)
+        return strip
+
+    def read(
+        self, image: Image.Image, box: tuple[int, int, int, int]
+    ) -> Image.Image:
+        """A box of the cropped and resized image, read from the source."""
+        left, top = self.offset
+        x0, y0, x1, y1 = box
+        if self.resized == self.cropped:
+            return image.crop((x0 + left, y0 + top, x1 + left, y1 + top))
+        if self.factor is not None:
+            factor = self.factor
+            return image.crop(
+                (
+                    x0 * factor + left,
+                    y0 * factor + top,
+                    x1 * factor + left,
+                    y1 * factor + top,
+                )
+            ).reduce(factor)
+        scale_x = self.cropped[0] / self.resized[0]
+        scale_y = self.cropped[1] / self.resized[1]
+        margin = ceil(2 * max(scale_x, scale_y)) + 1
+        fx0, fy0 = x0 * scale_x, y0 * scale_y
+        fx1, fy1 = x1 * scale_x, y1 * scale_y
+        sx0 = max(0, floor(fx0) - margin)
+        sy0 = max(0, floor(fy0) - margin)
+        sx1 = min(self.cropped[0], ceil(fx1) + margin)
+        sy1 = min(self.cropped[1], ceil(fy1) + margin)
+        region = image.crop((sx0 + left, sy0 + top, sx1 + left, sy1 + top))
+        return region.resize(
+            (x1 - x0, y1 - y0),
+            box=(fx0 - sx0, fy0 - sy0, fx1 - sx0, fy1 - sy0),
+        )
+
+
+def tiled_reduction(
+    operations: list[list[Operation]],
+    size: tuple[int, int],
+    image_format: str | None,
+) -> int:
+    """JPEG decode reduction shared by every output of a tiled render."""
+    if image_format != "JPEG":
+        return 1
+    return min(
+        (draft_reduction(output, size) for output in operations), default=1
+    )
+
+
+def tiled_operations(
+    outputs: list[OutputSpec], size: tuple[int, int], image_format: str | None
+) -> tuple[list[list[Operation]], int]:
+    """
+    Normalized operations of every output and the decode reduction they
+    share. Leading scales are pinned when the decode is reduced.
+    """
+    operations = [normalize(output.operations) for output in outputs]
+    reduction = tiled_reduction(operations, size, image_format)
+    if reduction > 1:
+        for output_operations in operations:
+            pin_resize(output_operations, size)
+    return operations, reduction
+
+
+def whole_memory(
+    operations: list[Operation], size: tuple[int, int], mode: str
+) -> int:
+    """
+    Peak bytes of applying operations one at a time to a whole image of
+    the given size, besides the image itself.
+
+    Each operation holds its input and its result, sized from the
+    operation chain: the bounding box of a rotation, the target of a
+    resize or the box of a crop.
+    """
+    held = 0
+    pixels = 0
+    for operation in operations:
+        result = operation_size(operation, size)
+        held = max(held, pixels + result[0] * result[1])
+        size = result
+        pixels = size[0] * size[1]
+    return held * pixel_bytes(mode)
+
+
+def peak_memory(
+    size: tuple[int, int],
+    mode: str,
+    image_format: str | None,
+    outputs: list[OutputSpec],
+    tiled: bool = True,
+) -> int:
+    """
+    Estimated peak bytes of rendering outputs, in tiled mode or not.
+
+    The decoded source is held throughout. In tiled mode outputs are
+    rendered one at a time: a streamed PNG needs a few strips, any other
+    output rendered in strips needs the whole output image, and outputs
+    that cannot be rendered in strips need every intermediate image on
+    their way. Otherwise outputs are rendered on whole images by up to
+    RENDER_THREADS parts at once, estimated from a full decode.
+    """
+    if not tiled:
+        source = size[0] * size[1] * pixel_bytes(mode)
+        needed = sorted(
+            (
+                whole_memory(normalize(output.operations), size, mode)
+                for output in outputs
+            ),
+            reverse=True,
+        )
+        return source + sum(needed[: image_settings.RENDER_THREADS])
+
+    operations, reduction = tiled_operations(outputs, size, image_format)
+    decoded = (-(-size[0] // reduction), -(-size[1] // reduction))
+    source = decoded[0] * decoded[1] * pixel_bytes(mode)
+    largest = 0
+    for output, output_operations in zip(outputs, operations):
+        parts = split_operations(output_operations)
+        if parts is None:
+            largest = max(
+                largest, whole_memory(output_operations, decoded, mode)
+            )
+            continue
+        width, height = StripRenderer(decoded, mode, *parts).size
+        needed = 3 * 4 * min(STRIP_PIXELS, width * height)
+        if (output.format or image_format) != "PNG":
+            needed += width * height * 4
+        largest = max(largest, needed)
+    return source + largest
+
+
+def check_memory(
+    size: tuple[int, int],
+    mode: str,
+    image_format: str | None,
+    outputs: list[OutputSpec],
+    data_size: int,
+    tiled: bool = True,
+) -> None:
+    """
+    Rejects renders estimated above the per-task memory ceiling.
+
+    Runs on the header alone, so a rejected image is never decoded.
+    """
+    needed = data_size + peak_memory(
+        size, mode, image_format, outputs, tiled
+    )
+    if needed > image_settings.TASK_MEMORY:
+        raise MemoryError(
+            f"Rendering an image of {size[0]}x{size[1]} pixels needs about "
+            f"{needed} bytes, above the limit of "
+            f"{image_settings.TASK_MEMORY} bytes per task"
+        )
+
+
+def png_strip(strip: Image.Image) -> Image.Image:
+    if strip.mode in PNG_COLOR_TYPES:
+        return strip
+    return strip.convert("RGBA" if strip.has_transparency_data else "RGB")
+
+
+def render_output(
+    image: Image.Image,
+    output: OutputSpec,
+    operations: list[Operation],
+    output_format: str,
+) -> tuple[BinaryIO, int, tuple[int, int], float]:
+    """
+    Renders and encodes one output of a decoded image.
+
+    Returns the encoded output, its length, its size and the time spent
+    rendering it, encoding excluded.
+    """
+    parts = split_operations(operations)
+    if parts is None:
+        start_time = perf_counter()
+        output_image = image
+        for operation in operations:
+            output_image = apply(operation, output_image)
+        elapsed = perf_counter() - start_time
+        encoded = encode(output_image, output_format, output.encoding)
+        return encoded, encoded.getbuffer().nbytes, output_image.size, elapsed
+
+    renderer = StripRenderer(image.size, image.mode, *parts)
+    strips = renderer.strips(image)
+    elapsed = 0.0
+    if output_format == "PNG":
+        settings = {}
+        if output.encoding is not None:
+            settings = encoder_settings(output.encoding)
+        level = settings.get("effort", 6)
+        encoded = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        writer = None
+        while True:
+            start_time = perf_counter()
+            strip = next(strips, None)
+            elapsed += perf_counter() - start_time
+            if strip is None:
+                break
+            strip = png_strip(strip)
+            if writer is None:
+                writer = PNGWriter(encoded, renderer.size, strip.mode, level)
+            writer.write(strip)
+        writer.close()
+        length = encoded.tell()
+        encoded.seek(0)
+        return encoded, length, renderer.size, elapsed
+
+    start_time = perf_counter()
+    output_image = None
+    top = 0
+    for strip in strips:
+        if output_image is None:
+            output_image = Image.new(strip.mode, renderer.size)
+        output_image.paste(strip, (0, top))
+        top += strip.height
+    elapsed = perf_counter() - start_time
+    encoded = encode(output_image, output_format, output.encoding)
+    return encoded, encoded.getbuffer().nbytes, renderer.size, elapsed
+
+
+def render_tiled(
+    data: bytes, outputs: list[OutputSpec]
+) -> Iterator[tuple[str, BinaryIO, int, tuple[int, int], float]]:
+    """
+    Renders the outputs of a large image one at a time, in strips.
+
+    The image is decoded once, reduced when every output is a JPEG
+    downscale. Outputs made of a crop, a resize and rotations by right
+    angles, flips, grayscale or color jitter without contrast are
+    rendered in strips of rows: PNG outputs are encoded strip by strip
+    into a temporary file, other formats are assembled before encoding, as
+    their encoders need the whole image. Other outputs are rendered on the
+    whole image.
+    Intermediate images of an output are released before the next one,
+    so at most one output is held at a time.
+
+    Yields (output name, encoded output, length, size, processing time).
+    The processing time covers the decode and the rendering of the output.
+    """
+    image = Image.open(io.BytesIO(data))
+    image_format, size = image.format, image.size
+    start_time = perf_counter()
+    operations, reduction = tiled_operations(outputs, size, image_format)
+    if reduction > 1:
+        image.draft(image.mode, (size[0] // reduction, size[1] // reduction))
+    image.load()
+    decode_time = perf_counter() - start_time
+    record_stage("decode", decode_time)
+    for output, output_operations in zip(outputs, operations):
+        encoded, length, rendered_size, elapsed = render_output(
+            image, output, output_operations, output.format or image_format
+        )
+        # Strips interleave transforms and encoding
+        record_stage("render", elapsed, output.name)
+        yield output.name, encoded, length, rendered_size, decode_time + elapsed
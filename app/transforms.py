@@ -0,0 +1,643 @@
+import math
+from functools import cache, partial
+from statistics import NormalDist
+from time import perf_counter
+from typing import Callable, Iterator
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter
+
+from app.accounting import record_stage
+from app.encoders import encoding_key
+from app.schemas import (
+    Blur,
+    ColorJitter,
+    Crop,
+    Flip,
+    Grayscale,
+    Noise,
+    Operation,
+    OutputSpec,
+    Resize,
+    Rotate,
+    Variants,
+)
+
+FORMAT_EXTENSIONS = {
+    "JPEG": "jpg",
+    "PNG": "png",
+    "WEBP": "webp",
+    "AVIF": "avif",
+}
+
+# Operations computing each pixel from the same pixel of the input. They
+# commute with crops, which are moved in front of them so they run on
+# fewer pixels. Contrast jitter is not one of them, as it blends pixels
+# with the mean of the whole image.
+POINTWISE = (Grayscale, ColorJitter)
+
+# Reductions a JPEG can be decoded at, largest first, with the cost of such
+# a decode relative to a full decode. Entropy decoding is done in full at
+# every scale, which is why the cost does not fall with the pixel count.
+DRAFT_REDUCTIONS = (8, 4, 2)
+DECODE_COST = {1: 1.0, 2: 0.6, 4: 0.45, 8: 0.35}
+
+# Cost of resampling a pixel relative to decoding one
+RESIZE_COST = 2.2
+
+# Rows of pixels noise is generated for at once, bounding the memory used
+# by noise buffers on large images
+NOISE_ROWS = 256
+
+CROP_SIDES = ("left", "top", "right", "bottom")
+
+TRANSPOSITIONS = {
+    90: Image.Transpose.ROTATE_90,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_270,
+}
+
+
+def default_outputs(degrees: int = 90) -> list[OutputSpec]:
+    """The rotated, gray and scaled outputs produced when none are given."""
+    return [
+        OutputSpec(name="rotated", operations=[Rotate(degrees=degrees)]),
+        OutputSpec(name="gray", operations=[Grayscale()]),
+        OutputSpec(name="scaled", operations=[Resize(scale=0.5)]),
+    ]
+
+
+def number(value: float) -> str:
+    return f"{value:g}"
+
+
+def operation_key(operation: Operation) -> str:
+    """Canonical key of an operation and its parameters."""
+    match operation:
+        case Rotate(degrees=degrees):
+            return f"rotate:{number(degrees)}"
+        case Resize(scale=scale) if scale is not None:
+            return f"scale:{number(scale)}"
+        case Resize(width=width, height=height):
+            return f"resize:{width or ''}x{height or ''}"
+        case Crop(left=left, top=top, right=right, bottom=bottom):
+            return f"crop:{left},{top},{right},{bottom}"
+        case Flip(direction=direction):
+            return f"flip:{direction}"
+        case Grayscale():
+            return "grayscale"
+        case Blur(radius=radius):
+            return f"blur:{number(radius)}"
+        case ColorJitter(
+            brightness=brightness, contrast=contrast, saturation=saturation
+        ):
+            return (
+                f"jitter:{number(brightness)},{number(contrast)},"
+                f"{number(saturation)}"
+            )
+        case Noise(sigma=sigma, seed=seed):
+            return f"noise:{number(sigma)},{seed}"
+
+
+def parse_operation(key: str) -> Operation:
+    """
+    Operation of a canonical operation key, the inverse of operation_key.
+
+    Raises ValueError, or a ValidationError, on keys that are malformed or
+    out of range.
+    """
+    name, _, args = key.partition(":")
+    values = args.split(",")
+    match name, len(values):
+        case "rotate", 1:
+            return Rotate(degrees=float(args))
+        case "scale", 1:
+            return Resize(scale=float(args))
+        case "resize", 1 if "x" in args:
+            width, height = args.split("x", 1)
+            return Resize(width=width or None, height=height or None)
+        case "crop", 4:
+            return Crop(**dict(zip(CROP_SIDES, values)))
+        case "flip", 1:
+            return Flip(direction=args)
+        case "grayscale", 1 if not args:
+            return Grayscale()
+        case "blur", 1:
+            return Blur(radius=float(args))
+        case "jitter", 3:
+            return ColorJitter(
+                **dict(zip(("brightness", "contrast", "saturation"), values))
+            )
+        case "noise", 2:
+            return Noise(sigma=values[0], seed=values[1])
+    raise ValueError(f"Unknown operation: {key}")
+
+
+def transform_key(output: OutputSpec) -> str:
+    """
+    Canonical key of everything that determines the content of an output.
+
+    Outputs with equal keys render to the same image, so the key is used to
+    share intermediate results and to deduplicate derivatives.
+    """
+    key = "|".join(operation_key(op) for op in normalize(output.operations))
+    key = key or "identity"
+    if output.format is not None:
+        key = f"{key}|format:{output.format}"
+    if output.encoding is not None:
+        key = f"{key}|encoding:{encoding_key(output.encoding)}"
+    return key
+
+
+def pointwise(operation: Operation) -> bool:
+    if isinstance(operation, ColorJitter):
+        return operation.contrast == 1
+    return isinstance(operation, POINTWISE)
+
+
+def right_angle(operation: Rotate) -> bool:
+    return operation.degrees % 90 == 0
+
+
+def fuse(first: Operation, second: Operation) -> list[Operation] | None:
+    """
+    Replaces two adjacent operations by a cheaper equivalent sequence.
+
+    Returns None when the pair cannot be simplified. Only rules that keep
+    every pixel of the result apply, as outputs with the same normalized
+    operations share renders and derivatives. Rotations by other angles
+    pad the image and consecutive resizes resample it twice, so neither
+    is fused, and no operation is moved past a resize, whose resampling
+    neither clipping nor alpha commute with.
+    """
+    match first, second:
+        case Rotate(), Rotate() if right_angle(first) and right_angle(second):
+            degrees = (first.degrees + second.degrees) % 360
+            return [Rotate(degrees=degrees)] if degrees else []
+        case Flip(), Flip() if first.direction == second.direction:
+            return []
+        case Grayscale(), Grayscale():
+            return [first]
+        case _, Crop() if pointwise(first):
+            return [second, first]
+    return None
+
+
+def normalize(operations: list[Operation]) -> list[Operation]:
+    """Fuses and reorders operations until no rule applies any more."""
+    operations = [
+        operation
+        for operation in operations
+        if not (isinstance(operation, Rotate) and operation.degrees % 360 == 0)
+    ]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(operations) - 1):
+            fused = fuse(operations[i], operations[i + 1])
+            if fused is not None and fused != operations[i : i + 2]:
+                operations[i : i + 2] = fused
+                changed = True
+                break
+    return operations
+
+
+@cache
+def normal_quantiles() -> np.ndarray:
+    """Standard normal quantiles at the centers of 65536 equal bins."""
+    inv_cdf = NormalDist().inv_cdf
+    return np.array(
+        [inv_cdf((i + 0.5) / 65536) for i in range(65536)], dtype=np.float32
+    )
+
+
+def add_noise(image: Image.Image, sigma: float, seed: int) -> Image.Image:
+    """
+    Adds Gaussian noise, reproducible from the seed.
+
+    Pixels are integers, so the noise is rounded to integers before it is
+    added, which makes it a lookup of uniform 16-bit samples in a table of
+    quantiles. That is several times faster than sampling normal floats.
+    """
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    table = np.rint(normal_quantiles() * sigma).astype(np.int16)
+    pixels = np.array(image)
+    rng = np.random.default_rng(seed)
+    for start in range(0, pixels.shape[0], NOISE_ROWS):
+        rows = pixels[start : start + NOISE_ROWS]
+        noise = table[rng.integers(0, 65536, rows.shape, dtype=np.uint16)]
+        noise += rows
+        np.clip(noise, 0, 255, out=noise)
+        rows[...] = noise
+    return Image.fromarray(pixels, mode=image.mode)
+
+
+def variant_name(index: int) -> str:
+    return f"variant_{index:03d}"
+
+
+def sample_variants(
+    variants: Variants, size: tuple[int, int]
+) -> list[tuple[OutputSpec, int, dict]]:
+    """
+    Draws the operations of each random variant of an image.
+
+    Every variant gets its own seed drawn from the seed of the request, and
+    all of its parameters are drawn from that seed alone, so any variant
+    can be reproduced on its own. Returns (output, seed, parameters) per
+    variant.
+    """
+    policy = variants.policy
+    width, height = size
+    seeds = np.random.default_rng(variants.seed).integers(
+        0, 2**63, variants.count
+    )
+    results = []
+    for index, seed in enumerate(seeds.tolist()):
+        rng = np.random.default_rng(seed)
+        scale = rng.uniform(policy.crop, 1)
+        crop_width = max(1, round(width * scale))
+        crop_height = max(1, round(height * scale))
+        left = int(rng.integers(0, width - crop_width + 1))
+        top = int(rng.integers(0, height - crop_height + 1))
+        params = {
+            "crop": [left, top, left + crop_width, top + crop_height],
+            "flip": bool(rng.random() < policy.flip),
+            "rotation": round(
+                rng.uniform(-policy.rotation, policy.rotation), 2
+            ),
+            "brightness": round(
+                rng.uniform(1 - policy.brightness, 1 + policy.brightness), 3
+            ),
+            "contrast": round(
+                rng.uniform(1 - policy.contrast, 1 + policy.contrast), 3
+            ),
+            "noise": round(rng.uniform(0, policy.noise), 2),
+        }
+        operations = []
+        if (crop_width, crop_height) != size:
+            operations.append(Crop(**dict(zip(CROP_SIDES, params["crop"]))))
+        if params["flip"]:
+            operations.append(Flip(direction="horizontal"))
+        if params["rotation"]:
+            operations.append(Rotate(degrees=params["rotation"]))
+        if params["brightness"] != 1 or params["contrast"] != 1:
+            operations.append(
+                ColorJitter(
+                    brightness=params["brightness"],
+                    contrast=params["contrast"],
+                )
+            )
+        if params["noise"]:
+            operations.append(Noise(sigma=params["noise"], seed=seed))
+        output = OutputSpec.model_construct(
+            name=variant_name(index),
+            operations=operations,
+            format=policy.format,
+            encoding=policy.encoding,
+        )
+        results.append((output, seed, params))
+    return results
+
+
+def resized_size(resize: Resize, size: tuple[int, int]) -> tuple[int, int]:
+    """Size of an image of the given size after a resize."""
+    width, height = size
+    if resize.scale is not None:
+        return (
+            max(1, int(width * resize.scale)),
+            max(1, int(height * resize.scale)),
+        )
+    return (
+        resize.width or max(1, round(width * resize.height / height)),
+        resize.height or max(1, round(height * resize.width / width)),
+    )
+
+
+def downscale_factor(resize: Resize) -> int | None:
+    """Integer factor of a downscale, or None if it is not one."""
+    if resize.scale is None:
+        return None
+    factor = round(1 / resize.scale)
+    return factor if factor > 1 and factor * resize.scale == 1 else None
+
+
+def reduce_factor(
+    resize: Resize, size: tuple[int, int], mode: str
+) -> int | None:
+    """
+    Factor a resize of an image of the given size and mode averages
+    blocks of pixels by, or None if it resamples the image.
+
+    Downscales by integer factors average blocks like Image.reduce, the
+    same as the batch engine, so a transform key renders the same pixels
+    on every path. Palette and bilevel images are resampled instead, as
+    averaging their pixels is meaningless.
+    """
+    factor = downscale_factor(resize)
+    if factor is None or mode in ("1", "P") or min(size) < factor:
+        return None
+    return factor
+
+
+def crop_box(crop: Crop, size: tuple[int, int]) -> tuple[int, int, int, int]:
+    """Box of a crop, clamped to an image of the given size."""
+    width, height = size
+    return (
+        min(crop.left, width - 1),
+        min(crop.top, height - 1),
+        min(crop.right, width),
+        min(crop.bottom, height),
+    )
+
+
+def rotated_size(degrees: float, size: tuple[int, int]) -> tuple[int, int]:
+    """Size of the bounding box Image.rotate expands an image to."""
+    width, height = size
+    angle = -math.radians(degrees % 360)
+    cos, sin = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    corners = [
+        (x - width / 2, y - height / 2)
+        for x, y in ((0, 0), (width, 0), (width, height), (0, height))
+    ]
+    xs = [cos * x + sin * y for x, y in corners]
+    ys = [cos * y - sin * x for x, y in corners]
+    return (
+        math.ceil(max(xs) + width / 2) - math.floor(min(xs) + width / 2),
+        math.ceil(max(ys) + height / 2) - math.floor(min(ys) + height / 2),
+    )
+
+
+def operation_size(
+    operation: Operation, size: tuple[int, int]
+) -> tuple[int, int]:
+    """Size of the result of an operation on an image of the given size."""
+    width, height = size
+    match operation:
+        case Rotate(degrees=degrees) if degrees % 180 == 0:
+            return size
+        case Rotate(degrees=degrees) if degrees % 90 == 0:
+            return height, width
+        case Rotate(degrees=degrees):
+            return rotated_size(degrees, size)
+        case Resize():
+            return resized_size(operation, size)
+        case Crop():
+            left, top, right, bottom = crop_box(operation, size)
+            return right - left, bottom - top
+    return size
+
+
+def peak_pixels(operations: list[Operation], size: tuple[int, int]) -> int:
+    """
+    Pixels of the largest image operations go through, from an image of
+    the given size to their result.
+    """
+    pixels = size[0] * size[1]
+    for operation in operations:
+        size = operation_size(operation, size)
+        pixels = max(pixels, size[0] * size[1])
+    return pixels
+
+
+def apply(operation: Operation, image: Image.Image) -> Image.Image:
+    match operation:
+        case Rotate(degrees=degrees) if degrees % 360 == 0:
+            return image
+        case Rotate(degrees=degrees) if degrees % 90 == 0:
+            return image.transpose(TRANSPOSITIONS[int(degrees) % 360])
+        case Rotate(degrees=degrees):
+            return image.rotate(degrees, expand=True)
+        case Resize() if (
+            factor := reduce_factor(operation, image.size, image.mode)
+        ):
+            width, height = resized_size(operation, image.size)
+            return image.crop((0, 0, width * factor, height * factor)).reduce(
+                factor
+            )
+        case Resize():
+            return image.resize(resized_size(operation, image.size))
+        case Crop():
+            return image.crop(crop_box(operation, image.size))
+        case Flip(direction="horizontal"):
+            return image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+        case Flip(direction="vertical"):
+            return image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+        case Grayscale():
+            return image.convert("L")
+        case Blur(radius=radius):
+            return image.filter(ImageFilter.GaussianBlur(radius))
+        case ColorJitter(
+            brightness=brightness, contrast=contrast, saturation=saturation
+        ):
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            if brightness != 1:
+                image = ImageEnhance.Brightness(image).enhance(brightness)
+            if contrast != 1:
+                image = ImageEnhance.Contrast(image).enhance(contrast)
+            if saturation != 1 and image.mode != "L":
+                image = ImageEnhance.Color(image).enhance(saturation)
+            return image
+        case Noise(sigma=sigma, seed=seed):
+            return add_noise(image, sigma, seed)
+
+
+class Node:
+    def __init__(self, operation: Operation | None = None):
+        self.operation = operation
+        self.children: dict[str, Node] = {}
+        self.outputs: list[str] = []
+
+
+class Plan:
+    """
+    Execution plan of a set of outputs over one decoded image.
+
+    Operation sequences are normalized and merged into a prefix tree, so
+    each distinct intermediate result is computed once and shared by all
+    outputs starting with the same operations.
+    """
+
+    def __init__(self, outputs: list[OutputSpec]):
+        self.outputs = {output.name: output for output in outputs}
+        self.root = Node()
+        for output in outputs:
+            node = self.root
+            for operation in normalize(output.operations):
+                key = operation_key(operation)
+                node = node.children.setdefault(key, Node(operation))
+            node.outputs.append(output.name)
+
+    def execute(
+        self, image: Image.Image, elapsed: float = 0.0
+    ) -> Iterator[tuple[str, Image.Image, float]]:
+        """
+        Yields (output name, image, processing time) as outputs are ready.
+
+        The processing time of an output covers every operation on its path,
+        including those shared with other outputs, plus the given time spent
+        before the plan, such as decoding. Intermediate images are released
+        once all outputs below them have been yielded.
+        """
+        for branch in self.branches(image, elapsed):
+            yield from branch()
+
+    def branches(
+        self, image: Image.Image, elapsed: float = 0.0
+    ) -> list[Callable[[], Iterator[tuple[str, Image.Image, float]]]]:
+        """
+        Independent parts of the plan, one per subtree below the root.
+
+        Each part yields the outputs of its subtree with the same
+        processing times as execute. Parts share no intermediate results,
+        so they can run concurrently. Outputs of the image itself come as
+        a part of their own.
+        """
+        parts = [
+            partial(self.descend, child, image, elapsed)
+            for child in self.root.children.values()
+        ]
+        if self.root.outputs:
+            identities = [(name, image, elapsed) for name in self.root.outputs]
+            parts.insert(0, partial(iter, identities))
+        return parts
+
+    def walk(
+        self, node: Node, image: Image.Image, elapsed: float
+    ) -> Iterator[tuple[str, Image.Image, float]]:
+        for name in node.outputs:
+            yield name, image, elapsed
+        for child in node.children.values():
+            yield from self.descend(child, image, elapsed)
+
+    def descend(
+        self, node: Node, image: Image.Image, elapsed: float
+    ) -> Iterator[tuple[str, Image.Image, float]]:
+        """Applies the operation of a node and walks the tree below it."""
+        start_time = perf_counter()
+        result = apply(node.operation, image)
+        duration = perf_counter() - start_time
+        record_stage(f"transform:{node.operation.op}", duration)
+        yield from self.walk(node, result, elapsed + duration)
+
+
+def draft_reduction(operations: list[Operation], size: tuple[int, int]) -> int:
+    """
+    Largest JPEG decode reduction that still satisfies the operations.
+
+    Only a leading resize can be served by a reduced decode, every other
+    operation needs the image at full resolution.
+    """
+    if not operations or not isinstance(operations[0], Resize):
+        return 1
+    width, height = resized_size(operations[0], size)
+    for reduction in DRAFT_REDUCTIONS:
+        if size[0] // width >= reduction and size[1] // height >= reduction:
+            return reduction
+    return 1
+
+
+class DecodePlan:
+    """
+    Execution plan of a set of outputs over an encoded image.
+
+    Outputs starting with a downscale may be rendered from a JPEG decoded
+    directly at 1/2, 1/4 or 1/8 of its size. Each output is assigned to the
+    cheapest decode able to serve it: an existing decode at a smaller
+    reduction, or a new reduced decode. Outputs needing full resolution
+    share one full decode. Each decode runs its outputs through a Plan.
+    """
+
+    def __init__(
+        self,
+        outputs: list[OutputSpec],
+        size: tuple[int, int],
+        image_format: str | None,
+    ):
+        self.outputs = {output.name: output for output in outputs}
+        self.size = size
+        wanted = {}
+        for output in outputs:
+            operations = normalize(output.operations)
+            reduction = 1
+            if image_format == "JPEG":
+                reduction = draft_reduction(operations, size)
+            if reduction > 1:
+                # A leading scale is relative to the decoded size, so it is
+                # pinned to the size it has on the full image
+                width, height = resized_size(operations[0], size)
+                operations[0] = Resize(width=width, height=height)
+            wanted.setdefault(reduction, []).append(
+                output.model_copy(update={"operations": operations})
+            )
+
+        decodes = {}
+        for reduction in sorted(wanted):
+            # Reuse the decode closest in size, if resizing from it is
+            # cheaper than another decode at this reduction
+            source = max(
+                (decode for decode in decodes if decode <= reduction),
+                default=None,
+            )
+            if source is None or self.resize_cost(
+                wanted[reduction], source
+            ) > DECODE_COST[reduction] + self.resize_cost(
+                wanted[reduction], reduction
+            ):
+                source = reduction
+            decodes.setdefault(source, []).extend(wanted[reduction])
+        self.plans = {
+            reduction: Plan(outputs) for reduction, outputs in decodes.items()
+        }
+
+    def resize_cost(self, outputs: list[OutputSpec], reduction: int) -> float:
+        """
+        Cost of the leading resizes of outputs from a reduced decode.
+
+        Resizing to the size of the decode itself is only a copy.
+        """
+        width, height = self.size
+        decoded = (-(-width // reduction), -(-height // reduction))
+        return sum(
+            RESIZE_COST / reduction**2
+            for output in outputs
+            if resized_size(output.operations[0], self.size) != decoded
+        )
+
+    def execute(
+        self, open_image: Callable[[], Image.Image]
+    ) -> Iterator[tuple[str, Image.Image, float]]:
+        """
+        Yields (output name, image, processing time) as outputs are ready.
+
+        open_image returns a new, not yet loaded image of the original on
+        every call, as a JPEG can only be drafted before it is decoded. The
+        processing time of an output includes the decode it comes from.
+        """
+        for branch in self.branches(open_image):
+            yield from branch()
+
+    def branches(
+        self, open_image: Callable[[], Image.Image]
+    ) -> Iterator[Callable[[], Iterator[tuple[str, Image.Image, float]]]]:
+        """
+        Yields the independent parts of the plans of every decode.
+
+        Decodes happen as the parts are requested, one after another, so
+        parts of an earlier decode can already run while the next one is
+        decoded.
+        """
+        width, height = self.size
+        for reduction, plan in sorted(self.plans.items()):
+            start_time = perf_counter()
+            image = open_image()
+            if reduction > 1:
+                image.draft(
+                    image.mode, (width // reduction, height // reduction)
+                )
+            image.load()
+            decode_time = perf_counter() - start_time
+            record_stage("decode", decode_time)
+            yield from plan.branches(image, decode_time)
@@ -0,0 +1,77 @@
+"""
+Images/sec per core of the batch engine against the per-image path.
+
+Renders the default rotated, gray and scaled outputs of same-size frames,
+once image by image through DecodePlan and once stacked through the batch
+engine. Both include decoding; encoding and storage are left out. Pillow
+and these NumPy operations run on a single thread, so the numbers are per
+core.
+
+Usage:
+    python -m benchmarks.batch_engine [--images 32] [--batch-size 8] [--size 1920x1080]
+"""
+
+import argparse
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from app.batching import render_batch
+from app.transforms import DecodePlan, default_outputs
+
+
+def make_frame(width: int, height: int, image_format: str) -> bytes:
+    image = Image.effect_noise((width // 8, height // 8), 64).convert("RGB")
+    buffer = BytesIO()
+    image.resize((width, height), Image.Resampling.BICUBIC).save(
+        buffer, format=image_format
+    )
+    return buffer.getvalue()
+
+
+def per_image(frames: list[bytes]) -> float:
+    outputs = default_outputs()
+    start = time.perf_counter()
+    for data in frames:
+        image = Image.open(BytesIO(data))
+        plan = DecodePlan(outputs, image.size, image.format)
+        for _ in plan.execute(lambda: Image.open(BytesIO(data))):
+            pass
+    return time.perf_counter() - start
+
+
+def batched(frames: list[bytes], batch_size: int) -> float:
+    outputs = default_outputs()
+    start = time.perf_counter()
+    for offset in range(0, len(frames), batch_size):
+        chunk = frames[offset : offset + batch_size]
+        render_batch(
+            [Image.open(BytesIO(data)) for data in chunk],
+            [outputs] * len(chunk),
+        )
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--size", default="1920x1080")
+    parser.add_argument("--format", default="JPEG")
+    args = parser.parse_args()
+    width, height = map(int, args.size.split("x"))
+
+    frames = [make_frame(width, height, args.format)] * args.images
+    for name, elapsed in (
+        ("per-image", per_image(frames)),
+        (f"batch of {args.batch_size}", batched(frames, args.batch_size)),
+    ):
+        print(
+            f"{name:>12}: {args.images} x {args.size} {args.format}: "
+            f"{args.images / elapsed:.1f} images/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Database rows/sec of one worker recording the outputs of augmentation tasks.
+
+Writes the ImageTask and Stats rows of --tasks tasks of four outputs each,
+once the way tasks used to, flushing every ImageTask for its generated id
+with statement logging on, and once without the logging. Then it writes
+them with OutputRecorder, one bulk write per task, and one per
+augmentation_batch task of --batch images. --latency adds a delay to every
+statement and commit to stand in for the round trip to a database server,
+which an in-process SQLite database does not have.
+
+Usage:
+    python -m benchmarks.db_rows [--tasks 500] [--batch 8] [--latency 0.5] [--url sqlite://]
+"""
+
+import argparse
+import contextlib
+import io
+import time
+from uuid import uuid4
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.models import Base, ImageTask, Stats, User
+from app.tasks import OutputRecorder
+
+OUTPUTS = ("original", "rotated", "gray", "scaled")
+
+
+def output_rows(task_id, user_id) -> list[tuple[dict, dict]]:
+    """ImageTask and Stats columns of the outputs of one task."""
+    name = uuid4().hex
+    return [
+        (
+            {
+                "task_id": task_id,
+                "user_id": user_id,
+                "img_link": f"{name}_{output}.png",
+                "output": f"{name}_{output}.png",
+                "content_hash": "a" * 64,
+                "transform": output,
+            },
+            {"width": 100, "height": 100, "size": 1000, "processing_time": 0},
+        )
+        for output in OUTPUTS
+    ]
+
+
+def per_row(session, tasks: list) -> None:
+    for task_id, user_id in tasks:
+        for image_task, stats in output_rows(task_id, user_id):
+            row = ImageTask(**image_task)
+            session.add(row)
+            session.flush()
+            session.add(Stats(image_id=row.id, **stats))
+        session.commit()
+
+
+def bulk(session, tasks: list, batch: int) -> None:
+    recorder = OutputRecorder(session)
+    for index, (task_id, user_id) in enumerate(tasks, 1):
+        for image_task, stats in output_rows(task_id, user_id):
+            recorder.add(image_task, **stats)
+        if index % batch == 0:
+            recorder.flush()
+    recorder.flush()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--url", default="sqlite://")
+    args = parser.parse_args()
+    delay = args.latency / 1000
+
+    print(
+        f"{args.tasks} tasks of {len(OUTPUTS)} outputs, "
+        f"{args.latency} ms per round trip"
+    )
+    print(f"{'writes':<16} {'rows/s':>10} {'round trips/task':>17}")
+    for name, echo, write in (
+        ("per row, echo", True, per_row),
+        ("per row", False, per_row),
+        ("bulk per task", False, lambda session, tasks: bulk(session, tasks, 1)),
+        (
+            f"bulk per {args.batch}",
+            False,
+            lambda session, tasks: bulk(session, tasks, args.batch),
+        ),
+    ):
+        engine = create_engine(args.url)
+        Base.metadata.create_all(engine)
+        round_trips = 0
+
+        def round_trip(*_):
+            nonlocal round_trips
+            round_trips += 1
+            time.sleep(delay)
+
+        event.listen(engine, "before_cursor_execute", round_trip)
+        event.listen(engine, "commit", round_trip)
+        with sessionmaker(bind=engine)() as session:
+            user = User(
+                id=uuid4(),
+                email=f"{uuid4().hex}@example.com",
+                password="password",
+                first_name="Bench",
+                last_name="Mark",
+            )
+            session.add(user)
+            session.commit()
+            tasks = [(uuid4(), user.id) for _ in range(args.tasks)]
+            round_trips = 0
+            # Statement logs go to stdout, as in a worker
+            with contextlib.redirect_stdout(io.StringIO()):
+                engine.echo = echo
+                start = time.perf_counter()
+                write(session, tasks)
+                elapsed = time.perf_counter() - start
+                engine.echo = False
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+        rows = args.tasks * len(OUTPUTS) * 2
+        print(
+            f"{name:<16} {rows / elapsed:>10.0f} "
+            f"{round_trips / args.tasks:>17.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
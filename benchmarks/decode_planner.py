@@ -0,0 +1,89 @@
+"""
+Rendering time of outputs with and without reduced JPEG decodes.
+
+Compares decoding the full image once for every output against the decode
+plan, which serves downscaled outputs from JPEGs decoded at 1/2, 1/4 or 1/8
+of their size. Encoding and storage are left out.
+
+Usage:
+    python -m benchmarks.decode_planner [--repeat 3] [--sizes 4000x3000 8000x6000]
+"""
+
+import argparse
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from app.schemas import OutputSpec, Resize
+from app.transforms import DecodePlan, Plan, default_outputs
+
+Image.MAX_IMAGE_PIXELS = None
+
+SCENARIOS = {
+    "default": default_outputs(90),
+    "scaled only": [OutputSpec(name="scaled", operations=[Resize(scale=0.5)])],
+    "thumbnails": [
+        OutputSpec(name="large", operations=[Resize(width=1024)]),
+        OutputSpec(name="medium", operations=[Resize(width=512)]),
+        OutputSpec(name="small", operations=[Resize(width=256)]),
+    ],
+}
+
+
+def make_jpeg(width: int, height: int) -> bytes:
+    # Upscaled noise compresses more like a photo than plain noise does
+    image = Image.effect_noise((width // 8, height // 8), 64).convert("RGB")
+    buffer = BytesIO()
+    image.resize((width, height), Image.Resampling.BICUBIC).save(
+        buffer, format="JPEG", quality=90
+    )
+    return buffer.getvalue()
+
+
+def full_decode(data: bytes, outputs: list[OutputSpec]) -> None:
+    image = Image.open(BytesIO(data))
+    image.load()
+    for _ in Plan(outputs).execute(image):
+        pass
+
+
+def planned_decode(data: bytes, outputs: list[OutputSpec]) -> None:
+    image = Image.open(BytesIO(data))
+    plan = DecodePlan(outputs, image.size, image.format)
+    for _ in plan.execute(lambda: Image.open(BytesIO(data))):
+        pass
+
+
+def measure(func, data: bytes, outputs: list[OutputSpec], repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data, outputs)
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--sizes", nargs="+", default=["4000x3000", "8000x6000"]
+    )
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        width, height = map(int, size.split("x"))
+        data = make_jpeg(width, height)
+        for name, outputs in SCENARIOS.items():
+            full = measure(full_decode, data, outputs, args.repeat)
+            planned = measure(planned_decode, data, outputs, args.repeat)
+            print(
+                f"{width * height / 1e6:.0f} MP {name}: "
+                f"full decode {full:.0f} ms, planned {planned:.0f} ms "
+                f"({full / planned:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Encoded size and encode time of each output format and encoder preset.
+
+"default" is Pillow's defaults, which outputs without an encoding get.
+Decoding and transforms are left out.
+
+Usage:
+    python -m benchmarks.encoder_presets [--repeat 3] [--size 1920x1080]
+"""
+
+import argparse
+import time
+
+from PIL import Image, features
+
+from app.encoders import PRESETS, encode
+from app.schemas import Encoding
+
+FORMATS = ["JPEG", "PNG", "WEBP"] + (
+    ["AVIF"] if features.check("avif") else []
+)
+
+
+def make_photo(width: int, height: int) -> Image.Image:
+    # Upscaled noise compresses more like a photo than plain noise does
+    image = Image.effect_noise((width // 8, height // 8), 64).convert("RGB")
+    return image.resize((width, height), Image.Resampling.BICUBIC)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--size", default="1920x1080")
+    args = parser.parse_args()
+    width, height = map(int, args.size.split("x"))
+    image = make_photo(width, height)
+
+    print(f"{'format':>6} {'preset':>9} {'KiB':>9} {'ms':>8}")
+    for image_format in FORMATS:
+        for preset in [None, *PRESETS]:
+            encoding = None if preset is None else Encoding(preset=preset)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                data = encode(image, image_format, encoding)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            print(
+                f"{image_format:>6} {preset or 'default':>9} "
+                f"{data.getbuffer().nbytes / 1024:>9.1f} "
+                f"{elapsed * 1000:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Queue wait of a small interactive user while a bulk backlog is processed.
+
+Simulates a worker pool fed by one broker queue. A bulk user submits a
+large backlog at once, in uploads of --bulk-batch files, while a small user
+submits a few images at a time every --interval seconds. Tasks are served
+once in FIFO order, as with a plain Celery queue, and once by the broker
+priorities submit_batch assigns from the lane of each upload and the
+backlog of its user. Prints the queue wait percentiles of the small user.
+
+Simulated time is in units of the mean task duration, so the numbers only
+depend on the shape of the load, not on the speed of this machine.
+
+Usage:
+    python -m benchmarks.fair_scheduling [--backlog 50000] [--workers 8] [--interval 5]
+"""
+
+import argparse
+import heapq
+import random
+from collections import defaultdict, deque
+from itertools import count
+
+import numpy as np
+
+from app.scheduling import task_priority, upload_lane
+
+
+def simulate(
+    fair: bool,
+    backlog: int,
+    bulk_batch: int,
+    workers: int,
+    interval: float,
+    small_files: int,
+    seed: int,
+) -> list[float]:
+    """Queue waits of the tasks of the small user."""
+    rng = random.Random(seed)
+    order = count()
+    queues = defaultdict(deque)
+    outstanding = defaultdict(int)
+    # (time, order, kind, payload) events
+    events = []
+    for offset in range(0, backlog, bulk_batch):
+        files = min(bulk_batch, backlog - offset)
+        heapq.heappush(events, (0.0, next(order), "submit", ("bulk", files)))
+    duration = backlog / workers
+    time = interval / 2
+    while time < duration:
+        heapq.heappush(
+            events, (time, next(order), "submit", ("small", small_files))
+        )
+        time += interval
+
+    idle = workers
+    waits = []
+
+    def dispatch(now: float) -> None:
+        nonlocal idle
+        while idle and any(queues.values()):
+            priority = min(level for level, queue in queues.items() if queue)
+            user, submitted = queues[priority].popleft()
+            if user == "small":
+                waits.append(now - submitted)
+            idle -= 1
+            finish = now + rng.expovariate(1.0)
+            heapq.heappush(events, (finish, next(order), "finish", user))
+
+    while events:
+        now, _, kind, payload = heapq.heappop(events)
+        if kind == "submit":
+            user, files = payload
+            lane = upload_lane(None, files)
+            for _ in range(files):
+                priority = 0
+                if fair:
+                    priority = task_priority(lane, outstanding[user])
+                outstanding[user] += 1
+                queues[priority].append((user, now))
+        else:
+            outstanding[payload] -= 1
+            idle += 1
+        dispatch(now)
+    return waits
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backlog", type=int, default=50_000)
+    parser.add_argument("--bulk-batch", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--interval", type=float, default=5.0)
+    parser.add_argument("--small-files", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(
+        f"{args.backlog} bulk tasks, {args.workers} workers, "
+        f"{args.small_files} small tasks every {args.interval} task durations"
+    )
+    print(f"{'scheduling':<12} {'tasks':>6} {'p50 wait':>10} {'p95 wait':>10}")
+    for name, fair in (("fifo", False), ("fair", True)):
+        waits = simulate(
+            fair,
+            args.backlog,
+            args.bulk_batch,
+            args.workers,
+            args.interval,
+            args.small_files,
+            args.seed,
+        )
+        p50, p95 = np.percentile(waits, [50, 95])
+        print(f"{name:<12} {len(waits):>6} {p50:>10.1f} {p95:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
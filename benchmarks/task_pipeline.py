@@ -0,0 +1,71 @@
+"""
+Images/sec of the augmentation task without MinIO or PostgreSQL.
+
+The original is served from the in-memory storage backend and the database
+session is a mock, so the numbers cover download, decode, transforms,
+encode and upload only.
+
+Usage:
+    python -m benchmarks.task_pipeline [--images 20] [--size 1920x1080]
+"""
+
+import argparse
+import time
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+
+from PIL import Image
+
+from app import tasks
+from app.ingest import build_filenames
+from app.storage import MemoryStorage
+
+
+def make_image(width: int, height: int, image_format: str) -> bytes:
+    buffer = BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(
+        buffer, format=image_format
+    )
+    return buffer.getvalue()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--size", default="1920x1080")
+    parser.add_argument("--format", default="JPEG")
+    args = parser.parse_args()
+    width, height = map(int, args.size.split("x"))
+    extension = "png" if args.format == "PNG" else "jpg"
+
+    storage = MemoryStorage()
+    storage.bootstrap()
+    filenames = build_filenames(f"bench.{extension}")
+    storage.put(
+        "images",
+        filenames["original"],
+        BytesIO(make_image(width, height, args.format)),
+    )
+    session = MagicMock()
+    session.execute.return_value.all.return_value = []
+
+    with patch.object(tasks, "storage", storage), patch.object(
+        tasks, "sync_sessionmaker"
+    ) as sessionmaker:
+        sessionmaker.return_value.__enter__.return_value = session
+        start = time.perf_counter()
+        for _ in range(args.images):
+            tasks.augmentation(
+                minio_path=f"images/{filenames['original']}",
+                filenames=filenames,
+                user_id="bench",
+            )
+        elapsed = time.perf_counter() - start
+    print(
+        f"{args.images} x {args.size} {args.format}: "
+        f"{args.images / elapsed:.1f} images/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Requests/sec of POST /upload for 1, 10 and 50 files per request.
+
+Storage and Celery are replaced by in-process fakes: the memory storage
+sleeps on every write to emulate a network round trip, submit_batch returns
+a dummy group result. Rate limits, admission and quotas, which need Redis,
+always let requests through. "blocking" reproduces the previous behaviour of
+calling the synchronous upload on the event loop, "async" is the current
+ingest path.
+
+Usage:
+    python -m benchmarks.upload_throughput [--requests 40] [--clients 8]
+"""
+
+import argparse
+import asyncio
+import time
+from io import BytesIO
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+from uuid import uuid4
+
+import httpx
+from PIL import Image
+
+from app import endpoints, ingest
+from app.auth import get_current_user
+from app.limits import limit_uploads
+from app.models import User
+from app.storage import HashingReader, MemoryStorage
+from main import app
+
+STORAGE_LATENCY = 0.01
+
+
+class SlowStorage(MemoryStorage):
+    def put(self, bucket_name, object_name, data, length=-1):
+        time.sleep(STORAGE_LATENCY)
+        return super().put(bucket_name, object_name, data, length)
+
+
+async def blocking_upload(file, object_name):
+    reader = HashingReader(file.file)
+    path = ingest.storage.put("images", object_name, reader)
+    return path, reader.hexdigest()
+
+
+def fake_submit_batch(uploads, user_id, lane=None):
+    return SimpleNamespace(id=str(uuid4())), [str(uuid4()) for _ in uploads]
+
+
+def make_image() -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (512, 512), color="red").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+async def run(files: int, requests: int, clients: int) -> float:
+    payload = make_image()
+    transport = httpx.ASGITransport(app=app)
+    semaphore = asyncio.Semaphore(clients)
+
+    async def send(client: httpx.AsyncClient) -> None:
+        async with semaphore:
+            response = await client.post(
+                "/upload",
+                files=[
+                    ("files", (f"image_{i}.png", payload, "image/png"))
+                    for i in range(files)
+                ],
+            )
+            response.raise_for_status()
+
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(send(client) for _ in range(requests)))
+        return requests / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--clients", type=int, default=8)
+    args = parser.parse_args()
+
+    user = User(id=uuid4())
+    app.dependency_overrides[get_current_user] = lambda: user
+    app.dependency_overrides[limit_uploads] = lambda: user
+    storage = SlowStorage()
+    storage.bootstrap()
+    with patch.object(ingest, "storage", storage), patch.object(
+        endpoints, "submit_batch", fake_submit_batch
+    ), patch.object(endpoints, "admit", AsyncMock()), patch.object(
+        endpoints, "charge_quota", AsyncMock()
+    ):
+        print(f"{'mode':<10}{'files':>6}{'req/s':>10}")
+        for mode in ("blocking", "async"):
+            for files in (1, 10, 50):
+                if mode == "blocking":
+                    with patch.object(
+                        endpoints, "store_upload", blocking_upload
+                    ):
+                        rps = asyncio.run(
+                            run(files, args.requests, args.clients)
+                        )
+                else:
+                    rps = asyncio.run(run(files, args.requests, args.clients))
+                print(f"{mode:<10}{files:>6}{rps:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,17 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
 from app.endpoints import router
+from app.storage import storage
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await storage.run(storage.bootstrap)
+    yield
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(router)
@@ -1,5 +1,5 @@
 from io import BytesIO
-from unittest.mock import AsyncMock, MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, PropertyMock, patch
 
 import pytest
 import pytest_asyncio
@@ -9,8 +9,9 @@ from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session, sessionmaker
 
-from app.minio_client import minio_client
+from app.celery import celery_app
 from app.models import Base
+from app.storage import MemoryStorage
 
 
 @pytest.fixture
@@ -24,9 +25,15 @@ async def mock_async_db_session():
 
 
 @pytest.fixture
-def mock_minio_client():
-    with patch("app.minio_client.minio_client") as mock_client:
-        yield mock_client
+def memory_storage():
+    storage = MemoryStorage(concurrency=2)
+    storage.bootstrap()
+    with patch("app.tasks.storage", storage), patch(
+        "app.ingest.storage", storage
+    ), patch("app.endpoints.storage", storage), patch(
+        "app.derivatives.storage", storage
+    ):
+        yield storage
 
 
 @pytest.fixture(scope="session")
@@ -52,36 +59,76 @@ def session(engine, tables):
 
 
 @pytest.fixture
-def mock_image_response():
-    """Creates a mock response for an image download from MinIO."""
-    mock_response = MagicMock()
+def image_bytes():
+    """Creates a PNG image as it would be downloaded from storage."""
     image = Image.new("RGB", (100, 100), color="red")
     image_bytes = BytesIO()
     image.save(image_bytes, format="PNG")
-    image_bytes.seek(0)
-    mock_response.read.return_value = image_bytes.getvalue()
-    return mock_response
+    return image_bytes.getvalue()
 
 
 @pytest.fixture
-def mock_get_object(mock_image_response):
-    """Patches the MinIO get_object method."""
-    with patch.object(
-        minio_client, "get_object", return_value=mock_image_response
-    ) as mock:
+def mock_storage_get(image_bytes):
+    """Patches the storage get method."""
+    with patch("app.tasks.storage.get", return_value=image_bytes) as mock:
         yield mock
 
 
 @pytest.fixture
-def mock_upload_to_minio():
-    """Mocks the upload_to_minio function."""
-    with patch("app.tasks.upload_to_minio") as mock:
+def mock_storage_put():
+    """Patches the storage put method."""
+    with patch("app.tasks.storage.put") as mock:
         mock.side_effect = (
-            lambda file, filename, bucket_name: f"{bucket_name}/{filename}"
+            lambda bucket_name, object_name, data, length=-1: (
+                f"{bucket_name}/{object_name}"
+            )
         )
         yield mock
 
 
+@pytest.fixture
+def mock_backlog():
+    """Patches the backlog of users, every task getting priority 0."""
+    with patch("app.ingest.reserve_priorities") as mock:
+        mock.side_effect = lambda client, user_id, lane, count: [0] * count
+        yield mock
+
+
+@pytest.fixture
+def mock_batch_owners():
+    """Patches the owners of batches kept in the result backend."""
+    owners = {}
+    client = MagicMock()
+    client.set.side_effect = lambda key, value, ex=None: owners.update(
+        {key: value.encode()}
+    )
+    client.get.side_effect = owners.get
+    # Backends are per thread, so the client of every one of them is patched
+    with patch.object(
+        type(celery_app.backend),
+        "client",
+        new_callable=PropertyMock,
+        return_value=client,
+    ):
+        yield owners
+
+
+@pytest.fixture
+def mock_recorder():
+    """Patches bulk writes of output rows, collecting the rows instead."""
+    rows = []
+
+    def flush(recorder):
+        rows.extend(recorder.rows)
+        recorder.rows = []
+
+    with patch(
+        "app.tasks.OutputRecorder.flush", autospec=True, side_effect=flush
+    ) as mock:
+        mock.rows = rows
+        yield mock
+
+
 @pytest.fixture
 def mock_sync_sessionmaker(mock_db_session):
     """Patches the sync_sessionmaker to return a mock session."""
@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+
+from app.accounting import (
+    Usage,
+    collect_stages,
+    memory_status,
+    record_stage,
+    take_stages,
+    timed,
+)
+
+# ========================= Test memory_status ======================
+
+
+def test_memory_status():
+    status = memory_status()
+    assert status["VmHWM"] >= status["VmRSS"] > 0
+
+
+def test_memory_status_without_proc():
+    with patch("app.accounting.PROC_STATUS", Path("/nonexistent/status")):
+        assert memory_status() == {}
+
+
+# ============================ Test Usage ===========================
+
+
+def test_usage_measures_allocations():
+    usage = Usage()
+    block = np.ones(64 * 1024 * 1024, dtype=np.uint8)
+    totals = usage.totals()
+    del block
+
+    assert totals["peak_rss"] >= 60 * 1024 * 1024
+    assert totals["cpu_time"] > 0
+    assert totals["wall_time"] >= totals["cpu_time"] * 0.5
+
+
+def test_usage_without_peak_reset():
+    with patch("app.accounting.reset_peak_rss", return_value=False), patch(
+        "app.accounting.max_rss", side_effect=[100, 250]
+    ):
+        usage = Usage()
+        assert usage.peak_rss() == 150
+
+
+# ========================== Test stage timings ======================
+
+
+def test_collect_stages():
+    # Nothing is collected outside of a collection
+    record_stage("decode", 1.0)
+    with collect_stages() as timings:
+        with timed("upload", "rotated"):
+            pass
+        with ThreadPoolExecutor(1) as executor:
+            executor.submit(
+                copy_context().run, record_stage, "transform:rotate", 0.5
+            ).result()
+    assert [(stage, output) for stage, output, _ in timings] == [
+        ("upload", "rotated"),
+        ("transform:rotate", None),
+    ]
+    assert 0 <= timings[0][2] < 1
+
+
+def test_take_stages():
+    assert take_stages() == []
+    with collect_stages() as timings:
+        record_stage("decode", 1.0)
+        assert take_stages() == [("decode", None, 1.0)]
+        record_stage("encode", 2.0, "gray")
+        assert timings == [("encode", "gray", 2.0)]
@@ -0,0 +1,97 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from fastapi import HTTPException
+
+from app.admission import UNKNOWN_WAIT, admit, backlog, queue_backlog
+
+
+def mock_redis(depths: list[int], drained: list[bytes | None]) -> MagicMock:
+    client = MagicMock()
+    pipeline = MagicMock()
+    pipeline.execute = AsyncMock(return_value=[*depths, drained])
+    client.pipeline.return_value.__aenter__.return_value = pipeline
+    return client
+
+
+def broker(depth: int, drained_per_minute: int):
+    """Patches Redis with a queue of depth tasks at a steady drain rate."""
+    depths = [depth] + [0] * 9
+    drained = [str(drained_per_minute).encode()] * 5
+    return patch("app.admission.redis_client", mock_redis(depths, drained))
+
+
+# ========================= Test queue_backlog ======================
+
+
+@pytest.mark.asyncio
+async def test_queue_backlog():
+    client = mock_redis(
+        [100, 0, 20] + [0] * 7, [b"60", None, b"120", b"60", b"60"]
+    )
+    with patch("app.admission.redis_client", client), patch(
+        "app.admission.celery_settings.DRAIN_MINUTES", 5
+    ):
+        result = await queue_backlog("small")
+    pipeline = client.pipeline.return_value.__aenter__.return_value
+    assert pipeline.llen.call_args_list[0].args == ("small",)
+    assert pipeline.llen.call_args_list[1].args == ("small:1",)
+    assert len(pipeline.mget.call_args.args[0]) == 5
+    assert result == {"depth": 120, "drain_rate": 1.0, "drain_seconds": 120.0}
+
+
+@pytest.mark.asyncio
+async def test_queue_backlog_without_progress():
+    with broker(5, 0):
+        assert (await queue_backlog("small"))["drain_seconds"] is None
+    with broker(0, 0):
+        assert (await queue_backlog("small"))["drain_seconds"] == 0.0
+
+
+@pytest.mark.asyncio
+async def test_backlog():
+    with broker(10, 60):
+        result = await backlog()
+    assert set(result) == {"small", "large", "huge"}
+
+
+# ============================= Test admit ===========================
+
+
+@pytest.mark.asyncio
+async def test_admit_within_limits():
+    with broker(100, 60):
+        await admit({"small", "large"})
+
+
+@pytest.mark.asyncio
+async def test_admit_rejects_full_queue():
+    with broker(25_000, 600), patch(
+        "app.admission.celery_settings.MAX_QUEUE_DEPTH", 20_000
+    ):
+        with pytest.raises(HTTPException) as e:
+            await admit({"small"})
+    assert e.value.status_code == 503
+    # 5000 tasks over the limit drained at 10 per second
+    assert e.value.headers == {"Retry-After": "500"}
+
+
+@pytest.mark.asyncio
+async def test_admit_rejects_full_queue_without_progress():
+    with broker(25_000, 0), patch(
+        "app.admission.celery_settings.MAX_QUEUE_DEPTH", 20_000
+    ):
+        with pytest.raises(HTTPException) as e:
+            await admit({"huge"})
+    assert e.value.headers == {"Retry-After": str(UNKNOWN_WAIT)}
+
+
+@pytest.mark.asyncio
+async def test_admit_defers_slow_queue():
+    with broker(5000, 60), patch(
+        "app.admission.celery_settings.MAX_DRAIN_SECONDS", 1800
+    ):
+        with pytest.raises(HTTPException) as e:
+            await admit({"large"})
+    assert e.value.status_code == 429
+    assert e.value.headers == {"Retry-After": "3200"}
@@ -8,6 +8,7 @@ from fastapi import HTTPException, status
 from app.auth import (
     authenticate_user,
     create_access_token,
+    get_admin_user,
     get_current_user,
     get_password_hash,
     user_authorization,
@@ -227,3 +228,15 @@ async def test_get_current_user_user_not_found(mock_async_db_session):
         await get_current_user(token, mock_async_db_session)
     assert exc_info.value.status_code == status.HTTP_401_UNAUTHORIZED
     assert exc_info.value.detail == "Could not validate credentials"
+
+
+# ======================= Test get_admin_user =======================
+
+
+@pytest.mark.asyncio
+async def test_get_admin_user():
+    admin = User(email="admin@example.com", is_admin=True)
+    assert await get_admin_user(admin) is admin
+    with pytest.raises(HTTPException) as exc_info:
+        await get_admin_user(User(email="user@example.com", is_admin=False))
+    assert exc_info.value.status_code == status.HTTP_403_FORBIDDEN
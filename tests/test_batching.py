@@ -0,0 +1,127 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from app.batching import apply_batch, batchable_outputs, render_batch
+from app.schemas import Blur, Grayscale, OutputSpec, Resize, Rotate
+from app.transforms import DecodePlan, apply, default_outputs
+
+
+def noise_image(size=(40, 24), mode="RGB") -> Image.Image:
+    bands = [Image.effect_noise(size, 90) for _ in mode]
+    return Image.merge(mode, bands)
+
+
+def openers(images: list[Image.Image]) -> list:
+    return [lambda image=image: image for image in images]
+
+
+def jpeg_opener(image: Image.Image):
+    buffer = BytesIO()
+    image.save(buffer, "JPEG")
+    return lambda: Image.open(BytesIO(buffer.getvalue()))
+
+
+# ========================= Test apply_batch ========================
+
+
+def test_apply_batch_matches_per_image_path():
+    images = [noise_image() for _ in range(3)]
+    pixels = np.stack([np.asarray(image) for image in images])
+    for operation in (
+        Rotate(degrees=90),
+        Rotate(degrees=180),
+        Rotate(degrees=-90),
+        Grayscale(),
+    ):
+        result = apply_batch(operation, pixels)
+        for image, image_pixels in zip(images, result):
+            expected = np.asarray(apply(operation, image))
+            assert np.array_equal(image_pixels, expected)
+
+
+def test_apply_batch_downscale_averages_blocks():
+    images = [noise_image(), noise_image(mode="L")]
+    for image in images:
+        pixels = np.asarray(image)[np.newaxis]
+        (result,) = apply_batch(Resize(scale=0.5), pixels)
+        assert np.array_equal(result, np.asarray(image.reduce(2)))
+
+
+def test_apply_batch_downscale_matches_per_image_path():
+    # Sizes that are not multiples of the factors drop the partial blocks
+    for image in (noise_image((41, 29)), noise_image((38, 27), mode="L")):
+        pixels = np.asarray(image)[np.newaxis]
+        for scale in (0.5, 1 / 3, 0.25, 0.125):
+            (result,) = apply_batch(Resize(scale=scale), pixels)
+            expected = np.asarray(apply(Resize(scale=scale), image))
+            assert np.array_equal(result, expected)
+
+
+def test_batchable_outputs():
+    assert batchable_outputs(default_outputs(270))
+    assert batchable_outputs(
+        [OutputSpec(name="small", operations=[Resize(scale=0.25)])]
+    )
+    assert not batchable_outputs(
+        [OutputSpec(name="tilted", operations=[Rotate(degrees=45)])]
+    )
+    assert not batchable_outputs(
+        [OutputSpec(name="third", operations=[Resize(scale=0.3)])]
+    )
+    assert not batchable_outputs(
+        [OutputSpec(name="blurred", operations=[Blur()])]
+    )
+
+
+# ========================= Test render_batch =======================
+
+
+def test_render_batch_stacks_same_shape_images():
+    images = [noise_image(), noise_image(), noise_image((24, 40))]
+    outputs = [default_outputs()] * 3
+
+    results = render_batch(openers(images), outputs)
+
+    assert set(results[0]) == {"rotated", "gray", "scaled"}
+    rotated, processing_time = results[1]["rotated"]
+    assert rotated.size == (24, 40)
+    assert processing_time >= 0
+    gray, _ = results[0]["gray"]
+    assert gray.mode == "L"
+    assert results[0]["scaled"][0].size == (20, 12)
+    # An image of its own shape is left to the per-image path
+    assert results[2] == {}
+
+
+def test_render_batch_skips_unsupported_images():
+    images = [noise_image(mode="CMYK"), noise_image(mode="CMYK")]
+    assert render_batch(openers(images), [default_outputs()] * 2) == [
+        {},
+        {},
+    ]
+    images = [noise_image(), noise_image()]
+    outputs = [[OutputSpec(name="blurred", operations=[Blur()])]] * 2
+    assert render_batch(openers(images), outputs) == [{}, {}]
+
+
+def test_render_batch_decodes_jpegs_like_per_image_path():
+    open_images = [jpeg_opener(noise_image((64, 48))) for _ in range(2)]
+    outputs = default_outputs()
+
+    results = render_batch(open_images, [outputs] * 2)
+
+    for open_image, rendered in zip(open_images, results):
+        plan = DecodePlan(outputs, (64, 48), "JPEG")
+        # The scaled output comes from a reduced decode on both paths
+        assert 2 in plan.plans
+        for name, expected, _ in plan.execute(open_image):
+            image, _ = rendered[name]
+            assert np.array_equal(np.asarray(image), np.asarray(expected))
+
+
+def test_render_batch_skips_jpegs_resampled_from_reduced_decode():
+    # A scale of an odd size is resampled from the reduced decode
+    open_images = [jpeg_opener(noise_image((65, 49))) for _ in range(2)]
+    assert render_batch(open_images, [default_outputs()] * 2) == [{}, {}]
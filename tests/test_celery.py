@@ -1,3 +1,14 @@
+from unittest.mock import MagicMock, patch
+
+from app.celery import (
+    count_drained,
+    record_usage,
+    release_backlog,
+    release_revoked,
+    start_usage,
+    usages,
+)
+from app.models import TaskUsage
 from app.settings import CelerySettings
 
 # ======================= Test celery_settings_ur =====================
@@ -9,3 +20,64 @@ def test_celery_settings_url():
     )
     result = settings.url
     assert result == "redis://localhost:6379/celery_db"
+
+
+# ========================= Test record_usage =======================
+
+
+def test_record_usage(mock_db_session):
+    task = MagicMock()
+    task.name = "app.tasks.augmentation"
+    task.request.delivery_info = {"routing_key": "large"}
+
+    with patch("app.celery.sync_sessionmaker") as mock_sessionmaker:
+        mock_sessionmaker.return_value.__enter__.return_value = mock_db_session
+        start_usage(task_id="task")
+        record_usage(task_id="task", task=task, state="SUCCESS")
+
+    (row,) = [call.args[0] for call in mock_db_session.merge.call_args_list]
+    assert isinstance(row, TaskUsage)
+    assert row.task_name == "app.tasks.augmentation"
+    assert row.queue == "large"
+    assert row.state == "SUCCESS"
+    assert row.wall_time >= 0 and row.cpu_time >= 0 and row.peak_rss >= 0
+    mock_db_session.commit.assert_called_once()
+    assert "task" not in usages
+
+
+def test_record_usage_without_start():
+    with patch("app.celery.sync_sessionmaker") as mock_sessionmaker:
+        record_usage(task_id="unknown", task=MagicMock(), state="SUCCESS")
+    mock_sessionmaker.assert_not_called()
+
+
+# ======================== Test release_backlog ======================
+
+
+def test_release_backlog():
+    with patch("app.celery.release_task") as mock_release:
+        release_backlog(kwargs={"user_id": "user"})
+        release_backlog(kwargs={"uploads": []})
+        # A retried task stays in the backlog
+        release_backlog(kwargs={"user_id": "user"}, state="RETRY")
+        release_revoked(request=MagicMock(kwargs={"user_id": "user"}))
+        release_revoked(request=None)
+    assert [call.args[1] for call in mock_release.call_args_list] == [
+        "user",
+        "user",
+    ]
+
+
+# ========================= Test count_drained =======================
+
+
+def test_count_drained():
+    task = MagicMock()
+    task.request.delivery_info = {"routing_key": "huge"}
+    with patch("app.celery.record_drained") as mock_record:
+        count_drained(task=task)
+        count_drained(task=task, state="RETRY")
+        task.request.delivery_info = None
+        count_drained(task=task)
+    assert mock_record.call_count == 1
+    assert mock_record.call_args.args[1] == "huge"
@@ -0,0 +1,91 @@
+import asyncio
+from io import BytesIO
+from uuid import uuid4
+
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+from app.derivatives import (
+    coalesce,
+    derivative_name,
+    output_format,
+    parse_render,
+)
+from app.models import ImageTask
+from app.settings import storage_settings
+
+# ========================= Test parse_render ========================
+
+
+def test_parse_render():
+    output = parse_render(["rotate:90", "grayscale"], "WEBP", "small")
+    assert len(output.operations) == 2
+    assert output.format == "WEBP"
+    assert output.encoding.preset == "small"
+
+
+@pytest.mark.parametrize("operations", [["bogus"], ["scale:2"]])
+def test_parse_render_invalid(operations):
+    with pytest.raises(HTTPException) as exc_info:
+        parse_render(operations, None, None)
+    assert exc_info.value.status_code == 422
+
+
+# ======================== Test derivative_name ======================
+
+
+def test_derivative_name():
+    gray = parse_render(["grayscale"], None, None)
+    name = derivative_name("a" * 64, gray, "JPEG")
+    assert name.startswith(f"derived/{'a' * 64}/")
+    assert name.endswith(".jpg")
+    assert name == derivative_name(
+        "a" * 64, parse_render(["grayscale", "grayscale"], None, None), "JPEG"
+    )
+    identity = parse_render([], None, None)
+    assert name != derivative_name("a" * 64, identity, "JPEG")
+    assert name != derivative_name("b" * 64, gray, "JPEG")
+    webp = derivative_name("a" * 64, parse_render([], "WEBP", None), "JPEG")
+    assert webp.endswith(".webp")
+
+
+# ========================= Test output_format =======================
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("img_link", ["scan_original.tif", "blob", "a.jpg"])
+async def test_output_format_of_stored_image(memory_storage, img_link):
+    buffer = BytesIO()
+    Image.new("RGB", (8, 8)).save(buffer, format="PNG")
+    memory_storage.put(storage_settings.BUCKET, img_link, buffer)
+    original = ImageTask(id=uuid4(), img_link=img_link)
+
+    # The extension of the name says nothing of the format
+    assert await output_format(original, parse_render([], None, None)) == (
+        "PNG"
+    )
+    webp = parse_render([], "WEBP", None)
+    assert await output_format(original, webp) == "WEBP"
+
+
+# =========================== Test coalesce ==========================
+
+
+@pytest.mark.asyncio
+async def test_coalesce_shares_one_render():
+    calls = 0
+
+    async def render():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    results = await asyncio.gather(
+        *(coalesce("key", render) for _ in range(3))
+    )
+
+    assert results == [1, 1, 1]
+    # A finished render is not reused
+    assert await coalesce("key", render) == 2
@@ -0,0 +1,101 @@
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+from pydantic import ValidationError
+
+from app.encoders import encode, encoder_settings, encoding_key, save_options
+from app.schemas import Encoding, OutputSpec
+from app.transforms import transform_key
+
+
+def photo(size=(160, 120)) -> Image.Image:
+    image = Image.effect_noise((size[0] // 8, size[1] // 8), 64)
+    return image.convert("RGB").resize(size, Image.Resampling.BICUBIC)
+
+
+# ======================= Test encoder_settings =====================
+
+
+def test_encoder_settings_overrides_preset():
+    settings = encoder_settings(Encoding(preset="small", quality=50))
+    assert settings["quality"] == 50
+    assert settings["effort"] == 9
+    assert encoder_settings(Encoding()) == {}
+
+
+def test_encoding_key():
+    assert encoding_key(Encoding(quality=80, optimize=True)) == (
+        "optimize=1,quality=80"
+    )
+    assert encoding_key(Encoding(preset="fast")) == encoding_key(
+        Encoding(
+            quality=80,
+            effort=1,
+            progressive=False,
+            optimize=False,
+            strip_metadata=True,
+        )
+    )
+
+
+def test_transform_key_with_encoding():
+    output = OutputSpec(
+        name="web",
+        operations=[],
+        format="WEBP",
+        encoding=Encoding(quality=60),
+    )
+    assert transform_key(output) == "identity|format:WEBP|encoding:quality=60"
+
+
+# ========================= Test save_options =======================
+
+
+def test_save_options_maps_effort():
+    image = Image.new("RGB", (10, 10))
+    settings = {"quality": 70, "effort": 9}
+    assert save_options(image, "PNG", settings) == {"compress_level": 9}
+    assert save_options(image, "WEBP", settings) == {
+        "quality": 70,
+        "method": 6,
+    }
+    assert save_options(image, "AVIF", {"effort": 0}) == {"speed": 10}
+    assert save_options(image, "AVIF", {"effort": 9}) == {"speed": 4}
+
+
+def test_save_options_metadata():
+    image = Image.new("RGB", (10, 10))
+    image.info["exif"] = b"Exif\x00\x00"
+    options = save_options(image, "JPEG", {"strip_metadata": False})
+    assert options == {"exif": b"Exif\x00\x00"}
+    options = save_options(image, "JPEG", {"strip_metadata": True})
+    assert options == {"icc_profile": None}
+
+
+# ============================ Test encode ==========================
+
+
+def test_encode_presets():
+    image = photo()
+    fast = encode(image, "JPEG", Encoding(preset="fast"))
+    small = encode(image, "JPEG", Encoding(preset="small"))
+    assert small.getbuffer().nbytes < fast.getbuffer().nbytes
+    with Image.open(small) as encoded:
+        assert encoded.info.get("progressive")
+
+
+def test_encode_without_encoding():
+    data = encode(Image.new("RGBA", (10, 10)), "JPEG")
+    with Image.open(data) as encoded:
+        assert encoded.format == "JPEG"
+        assert encoded.mode == "RGB"
+
+
+# ========================= Test format check =======================
+
+
+def test_avif_rejected_when_unavailable():
+    with patch("app.schemas.features.check", return_value=False):
+        with pytest.raises(ValidationError, match="AVIF"):
+            OutputSpec(name="avif", operations=[], format="AVIF")
@@ -0,0 +1,272 @@
+from io import BytesIO
+from unittest.mock import AsyncMock, MagicMock, patch
+from uuid import uuid4
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app.auth import get_current_user
+from app.database import get_session
+from app.derivatives import derivative_name, parse_render
+from app.endpoints import complete_images, complete_upload_session
+from app.limits import limit_downloads
+from app.models import ImageTask, UploadPart, UploadSession
+from app.schemas import UploadFiles
+from app.settings import storage_settings
+from main import app
+
+
+@pytest.fixture
+def mock_limits():
+    """Patches admission and quotas, which need Redis."""
+    with patch("app.endpoints.admit", AsyncMock()) as admit, patch(
+        "app.endpoints.charge_quota", AsyncMock()
+    ) as charge_quota:
+        yield admit, charge_quota
+
+
+def png() -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (8, 8)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def upload_session_of(storage, user_id, data: bytes) -> UploadSession:
+    """An upload session with all of data uploaded as its one part."""
+    object_name = f"uploads/{user_id}/{uuid4().hex}/image_original.png"
+    upload_id = storage.create_multipart(storage_settings.BUCKET, object_name)
+    etag = storage.upload_part(
+        storage_settings.BUCKET, object_name, upload_id, 1, data
+    )
+    return UploadSession(
+        id=uuid4(),
+        user_id=user_id,
+        filename="image.png",
+        object_name=object_name,
+        upload_id=upload_id,
+        parts=[UploadPart(part_number=1, etag=etag, size=len(data))],
+    )
+
+
+# ====================== Test complete_images ========================
+
+
+@pytest.mark.asyncio
+async def test_complete_images_rejected_not_charged(
+    memory_storage, mock_limits
+):
+    admit, charge_quota = mock_limits
+    user = MagicMock(id=uuid4())
+    object_name = f"uploads/{user.id}/{uuid4().hex}/image_original.png"
+    memory_storage.put(
+        storage_settings.BUCKET, object_name, BytesIO(b"not an image")
+    )
+
+    with pytest.raises(HTTPException) as e:
+        await complete_images(user, UploadFiles(files=[object_name]))
+
+    assert e.value.status_code == 400
+    admit.assert_not_awaited()
+    charge_quota.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_complete_images_not_admitted_not_charged(
+    memory_storage, mock_limits
+):
+    admit, charge_quota = mock_limits
+    admit.side_effect = HTTPException(status_code=503)
+    user = MagicMock(id=uuid4())
+    object_name = f"uploads/{user.id}/{uuid4().hex}/image_original.png"
+    memory_storage.put(storage_settings.BUCKET, object_name, BytesIO(png()))
+
+    with pytest.raises(HTTPException) as e:
+        await complete_images(user, UploadFiles(files=[object_name]))
+
+    assert e.value.status_code == 503
+    charge_quota.assert_not_awaited()
+    # The upload is kept, so it can be completed once admitted
+    assert memory_storage.stat(storage_settings.BUCKET, object_name)
+
+
+# ================== Test complete_upload_session ====================
+
+
+@pytest.mark.asyncio
+async def test_complete_upload_session_rejected(
+    memory_storage, mock_async_db_session, mock_limits
+):
+    user = MagicMock(id=uuid4())
+    upload_session = upload_session_of(
+        memory_storage, user.id, b"not an image"
+    )
+
+    with pytest.raises(HTTPException) as e:
+        await complete_upload_session(
+            mock_async_db_session, user, upload_session
+        )
+
+    assert e.value.status_code == 400
+    mock_limits[1].assert_not_awaited()
+    # The session is gone for good, so no retry completes it again
+    mock_async_db_session.delete.assert_awaited_once_with(upload_session)
+    mock_async_db_session.commit.assert_awaited_once()
+    bucket_name = storage_settings.BUCKET
+    assert memory_storage.stat(bucket_name, upload_session.object_name) is None
+
+
+@pytest.mark.asyncio
+async def test_complete_upload_session_over_quota(
+    memory_storage, mock_async_db_session, mock_limits
+):
+    _, charge_quota = mock_limits
+    charge_quota.side_effect = HTTPException(status_code=429)
+    user = MagicMock(id=uuid4())
+    upload_session = upload_session_of(memory_storage, user.id, png())
+
+    with pytest.raises(HTTPException) as e:
+        await complete_upload_session(
+            mock_async_db_session, user, upload_session
+        )
+
+    assert e.value.status_code == 429
+    charge_quota.assert_awaited_once_with(
+        user.id, images=1, upload_bytes=len(png())
+    )
+    mock_async_db_session.delete.assert_awaited_once_with(upload_session)
+    bucket_name = storage_settings.BUCKET
+    assert memory_storage.stat(bucket_name, upload_session.object_name) is None
+
+
+# ======================= Test GET /images/render ====================
+
+
+@pytest.fixture
+def render_client(memory_storage, mock_async_db_session):
+    """
+    A client of the app as a user owning one stored PNG original, with
+    downloads neither limited nor metered.
+    """
+    user = MagicMock(id=uuid4())
+    original = ImageTask(
+        id=uuid4(),
+        task_id=uuid4(),
+        user_id=user.id,
+        img_link=f"uploads/{user.id}/{uuid4().hex}/image_original.png",
+        content_hash="a" * 64,
+        transform="original",
+    )
+    memory_storage.put(
+        storage_settings.BUCKET, original.img_link, BytesIO(png())
+    )
+    mock_async_db_session.get.side_effect = lambda model, image_id: (
+        original if image_id == original.id else None
+    )
+    app.dependency_overrides[get_session] = lambda: mock_async_db_session
+    app.dependency_overrides[limit_downloads] = lambda: user
+    with patch("app.endpoints.record_download", AsyncMock()):
+        yield TestClient(app), original
+    app.dependency_overrides.clear()
+
+
+def stats_row(**columns):
+    """A Stats row as returned by a select of its columns."""
+    return MagicMock(**columns, _mapping=columns)
+
+
+def query_results(*rows):
+    """Results of the queries of a request, returning each row in turn."""
+    return [MagicMock(first=MagicMock(return_value=row)) for row in rows]
+
+
+def test_render_image_not_found(render_client, mock_async_db_session):
+    client, _ = render_client
+    response = client.get(f"/images/{uuid4()}/render?op=grayscale")
+    assert response.status_code == 404
+
+
+def test_render_image_existing_derivative(
+    render_client, memory_storage, mock_async_db_session
+):
+    client, original = render_client
+    memory_storage.put(
+        storage_settings.BUCKET, "derived/gray.png", BytesIO(b"derived")
+    )
+    mock_async_db_session.execute.side_effect = query_results(
+        stats_row(width=8, height=8, size=100),
+        ("derived/gray.png", 7),
+    )
+
+    with patch("app.endpoints.render_derivative") as render_derivative:
+        response = client.get(f"/images/{original.id}/render?op=grayscale")
+
+    assert response.status_code == 200
+    assert response.content == b"derived"
+    assert response.headers["content-type"] == "image/png"
+    render_derivative.apply_async.assert_not_called()
+
+
+def test_render_image_renders_on_worker(
+    render_client, memory_storage, mock_async_db_session
+):
+    client, original = render_client
+    mock_async_db_session.execute.side_effect = query_results(
+        stats_row(width=8, height=8, size=100),
+        None,
+    )
+    object_name = derivative_name(
+        original.content_hash, parse_render(["grayscale"], None, None), "PNG"
+    )
+
+    def render(kwargs, queue):
+        # What the worker saves for the API to stream
+        memory_storage.put(
+            storage_settings.BUCKET, kwargs["object_name"], BytesIO(b"gray")
+        )
+        return MagicMock()
+
+    with patch("app.endpoints.render_derivative") as render_derivative:
+        render_derivative.apply_async.side_effect = render
+        response = client.get(f"/images/{original.id}/render?op=grayscale")
+
+    assert response.status_code == 200
+    assert response.content == b"gray"
+    ((), kwargs) = render_derivative.apply_async.call_args
+    assert kwargs["queue"] == "small"
+    assert kwargs["kwargs"]["object_name"] == object_name
+    assert kwargs["kwargs"]["original"]["img_link"] == original.img_link
+
+
+# ==================== Test GET /ops and /batch ======================
+
+
+@pytest.fixture
+def user_client():
+    """A client of the app as a user who is not an admin."""
+    user = MagicMock(id=uuid4(), is_admin=False)
+    app.dependency_overrides[get_current_user] = lambda: user
+    yield TestClient(app), user
+    app.dependency_overrides.clear()
+
+
+def test_ops_backlog_requires_admin(user_client):
+    client, user = user_client
+    with patch("app.endpoints.backlog", AsyncMock(return_value={})):
+        assert client.get("/ops/backlog").status_code == 403
+        user.is_admin = True
+        assert client.get("/ops/backlog").status_code == 200
+
+
+def test_batch_status_of_other_user(user_client, mock_batch_owners):
+    client, user = user_client
+    mock_batch_owners["batch:mine"] = str(user.id).encode()
+    mock_batch_owners["batch:theirs"] = str(uuid4()).encode()
+    with patch("app.ingest.GroupResult") as mock_group_result:
+        mock_group_result.restore.return_value = MagicMock(results=[])
+        assert client.get("/batch/theirs").status_code == 403
+        assert client.get("/batch/unknown").status_code == 404
+        response = client.get("/batch/mine")
+    assert response.status_code == 200
+    assert response.json()["total"] == 0
@@ -0,0 +1,220 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+from uuid import uuid4
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import event
+
+from app.history import (
+    decode_cursor,
+    encode_cursor,
+    export_history,
+    history_page,
+    history_query,
+)
+from app.models import ImageTask, Stats, User
+
+START = datetime(2026, 1, 1)
+
+
+@pytest.fixture
+def history(session):
+    """A user with an original, an output and a variant on each of 3 days."""
+    user = User(
+        id=uuid4(),
+        email=f"{uuid4().hex}@example.com",
+        password="securepassword",
+        first_name="Jane",
+        last_name="Doe",
+    )
+    session.add(user)
+    for day in range(3):
+        task_id = uuid4()
+        for transform, seed in (
+            ("original", None),
+            ("rotate:90", None),
+            ("variant", 7),
+        ):
+            image_task = ImageTask(
+                id=uuid4(),
+                task_id=task_id,
+                user_id=user.id,
+                img_link=f"{day}_{transform}.png",
+                transform=transform,
+                seed=seed,
+                created_at=START + timedelta(days=day),
+            )
+            session.add(image_task)
+            session.add(
+                Stats(
+                    id=uuid4(),
+                    image_id=image_task.id,
+                    width=10,
+                    height=10,
+                    size=100,
+                    processing_time=0,
+                )
+            )
+    session.commit()
+    return user
+
+
+# =========================== Test cursors ===========================
+
+
+def test_cursor_round_trip():
+    image_id = uuid4()
+    assert decode_cursor(encode_cursor(START, image_id)) == (START, image_id)
+
+
+def test_decode_cursor_invalid():
+    with pytest.raises(HTTPException) as e:
+        decode_cursor("not a cursor")
+    assert e.value.status_code == 400
+
+
+# ========================== Test history_query ======================
+
+
+def test_history_pages(session, history):
+    pages, cursor = [], None
+    while True:
+        rows = session.execute(
+            history_query(history.id, cursor).limit(4 + 1)
+        ).all()
+        page = history_page(rows, 4)
+        pages.append(page["items"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert [len(items) for items in pages] == [4, 4, 1]
+    items = [item for items in pages for item in items]
+    assert len({item["id"] for item in items}) == 9
+    keys = [(item["created_at"], str(item["id"])) for item in items]
+    assert keys == sorted(keys, reverse=True)
+    assert items[0]["size"] == 100
+
+
+@pytest.mark.parametrize(
+    "kind, transforms",
+    [
+        ("original", {"original"}),
+        ("output", {"rotate:90"}),
+        ("variant", {"variant"}),
+    ],
+)
+def test_history_query_kind(session, history, kind, transforms):
+    rows = session.execute(history_query(history.id, kind=kind)).all()
+    assert len(rows) == 3
+    assert {row.transform for row in rows} == transforms
+
+
+def test_history_query_date_range(session, history):
+    rows = session.execute(
+        history_query(
+            history.id,
+            since=START + timedelta(days=1),
+            until=START + timedelta(days=2),
+        )
+    ).all()
+    assert {row.img_link[0] for row in rows} == {"1"}
+
+
+def test_history_query_uses_index(session, history):
+    executed = []
+    engine = session.get_bind()
+
+    def listener(conn, cursor, statement, parameters, *args):
+        executed.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        session.execute(
+            history_query(history.id, encode_cursor(START, uuid4())).limit(10)
+        )
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    statement, parameters = executed[-1]
+    cursor = session.connection().connection.cursor()
+    plan = [
+        row[-1]
+        for row in cursor.execute(
+            f"EXPLAIN QUERY PLAN {statement}", parameters
+        )
+    ]
+    # A range scan of the index, without sorting the history
+    assert any("ix_imagetask_user_id_created_at" in step for step in plan)
+    assert not any("TEMP B-TREE" in step for step in plan)
+
+
+# ========================= Test export_history ======================
+
+
+def stream_session(session, partition_size: int):
+    """
+    An async session streaming from a sync one, as the API has no async
+    SQLite driver here.
+    """
+
+    async def partitions(result):
+        for rows in result.partitions(partition_size):
+            yield rows
+
+    async def stream(query):
+        result = MagicMock()
+        result.partitions = lambda: partitions(session.execute(query))
+        return result
+
+    async_session = MagicMock()
+    async_session.stream = stream
+    sessionmaker = MagicMock()
+    sessionmaker.return_value.__aenter__.return_value = async_session
+    return sessionmaker
+
+
+async def export(session, query, *args) -> list[bytes]:
+    with patch(
+        "app.history.async_sessionmaker", stream_session(session, 4)
+    ):
+        return [chunk async for chunk in export_history(query, *args)]
+
+
+@pytest.mark.asyncio
+async def test_export_history_ndjson(session, history):
+    chunks = await export(session, history_query(history.id))
+
+    # One chunk per partition of the cursor
+    assert len(chunks) == 3
+    records = [json.loads(line) for line in b"".join(chunks).splitlines()]
+    assert len(records) == 9
+    assert records[0]["size"] == 100
+
+    # Resuming after a record exports the records after it
+    query = history_query(history.id, records[4]["cursor"])
+    resumed = await export(session, query)
+    assert [
+        json.loads(line)["id"] for line in b"".join(resumed).splitlines()
+    ] == [record["id"] for record in records[5:]]
+
+
+@pytest.mark.asyncio
+async def test_export_history_csv(session, history):
+    chunks = await export(session, history_query(history.id), "csv")
+    rows = list(csv.DictReader(io.StringIO(b"".join(chunks).decode())))
+    assert len(rows) == 9
+    assert set(rows[0]) >= {"id", "img_link", "size", "cursor"}
+
+    resumed = await export(
+        session,
+        history_query(history.id, rows[0]["cursor"]),
+        "csv",
+        False,
+    )
+    lines = b"".join(resumed).decode().splitlines()
+    assert len(lines) == 8
+    assert not lines[0].startswith("id,")
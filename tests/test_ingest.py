@@ -0,0 +1,444 @@
+import hashlib
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+from uuid import uuid4
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+
+from app.ingest import (
+    batch_progress,
+    build_filenames,
+    chunk_uploads,
+    dump_variants,
+    eager_outputs,
+    parse_outputs,
+    parse_upload_name,
+    sniff_image,
+    sniff_stored,
+    sniff_upload,
+    store_upload,
+    submit_batch,
+    task_queue,
+    upload_prefix,
+)
+from app.schemas import OutputSpec, Resize, Rotate, Variants
+
+# ======================== Test build_filenames ======================
+
+
+def test_build_filenames():
+    result = build_filenames("holiday.photo.JPG")
+    assert result == {
+        "original": "holiday.photo_original.jpg",
+        "rotated": "holiday.photo_rotated.jpg",
+        "gray": "holiday.photo_gray.jpg",
+        "scaled": "holiday.photo_scaled.jpg",
+    }
+
+
+def test_build_filenames_with_outputs():
+    outputs = parse_outputs(
+        '[{"name": "thumb", "operations": [{"op": "resize", "width": 64}],'
+        ' "format": "WEBP"}, {"name": "copy", "operations": []}]'
+    )
+    assert build_filenames("a.png", outputs) == {
+        "original": "a_original.png",
+        "thumb": "a_thumb.webp",
+        "copy": "a_copy.png",
+    }
+
+
+def test_build_filenames_with_variants():
+    variants = Variants(count=2, policy={"format": "PNG"})
+    assert build_filenames("a.jpg", None, variants) == {
+        "original": "a_original.jpg",
+        "variant_000": "a_variant_000.png",
+        "variant_001": "a_variant_001.png",
+    }
+
+
+def test_build_filenames_with_prefix():
+    prefix = upload_prefix(uuid4())
+    assert build_filenames("a.png", [], None, prefix) == {
+        "original": f"{prefix}a_original.png"
+    }
+
+
+# ========================= Test upload names ========================
+
+
+def test_upload_prefix_is_unique():
+    user_id = uuid4()
+    assert upload_prefix(user_id) != upload_prefix(user_id)
+    assert upload_prefix(user_id).startswith(f"uploads/{user_id}/")
+
+
+def test_parse_upload_name():
+    user_id = uuid4()
+    prefix = upload_prefix(user_id)
+    object_name = build_filenames("cat_original.PNG", prefix=prefix)[
+        "original"
+    ]
+    assert parse_upload_name(user_id, object_name) == (
+        prefix,
+        "cat_original.png",
+    )
+
+
+@pytest.mark.parametrize(
+    "object_name",
+    [
+        "cat_original.png",
+        "uploads/{other}/0123456789abcdef0123456789abcdef/cat_original.png",
+        "uploads/{user}/guessable/cat_original.png",
+        "uploads/{user}/0123456789abcdef0123456789abcdef/cat_rotated.png",
+    ],
+)
+def test_parse_upload_name_rejects_other_names(object_name):
+    user_id = uuid4()
+    object_name = object_name.format(user=user_id, other=uuid4())
+    with pytest.raises(HTTPException) as e:
+        parse_upload_name(user_id, object_name)
+    assert e.value.status_code == 404
+
+
+# ========================= Test dump_variants =======================
+
+
+def test_dump_variants_draws_seeds():
+    assert dump_variants(None) is None
+    assert dump_variants(Variants(count=1, seed=5))["seed"] == 5
+    seeds = {dump_variants(Variants(count=1))["seed"] for _ in range(3)}
+    assert len(seeds) == 3
+
+
+# ========================= Test parse_outputs =======================
+
+
+def test_parse_outputs_none():
+    assert parse_outputs(None) is None
+
+
+@pytest.mark.parametrize(
+    "outputs",
+    [
+        "not json",
+        "[]",
+        '[{"name": "original", "operations": []}]',
+        '[{"name": "a", "operations": []}, {"name": "a", "operations": []}]',
+        '[{"name": "a", "operations": [{"op": "resize"}]}]',
+        '[{"name": "a", "operations": [{"op": "sharpen"}]}]',
+        '[{"name": "a", "operations": [], "format": "GIF"}]',
+    ],
+)
+def test_parse_outputs_invalid(outputs):
+    with pytest.raises(HTTPException) as exc_info:
+        parse_outputs(outputs)
+    assert exc_info.value.status_code == 422
+
+
+def test_eager_outputs():
+    outputs = parse_outputs('[{"name": "copy", "operations": []}]')
+    assert eager_outputs(outputs, None, True) is outputs
+    assert eager_outputs(None, None, False) == []
+    with pytest.raises(HTTPException) as exc_info:
+        eager_outputs(outputs, None, False)
+    assert exc_info.value.status_code == 422
+
+
+# ========================= Test submit_batch ========================
+
+
+def test_submit_batch(mock_backlog, mock_batch_owners):
+    uploads = [
+        {
+            "minio_path": "images/a_original.png",
+            "filenames": build_filenames("a.png"),
+            "content_hash": "hash",
+        },
+        {
+            "minio_path": "images/b_original.png",
+            "filenames": build_filenames("b.png"),
+        },
+    ]
+    with patch("app.ingest.group") as mock_group:
+        batch_result = mock_group.return_value.apply_async.return_value
+        batch_result.results = [MagicMock(id="a"), MagicMock(id="b")]
+        result, task_ids = submit_batch(uploads, "user")
+    signatures = list(mock_group.call_args.args[0])
+    assert [signature.kwargs for signature in signatures] == [
+        {"user_id": "user", **upload} for upload in uploads
+    ]
+    assert mock_group.return_value.apply_async.call_count == 1
+    batch_result.save.assert_called_once()
+    assert result is batch_result
+    assert mock_batch_owners == {f"batch:{batch_result.id}": b"user"}
+    assert task_ids == ["a", "b"]
+
+
+def test_submit_batch_stacks_same_shape_uploads(mock_backlog, mock_batch_owners):
+    frame = {"format": "JPEG", "mode": "RGB", "width": 64, "height": 48}
+    uploads = [
+        {
+            "minio_path": f"images/{name}_original.jpg",
+            "filenames": build_filenames(f"{name}.jpg"),
+            "image_info": frame,
+        }
+        for name in "abc"
+    ]
+    with patch("app.ingest.group") as mock_group, patch(
+        "app.ingest.image_settings.BATCH_SIZE", 8
+    ):
+        batch_result = mock_group.return_value.apply_async.return_value
+        batch_result.results = [MagicMock(id="batch")]
+        _, task_ids = submit_batch(uploads, "user")
+    (signature,) = mock_group.call_args.args[0]
+    assert signature.task == "app.tasks.augmentation_batch"
+    assert signature.kwargs == {"uploads": uploads, "user_id": "user"}
+    assert signature.options["queue"] == "small"
+    assert task_ids == ["batch"] * 3
+
+
+def test_submit_batch_routes_by_size(mock_backlog, mock_batch_owners):
+    uploads = [
+        {
+            "minio_path": f"images/{name}_original.jpg",
+            "filenames": build_filenames(f"{name}.jpg"),
+            "image_info": {
+                "mode": "RGB",
+                "width": width,
+                "height": 1000,
+                "size": 1024,
+            },
+        }
+        for name, width in (("small", 1000), ("huge", 60_000))
+    ]
+    with patch("app.ingest.group") as mock_group:
+        batch_result = mock_group.return_value.apply_async.return_value
+        batch_result.results = [MagicMock(id="a"), MagicMock(id="b")]
+        submit_batch(uploads, "user")
+    signatures = list(mock_group.call_args.args[0])
+    assert [signature.options["queue"] for signature in signatures] == [
+        "small",
+        "huge",
+    ]
+
+
+def test_submit_batch_prioritizes_by_backlog(mock_backlog, mock_batch_owners):
+    mock_backlog.side_effect = None
+    mock_backlog.return_value = [0, 6]
+    uploads = [
+        {"minio_path": f"images/{name}.png", "filenames": {}}
+        for name in "ab"
+    ]
+    with patch("app.ingest.group") as mock_group:
+        batch_result = mock_group.return_value.apply_async.return_value
+        batch_result.results = [MagicMock(id="a"), MagicMock(id="b")]
+        submit_batch(uploads, "user", "bulk")
+    _, user_id, lane, count = mock_backlog.call_args.args
+    assert (user_id, lane, count) == ("user", "bulk", 2)
+    signatures = list(mock_group.call_args.args[0])
+    assert [signature.options["priority"] for signature in signatures] == [
+        0,
+        6,
+    ]
+
+
+# =========================== Test task_queue ========================
+
+
+@pytest.mark.parametrize(
+    "image_info, queue",
+    [
+        ({"width": 1000, "height": 1000, "size": 1024}, "small"),
+        ({"width": 1000, "height": 1000, "size": None}, "small"),
+        ({"width": 4000, "height": 4000, "size": 1024}, "large"),
+        ({"width": 100, "height": 100, "size": 20 * 1024**2}, "large"),
+        ({"width": 8000, "height": 8000, "size": 1024}, "huge"),
+        ({"width": 100, "height": 100, "size": 200 * 1024**2}, "huge"),
+        (None, "large"),
+    ],
+)
+def test_task_queue(image_info, queue):
+    assert task_queue(image_info) == queue
+
+
+# ========================= Test chunk_uploads =======================
+
+
+def test_chunk_uploads():
+    frame = {"mode": "RGB", "width": 64, "height": 48}
+    uploads = [
+        {"image_info": frame},
+        {"image_info": {**frame, "width": 65}},
+        {"image_info": frame},
+        {"image_info": None},
+        {"image_info": {**frame, "mode": "CMYK"}},
+        {"image_info": frame, "variants": {"count": 2}},
+        {
+            "image_info": frame,
+            "outputs": [{"name": "blur", "operations": [{"op": "blur"}]}],
+        },
+        {"image_info": frame},
+    ]
+    with patch("app.ingest.image_settings.BATCH_SIZE", 2):
+        chunks = chunk_uploads(uploads)
+    assert chunks == [[0, 2], [1], [3], [4], [5], [6], [7]]
+
+
+# ========================= Test batch_progress ======================
+
+
+def test_batch_progress():
+    tasks = [MagicMock(id=str(i)) for i in range(5)]
+    metas = [
+        None,
+        {"status": "STARTED"},
+        {"status": "SUCCESS"},
+        {"status": "SUCCESS"},
+        {"status": "FAILURE"},
+    ]
+    with patch("app.ingest.GroupResult") as mock_group_result, patch(
+        "app.ingest.celery_app"
+    ) as mock_celery_app:
+        mock_group_result.restore.return_value = MagicMock(results=tasks)
+        backend = mock_celery_app.backend
+        backend.mget.return_value = metas
+        backend.client.get.return_value = b"user"
+        backend.decode_result.side_effect = lambda meta: meta
+        result = batch_progress("batch-id", "user")
+    assert backend.mget.call_count == 1
+    assert result == {
+        "total": 5,
+        "queued": 1,
+        "running": 1,
+        "done": 2,
+        "failed": 1,
+    }
+
+
+def test_batch_progress_not_found(mock_batch_owners):
+    assert batch_progress("batch-id", "user") is None
+    mock_batch_owners["batch:batch-id"] = b"user"
+    with patch("app.ingest.GroupResult") as mock_group_result:
+        mock_group_result.restore.return_value = None
+        assert batch_progress("batch-id", "user") is None
+
+
+def test_batch_progress_of_other_user(mock_batch_owners):
+    mock_batch_owners["batch:batch-id"] = b"owner"
+    with patch("app.ingest.GroupResult") as mock_group_result:
+        with pytest.raises(HTTPException) as exc_info:
+            batch_progress("batch-id", "user")
+        mock_group_result.restore.assert_not_called()
+    assert exc_info.value.status_code == 403
+
+
+# ========================= Test store_upload ========================
+
+
+@pytest.mark.asyncio
+async def test_store_upload(memory_storage):
+    file = UploadFile(file=BytesIO(b"file content"), size=12)
+    result = await store_upload(file, "image_original.png")
+    assert result == (
+        "images/image_original.png",
+        hashlib.sha256(b"file content").hexdigest(),
+    )
+    assert (
+        memory_storage.get("images", "image_original.png") == b"file content"
+    )
+
+
+# ========================= Test sniff_image ========================
+
+
+def encode_image(size, image_format="PNG") -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", size, color="red").save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def test_sniff_image():
+    head = encode_image((120, 80), "JPEG")[:1024]
+    result = sniff_image("image.jpg", head, 5000)
+    assert result == {
+        "format": "JPEG",
+        "mode": "RGB",
+        "width": 120,
+        "height": 80,
+        "frames": 1,
+        "size": 5000,
+    }
+
+
+def test_sniff_image_corrupt():
+    with pytest.raises(HTTPException) as exc_info:
+        sniff_image("image.png", b"not an image", 12)
+    assert exc_info.value.status_code == 400
+
+
+def test_sniff_image_unsupported_format():
+    with pytest.raises(HTTPException) as exc_info:
+        sniff_image("image.png", encode_image((10, 10), "GIF"), 100)
+    assert exc_info.value.status_code == 400
+
+
+def test_sniff_image_too_many_pixels():
+    with patch("app.ingest.image_settings.MAX_PIXELS", 100):
+        with pytest.raises(HTTPException) as exc_info:
+            sniff_image("image.png", encode_image((20, 20)), 100)
+    assert exc_info.value.status_code == 413
+
+
+def test_sniff_image_too_many_bytes():
+    with patch("app.ingest.image_settings.MAX_BYTES", 10):
+        with pytest.raises(HTTPException) as exc_info:
+            sniff_image("image.png", encode_image((20, 20)), 100)
+    assert exc_info.value.status_code == 413
+
+
+@pytest.mark.parametrize(
+    "outputs, variants",
+    [
+        ([OutputSpec(name="big", operations=[Resize(width=2000)])], None),
+        (
+            [
+                OutputSpec(
+                    name="big",
+                    operations=[Resize(scale=0.5), Resize(height=1000)],
+                )
+            ],
+            None,
+        ),
+        (None, Variants(count=1, policy={"rotation": 30})),
+    ],
+)
+def test_sniff_image_outputs_too_large(outputs, variants):
+    head = encode_image((100, 10))
+    with patch("app.ingest.image_settings.MAX_PIXELS", 1200):
+        with pytest.raises(HTTPException) as exc_info:
+            sniff_image("image.png", head, 100, outputs, variants)
+        assert exc_info.value.status_code == 413
+        # Outputs no larger than the image pass
+        small = OutputSpec(name="small", operations=[Rotate(degrees=90)])
+        sniff_image("image.png", head, 100, [small])
+
+
+@pytest.mark.asyncio
+async def test_sniff_upload_rewinds():
+    data = encode_image((30, 40))
+    file = UploadFile(file=BytesIO(data), filename="image.png", size=len(data))
+    result = await sniff_upload(file)
+    assert (result["width"], result["height"]) == (30, 40)
+    assert await file.read() == data
+
+
+@pytest.mark.asyncio
+async def test_sniff_stored_deletes_rejected(memory_storage):
+    memory_storage.put("images", "image_original.png", BytesIO(b"garbage"))
+    with pytest.raises(HTTPException):
+        await sniff_stored("image.png", "image_original.png")
+    assert memory_storage.stat("images", "image_original.png") is None
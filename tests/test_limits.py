@@ -0,0 +1,134 @@
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from fastapi import HTTPException
+
+from app.limits import (
+    QUOTA_GRACE,
+    charge_quota,
+    limit_downloads,
+    metered,
+    take_token,
+    today,
+    usage,
+)
+
+# ============================= Test today ===========================
+
+
+def test_today():
+    moment = datetime(2026, 3, 4, 23, 59, 30, tzinfo=timezone.utc)
+    with patch("app.limits.datetime", wraps=datetime) as mock_datetime:
+        mock_datetime.now.return_value = moment
+        assert today() == ("2026-03-04", 30)
+
+
+# ========================== Test take_token =========================
+
+
+@pytest.mark.asyncio
+async def test_take_token_allowed():
+    with patch(
+        "app.limits.token_bucket", AsyncMock(return_value=[1, b"19"])
+    ) as mock_bucket:
+        await take_token("user", "upload")
+    assert mock_bucket.call_args.kwargs["keys"] == ["rate:user:upload"]
+    assert mock_bucket.call_args.kwargs["args"][2] == 1
+
+
+@pytest.mark.asyncio
+async def test_take_token_rejected():
+    with patch(
+        "app.limits.token_bucket", AsyncMock(return_value=[0, b"2.25"])
+    ):
+        with pytest.raises(HTTPException) as e:
+            await take_token("user", "download")
+    assert e.value.status_code == 429
+    assert e.value.headers == {"Retry-After": "3"}
+
+
+# ========================= Test charge_quota ========================
+
+
+@pytest.mark.asyncio
+async def test_charge_quota():
+    with patch(
+        "app.limits.quota", AsyncMock(return_value=0)
+    ) as mock_quota, patch("app.limits.today", return_value=("day", 100)):
+        await charge_quota("user", images=3, upload_bytes=2048)
+    kwargs = mock_quota.call_args.kwargs
+    assert kwargs["keys"] == [
+        "quota:user:images:day",
+        "quota:user:upload_bytes:day",
+    ]
+    ttl, images, upload_bytes, *limits = kwargs["args"]
+    assert (ttl, images, upload_bytes) == (100 + QUOTA_GRACE, 3, 2048)
+    assert len(limits) == 2
+
+
+@pytest.mark.asyncio
+async def test_charge_quota_exceeded():
+    with patch("app.limits.quota", AsyncMock(return_value=2)), patch(
+        "app.limits.today", return_value=("day", 3600)
+    ):
+        with pytest.raises(HTTPException) as e:
+            await charge_quota("user", images=3, upload_bytes=2048)
+    assert e.value.status_code == 429
+    assert "upload bytes" in e.value.detail
+    assert e.value.headers == {"Retry-After": "3600"}
+
+
+# ======================== Test limit_downloads ======================
+
+
+@pytest.mark.asyncio
+async def test_limit_downloads():
+    user = MagicMock(id="user")
+    with patch("app.limits.take_token") as mock_take, patch(
+        "app.limits.charge_quota"
+    ) as mock_charge:
+        assert await limit_downloads(user) is user
+    mock_take.assert_awaited_once_with("user", "download")
+    mock_charge.assert_awaited_once_with("user", download_bytes=0)
+
+
+# ============================ Test metered ==========================
+
+
+@pytest.mark.asyncio
+async def test_metered():
+    async def chunks():
+        yield b"abc"
+        yield b"de"
+        raise ConnectionResetError
+
+    with patch("app.limits.record_download") as mock_record:
+        received = []
+        with pytest.raises(ConnectionResetError):
+            async for chunk in metered("user", chunks()):
+                received.append(chunk)
+    assert received == [b"abc", b"de"]
+    mock_record.assert_awaited_once_with("user", 5)
+
+
+# ============================= Test usage ===========================
+
+
+@pytest.mark.asyncio
+async def test_usage():
+    client = MagicMock()
+    client.time = AsyncMock(return_value=(1000, 500_000))
+    client.hmget = AsyncMock(side_effect=[[b"4", b"998.5"], [None, None]])
+    client.mget = AsyncMock(return_value=[b"12", None, b"4096"])
+    with patch("app.limits.redis_client", client), patch(
+        "app.limits.limit_settings.UPLOAD_RATE", 1.0
+    ), patch("app.limits.limit_settings.UPLOAD_BURST", 20):
+        result = await usage("user")
+    assert result["rates"]["upload"]["tokens"] == 6.0
+    assert result["rates"]["download"]["tokens"] == (
+        result["rates"]["download"]["burst"]
+    )
+    assert result["quotas"]["images"]["used"] == 12
+    assert result["quotas"]["upload_bytes"]["used"] == 0
+    assert result["quotas"]["download_bytes"]["used"] == 4096
@@ -0,0 +1,215 @@
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from app.models import (
+    Base,
+    DimensionRollup,
+    ImageRollup,
+    ImageTask,
+    RollupWatermark,
+    SizeRollup,
+    StageRollup,
+    StageTiming,
+    Stats,
+    User,
+)
+from app.rollups import DURATION_BUCKETS, SIZE_BUCKETS, WATERMARK, roll_up
+
+START = datetime(2026, 1, 1)
+
+
+@pytest.fixture
+def session():
+    """A database of its own, as rollups count every row in it."""
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as session:
+        yield session
+    engine.dispose()
+
+
+@pytest.fixture
+def user(session):
+    user = User(
+        id=uuid4(),
+        email=f"{uuid4().hex}@example.com",
+        password="securepassword",
+        first_name="Jane",
+        last_name="Doe",
+    )
+    session.add(user)
+    session.commit()
+    return user
+
+
+def add_image(
+    session,
+    user,
+    created_at: datetime,
+    transform: str = "rotate:90",
+    size: int = 1000,
+    deduplicated: bool = False,
+    seed: int | None = None,
+) -> None:
+    image_task = ImageTask(
+        id=uuid4(),
+        task_id=uuid4(),
+        user_id=user.id,
+        img_link=f"{uuid4().hex}.png",
+        transform=transform,
+        deduplicated=deduplicated,
+        seed=seed,
+        created_at=created_at,
+    )
+    session.add(image_task)
+    session.add(
+        Stats(
+            id=uuid4(),
+            image_id=image_task.id,
+            width=10,
+            height=20,
+            size=size,
+            processing_time=0.5,
+        )
+    )
+    session.add(
+        StageTiming(
+            task_id=image_task.task_id,
+            stage="decode",
+            duration=0.002,
+            created_at=created_at,
+        )
+    )
+    session.commit()
+
+
+def rows(session, model) -> list[dict]:
+    return [
+        {
+            column.key: getattr(row, column.key)
+            for column in model.__table__.columns
+        }
+        for row in session.scalars(
+            select(model).order_by(*model.__table__.primary_key)
+        )
+    ]
+
+
+# ============================ Test roll_up ==========================
+
+
+def test_roll_up_without_rows(session):
+    assert not roll_up(session, START)
+    assert session.get(RollupWatermark, WATERMARK) is None
+
+
+def test_roll_up(session, user):
+    add_image(session, user, START + timedelta(seconds=10), "original")
+    add_image(
+        session,
+        user,
+        START + timedelta(seconds=50),
+        "original",
+        deduplicated=True,
+    )
+    add_image(session, user, START + timedelta(minutes=1), size=5000)
+    add_image(session, user, START + timedelta(minutes=1), seed=7)
+
+    assert roll_up(session, START + timedelta(minutes=10))
+
+    assert rows(session, ImageRollup) == [
+        {
+            "minute": START,
+            "kind": "original",
+            "images": 2,
+            "deduplicated": 1,
+            "size": 2000,
+            "processing_time": 1.0,
+        },
+        {
+            "minute": START + timedelta(minutes=1),
+            "kind": "output",
+            "images": 1,
+            "deduplicated": 0,
+            "size": 5000,
+            "processing_time": 0.5,
+        },
+        {
+            "minute": START + timedelta(minutes=1),
+            "kind": "variant",
+            "images": 1,
+            "deduplicated": 0,
+            "size": 1000,
+            "processing_time": 0.5,
+        },
+    ]
+    assert rows(session, SizeRollup) == [
+        {"minute": START, "bucket": 1024, "images": 2},
+        {"minute": START + timedelta(minutes=1), "bucket": 1024, "images": 1},
+        {"minute": START + timedelta(minutes=1), "bucket": 8192, "images": 1},
+    ]
+    assert [row["images"] for row in rows(session, DimensionRollup)] == [2, 2]
+    stages = rows(session, StageRollup)
+    assert [(row["count"], row["bucket"]) for row in stages] == [
+        (2, 2048),
+        (2, 2048),
+    ]
+    assert stages[0]["duration"] == pytest.approx(0.004)
+    # The rows up to ROLLUP_LAG before now are in the rollups
+    assert session.get(RollupWatermark, WATERMARK).watermark == START + (
+        timedelta(minutes=8)
+    )
+
+
+def test_roll_up_is_incremental(session, user):
+    add_image(session, user, START)
+    assert roll_up(session, START + timedelta(minutes=5))
+    assert not roll_up(session, START + timedelta(minutes=5))
+
+    # Rows of the same minutes after the watermark add to the rollups,
+    # without counting the rolled up ones again
+    add_image(session, user, START + timedelta(minutes=3))
+    add_image(session, user, START + timedelta(minutes=3, seconds=30))
+    assert roll_up(session, START + timedelta(minutes=6))
+
+    assert [
+        (row["minute"], row["images"]) for row in rows(session, ImageRollup)
+    ] == [(START, 1), (START + timedelta(minutes=3), 2)]
+    assert session.scalar(select(func.sum(StageRollup.count))) == 3
+
+
+def test_roll_up_window(session, user, monkeypatch):
+    monkeypatch.setattr("app.rollups.celery_settings.ROLLUP_WINDOW", 60 * 60)
+    for hour in range(3):
+        add_image(session, user, START + timedelta(hours=hour))
+
+    steps = 0
+    while roll_up(session, START + timedelta(days=1)):
+        steps += 1
+
+    assert steps == 24
+    assert session.scalar(select(func.sum(ImageRollup.images))) == 3
+
+
+def test_roll_up_lag(session, user):
+    add_image(session, user, START + timedelta(seconds=30))
+
+    # The minute of the row is not yet ROLLUP_LAG in the past
+    assert not roll_up(session, START + timedelta(minutes=2))
+    assert rows(session, ImageRollup) == []
+
+
+def test_buckets():
+    assert SIZE_BUCKETS == sorted(SIZE_BUCKETS)
+    assert SIZE_BUCKETS[0] == 1024
+    assert DURATION_BUCKETS[0] == 1
+    # Above a few microseconds, where bounds are rounded to whole ones,
+    # neighbouring bounds are about a half power of 2 apart
+    assert all(
+        upper / lower <= 1.5
+        for lower, upper in zip(DURATION_BUCKETS[4:], DURATION_BUCKETS[5:])
+    )
@@ -0,0 +1,98 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.scheduling import (
+    BACKLOG_TTL,
+    queue_keys,
+    record_drained,
+    release_task,
+    reserve_priorities,
+    task_priority,
+    upload_lane,
+)
+
+# ========================== Test upload_lane ========================
+
+
+def test_upload_lane():
+    with patch("app.scheduling.celery_settings.INTERACTIVE_UPLOADS", 10):
+        assert upload_lane(None, 1) == "interactive"
+        assert upload_lane(None, 10) == "interactive"
+        assert upload_lane(None, 11) == "bulk"
+        assert upload_lane("interactive", 500) == "interactive"
+        assert upload_lane("bulk", 1) == "bulk"
+
+
+# ========================= Test task_priority =======================
+
+
+@pytest.mark.parametrize(
+    "lane, position, priority",
+    [
+        ("interactive", 0, 0),
+        ("interactive", 7, 0),
+        ("interactive", 8, 1),
+        ("interactive", 16, 2),
+        ("interactive", 31, 2),
+        ("interactive", 32, 3),
+        ("interactive", 64, 4),
+        ("interactive", 50_000, 4),
+        ("bulk", 0, 5),
+        ("bulk", 50_000, 9),
+    ],
+)
+def test_task_priority(lane, position, priority):
+    with patch("app.scheduling.celery_settings.FAIR_SHARE", 8):
+        assert task_priority(lane, position) == priority
+
+
+# ======================= Test reserve_priorities ====================
+
+
+def test_reserve_priorities():
+    client = MagicMock()
+    pipeline = client.pipeline.return_value.__enter__.return_value
+    pipeline.execute.return_value = [10, True]
+
+    with patch("app.scheduling.celery_settings.FAIR_SHARE", 8):
+        priorities = reserve_priorities(client, "user", "interactive", 3)
+
+    assert priorities == [0, 1, 1]
+    pipeline.incrby.assert_called_once_with("backlog:user", 3)
+    pipeline.expire.assert_called_once_with("backlog:user", BACKLOG_TTL)
+
+
+# ========================= Test release_task ========================
+
+
+def test_release_task():
+    client = MagicMock()
+    client.decr.return_value = 4
+    release_task(client, "user")
+    client.decr.assert_called_once_with("backlog:user")
+    client.delete.assert_not_called()
+
+    client.decr.return_value = -1
+    release_task(client, "user")
+    client.delete.assert_called_once_with("backlog:user")
+
+
+# ========================== Test queue_keys =========================
+
+
+def test_queue_keys():
+    keys = queue_keys("large")
+    assert keys[:3] == ["large", "large:1", "large:2"]
+    assert len(keys) == 10
+
+
+# ======================== Test record_drained =======================
+
+
+def test_record_drained():
+    client = MagicMock()
+    pipeline = client.pipeline.return_value.__enter__.return_value
+    record_drained(client, "small", 120.5)
+    pipeline.incr.assert_called_once_with("drained:small:2")
+    pipeline.execute.assert_called_once()
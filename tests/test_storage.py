@@ -0,0 +1,199 @@
+from io import BytesIO
+from unittest.mock import MagicMock, create_autospec, patch
+
+import pytest
+from minio import Minio
+from minio.error import S3Error
+
+from app.storage import (
+    HashingReader,
+    LocalStorage,
+    MemoryStorage,
+    MinioStorage,
+    ObjectNotFoundError,
+)
+
+
+@pytest.fixture(params=["memory", "local"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        storage = MemoryStorage(concurrency=2)
+    else:
+        storage = LocalStorage(root=str(tmp_path), concurrency=2)
+    storage.bootstrap()
+    return storage
+
+
+# ========================= Test put / get ==========================
+
+
+def test_put_get(storage):
+    result = storage.put("images", "image.png", BytesIO(b"file content"))
+    assert result == "images/image.png"
+    assert storage.get("images", "image.png") == b"file content"
+    assert storage.stat("images", "image.png") == 12
+
+
+def test_get_missing(storage):
+    with pytest.raises(ObjectNotFoundError):
+        storage.get("images", "missing.png")
+    assert storage.stat("images", "missing.png") is None
+
+
+def test_delete(storage):
+    storage.put("images", "image.png", BytesIO(b"file content"))
+    storage.delete("images", "image.png")
+    assert storage.stat("images", "image.png") is None
+
+
+def test_stream(storage):
+    storage.put("images", "image.png", BytesIO(b"file content"))
+    chunks = list(storage.stream("images", "image.png", chunk_size=5))
+    assert chunks == [b"file ", b"conte", b"nt"]
+
+
+def test_local_storage_rejects_traversal(tmp_path):
+    storage = LocalStorage(root=str(tmp_path))
+    with pytest.raises(ValueError):
+        storage.put("images", "../escape.png", BytesIO(b"file content"))
+
+
+# ========================= Test multipart ==========================
+
+
+def test_multipart(storage):
+    upload_id = storage.create_multipart("images", "large.png")
+    etags = {
+        number: storage.upload_part(
+            "images", "large.png", upload_id, number, data
+        )
+        for number, data in ((2, b"second "), (1, b"first "), (3, b"third"))
+    }
+    result = storage.complete_multipart(
+        "images", "large.png", upload_id, list(etags.items())
+    )
+    assert result == "images/large.png"
+    assert storage.get("images", "large.png") == b"first second third"
+
+
+def test_multipart_part_reupload(storage):
+    upload_id = storage.create_multipart("images", "large.png")
+    storage.upload_part("images", "large.png", upload_id, 1, b"broken")
+    etag = storage.upload_part("images", "large.png", upload_id, 1, b"fixed")
+    storage.complete_multipart("images", "large.png", upload_id, [(1, etag)])
+    assert storage.get("images", "large.png") == b"fixed"
+
+
+def test_multipart_abort(storage):
+    upload_id = storage.create_multipart("images", "large.png")
+    storage.upload_part("images", "large.png", upload_id, 1, b"data")
+    storage.abort_multipart("images", "large.png", upload_id)
+    assert storage.stat("images", "large.png") is None
+
+
+# ======================== Test async methods ========================
+
+
+@pytest.mark.asyncio
+async def test_async_methods(storage):
+    await storage.aput("images", "image.png", BytesIO(b"file content"))
+    assert await storage.aget("images", "image.png") == b"file content"
+    assert await storage.astat("images", "image.png") == 12
+    chunks = [
+        chunk
+        async for chunk in storage.astream("images", "image.png", chunk_size=8)
+    ]
+    assert chunks == [b"file con", b"tent"]
+    await storage.adelete("images", "image.png")
+    assert await storage.astat("images", "image.png") is None
+
+
+# ========================= Test HashingReader =======================
+
+
+def test_hashing_reader():
+    reader = HashingReader(BytesIO(b"file content"))
+    reader.read(4)
+    reader.seek(0)
+    while reader.read(5):
+        pass
+    assert reader.hexdigest() == (
+        "e0ac3601005dfa1864f5392aabaf7d898b1b5bab854f1acb4491bcd806b76b0c"
+    )
+
+
+# ========================= Test MinioStorage ========================
+
+
+def s3_error(code):
+    return S3Error(MagicMock(), code, "message", "resource", "request", "host")
+
+
+@pytest.fixture
+def minio_storage():
+    with patch("app.storage.Minio") as mock_minio:
+        storage = MinioStorage(concurrency=2)
+        storage.client = MagicMock()
+        storage.presign_client = mock_minio.return_value
+        yield storage
+
+
+def test_minio_put_does_not_check_bucket(minio_storage):
+    file = BytesIO(b"file content")
+    result = minio_storage.put("images", "image.png", file, 12)
+    minio_storage.client.bucket_exists.assert_not_called()
+    minio_storage.client.put_object.assert_called_once_with(
+        "images", "image.png", file, length=12, part_size=10 * 1024 * 1024
+    )
+    assert result == "images/image.png"
+
+
+def test_minio_bootstrap(minio_storage):
+    minio_storage.client.bucket_exists.return_value = False
+    minio_storage.bootstrap()
+    minio_storage.client.make_bucket.assert_called_once_with("images")
+
+
+def test_minio_stat(minio_storage):
+    minio_storage.client.stat_object.return_value = MagicMock(size=12)
+    assert minio_storage.stat("images", "image.png") == 12
+    minio_storage.client.stat_object.side_effect = s3_error("NoSuchKey")
+    assert minio_storage.stat("images", "image.png") is None
+    minio_storage.client.stat_object.side_effect = s3_error("AccessDenied")
+    with pytest.raises(S3Error):
+        minio_storage.stat("images", "image.png")
+
+
+def test_minio_get(minio_storage):
+    response = minio_storage.client.get_object.return_value
+    response.read.return_value = b"file content"
+    assert minio_storage.get("images", "image.png") == b"file content"
+    response.release_conn.assert_called_once()
+    minio_storage.client.get_object.side_effect = s3_error("NoSuchKey")
+    with pytest.raises(ObjectNotFoundError):
+        minio_storage.get("images", "image.png")
+
+
+def test_minio_presign(minio_storage):
+    minio_storage.presign_client.presigned_put_object.return_value = "url"
+    assert minio_storage.presign("images", "image.png") == "url"
+
+
+def test_minio_multipart(minio_storage):
+    # Calls to the private methods are checked against their signatures
+    client = minio_storage.client = create_autospec(Minio, instance=True)
+    client._create_multipart_upload.return_value = "upload-id"
+    client._upload_part.return_value = "etag"
+    upload_id = minio_storage.create_multipart("images", "large.png")
+    etag = minio_storage.upload_part(
+        "images", "large.png", upload_id, 1, b"data"
+    )
+    result = minio_storage.complete_multipart(
+        "images", "large.png", upload_id, [(1, etag)]
+    )
+    client._upload_part.assert_called_once_with(
+        "images", "large.png", b"data", None, "upload-id", 1
+    )
+    parts = client._complete_multipart_upload.call_args.args[3]
+    assert [(part.part_number, part.etag) for part in parts] == [(1, "etag")]
+    assert result == "images/large.png"
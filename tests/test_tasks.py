@@ -1,16 +1,50 @@
+import hashlib
+import threading
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+from uuid import uuid4
+
 import pytest
+from PIL import Image
 from sqlalchemy.exc import SQLAlchemyError
 
-from app.tasks import augmentation
+from app.batching import render_batch
+from app.derivatives import derivative_name
+from app.models import ImageTask, StageTiming, Stats, User
+from app.schemas import OutputSpec, Resize, Rotate
+from app.tasks import (
+    TRANSIENT_ERRORS,
+    augment,
+    augmentation,
+    augmentation_batch,
+    find_derivatives,
+    recording,
+    OutputRecorder,
+    render_derivative,
+    run_branches,
+    transform_keys,
+)
+from app.transforms import DecodePlan, default_outputs
+
+
+def derived_paths(data: bytes, outputs: list[OutputSpec]) -> dict:
+    """Storage paths the outputs of a PNG image are rendered to."""
+    content_hash = hashlib.sha256(data).hexdigest()
+    return {
+        output.name: "test_bucket/"
+        + derivative_name(content_hash, output, "PNG")
+        for output in outputs
+    }
 
 
 # ========================= Test augmentation =======================
 @pytest.mark.asyncio
 def test_augmentation(
-    mock_get_object,
-    mock_upload_to_minio,
+    image_bytes,
+    mock_storage_get,
+    mock_storage_put,
     mock_sync_sessionmaker,
-    mock_db_session,
+    mock_recorder,
 ):
     # Define the input parameters for the augmentation task
     minio_path = "test_bucket/test_image.png"
@@ -27,24 +61,132 @@ def test_augmentation(
         minio_path=minio_path, filenames=filenames, user_id=user_id, degrees=90
     )
 
-    # Assert: Verify that the result paths match the expected mock URLs
-    assert result["rotated_image_path"] == "test_bucket/rotated_image.png"
-    assert result["gray_image_path"] == "test_bucket/gray_image.png"
-    assert result["scaled_image_path"] == "test_bucket/scaled_image.png"
+    # Assert: Verify that the outputs were stored under the names of
+    # their derivatives
+    paths = derived_paths(image_bytes, default_outputs(90))
+    assert result["rotated_image_path"] == paths["rotated"]
+    assert result["gray_image_path"] == paths["gray"]
+    assert result["scaled_image_path"] == paths["scaled"]
+
+    # Verify that the original was downloaded from storage
+    mock_storage_get.assert_called_once_with("test_bucket", "test_image.png")
+
+    # Verify that storage put was called for each transformation
+    assert mock_storage_put.call_count == 3
+
+    # Verify that the rows of the original and the 3 transformations
+    # were written at once, under the names they were requested as
+    assert len(mock_recorder.rows) == 4
+    assert [image_task["output"] for image_task, _ in mock_recorder.rows] == [
+        "original_image.png",
+        "rotated_image.png",
+        "gray_image.png",
+        "scaled_image.png",
+    ]
+    mock_recorder.assert_called_once()
+
+
+# ===================== Test augmentation_outputs ===================
+
+
+def test_augmentation_outputs(
+    image_bytes,
+    mock_storage_get,
+    mock_storage_put,
+    mock_sync_sessionmaker,
+    mock_recorder,
+):
+    outputs = [
+        {
+            "name": "thumb",
+            "operations": [
+                {"op": "grayscale"},
+                {"op": "resize", "width": 50},
+            ],
+            "format": "WEBP",
+        }
+    ]
+    filenames = {"original": "image.png", "thumb": "image_thumb.webp"}
+
+    result = augmentation(
+        minio_path="test_bucket/test_image.png",
+        filenames=filenames,
+        user_id="test_user_id",
+        outputs=outputs,
+    )
+
+    output = OutputSpec.model_validate(outputs[0])
+    path = derived_paths(image_bytes, [output])["thumb"]
+    assert result == {"thumb_image_path": path}
+    assert path.endswith(".webp")
+    mock_storage_put.assert_called_once()
+    data = mock_storage_put.call_args.args[2]
+    with Image.open(data) as image:
+        assert image.format == "WEBP"
+        assert image.width == 50
+    image_task, _ = mock_recorder.rows[1]
+    assert image_task["transform"] == "grayscale|resize:50x|format:WEBP"
+
+
+def test_augmentation_outputs_encoding(
+    mock_storage_get,
+    mock_storage_put,
+    mock_sync_sessionmaker,
+    mock_recorder,
+):
+    outputs = [
+        {
+            "name": "web",
+            "operations": [],
+            "format": "JPEG",
+            "encoding": {"preset": "small", "quality": 60},
+        }
+    ]
 
-    # Verify that the MinIO get_object was called correctly
-    mock_get_object.assert_called_once_with(
-        bucket_name="test_bucket", object_name="test_image.png"
+    augmentation(
+        minio_path="test_bucket/test_image.png",
+        filenames={"original": "image.png", "web": "image_web.jpg"},
+        user_id="test_user_id",
+        outputs=outputs,
     )
 
-    # Verify that upload_to_minio was called for each transformation
-    assert mock_upload_to_minio.call_count == 3
+    data = mock_storage_put.call_args.args[2]
+    with Image.open(data) as image:
+        assert image.info.get("progressive")
+    image_task, stats = mock_recorder.rows[1]
+    assert image_task["transform"].endswith("quality=60,strip_metadata=1")
+    assert stats["size"] == data.getbuffer().nbytes
 
-    # Verify that database interactions occurred
-    assert (
-        mock_db_session.add.call_count == 8
-    )  # 2 for the original image, 6 for the transformations
-    mock_db_session.commit.assert_called_once()
+
+# ===================== Test augmentation_variants ==================
+
+
+def test_augmentation_variants(
+    mock_storage_get,
+    mock_storage_put,
+    mock_sync_sessionmaker,
+    mock_recorder,
+):
+    filenames = {"original": "image.png"}
+    filenames.update(
+        (f"variant_00{index}", f"image_variant_00{index}.png")
+        for index in range(3)
+    )
+
+    result = augmentation(
+        minio_path="test_bucket/test_image.png",
+        filenames=filenames,
+        user_id="test_user_id",
+        image_info={"width": 100, "height": 100},
+        variants={"count": 3, "seed": 42, "policy": {"noise": 5}},
+    )
+
+    assert len(result) == 3
+    mock_storage_get.assert_called_once()
+    assert mock_storage_put.call_count == 3
+    variants = [image_task for image_task, _ in mock_recorder.rows][1:]
+    assert len({row["seed"] for row in variants}) == 3
+    assert all(set(row["params"]) >= {"crop", "rotation"} for row in variants)
 
 
 # # =============== Test augmentation_exception_handling =============
@@ -52,13 +194,13 @@ def test_augmentation(
 
 @pytest.mark.asyncio
 def test_augmentation_exception_handling(
-    mock_get_object,
-    mock_upload_to_minio,
+    mock_storage_get,
+    mock_storage_put,
     mock_sync_sessionmaker,
     mock_db_session,
 ):
-    # Simulate an exception being raised when adding to the database
-    mock_db_session.add.side_effect = SQLAlchemyError(
+    # Simulate an exception being raised when writing to the database
+    mock_db_session.scalars.side_effect = SQLAlchemyError(
         "Simulated database error"
     )
 
@@ -81,6 +223,546 @@ def test_augmentation_exception_handling(
             degrees=90,
         )
 
-    mock_db_session.rollback.assert_called_once()
+    mock_db_session.rollback.assert_called()
     mock_db_session.commit.assert_not_called()
     mock_sync_sessionmaker.return_value.__exit__.assert_called_once()
+
+
+# ===================== Test augmentation_deduplicated ===============
+
+
+def test_augmentation_deduplicated(
+    mock_storage_get,
+    mock_storage_put,
+    mock_sync_sessionmaker,
+    mock_db_session,
+    mock_recorder,
+):
+    rows = [
+        (
+            ImageTask(img_link=f"first_{transform}.png", transform=transform),
+            Stats(width=10, height=20, size=30),
+        )
+        for transform in transform_keys(default_outputs(90)).values()
+    ]
+    mock_db_session.execute.return_value.all.return_value = rows
+    filenames = {
+        "original": "original_image.png",
+        "rotated": "rotated_image.png",
+        "gray": "gray_image.png",
+        "scaled": "scaled_image.png",
+    }
+
+    result = augmentation(
+        minio_path="test_bucket/test_image.png",
+        filenames=filenames,
+        user_id="test_user_id",
+        content_hash="hash",
+    )
+
+    assert result["rotated_image_path"] == "test_bucket/first_rotate:90.png"
+    assert result["gray_image_path"] == "test_bucket/first_grayscale.png"
+    assert result["scaled_image_path"] == "test_bucket/first_scale:0.5.png"
+    mock_storage_get.assert_not_called()
+    mock_storage_put.assert_not_called()
+    image_tasks = [image_task for image_task, _ in mock_recorder.rows]
+    assert len(image_tasks) == 4
+    assert all(row["deduplicated"] for row in image_tasks)
+    assert image_tasks[0]["img_link"] == "original_image.png"
+    mock_recorder.assert_called_once()
+
+
+# ======================== Test find_derivatives =====================
+
+
+def test_find_derivatives(session):
+    user = User(
+        id=uuid4(),
+        email="dedup_user@example.com",
+        password="securepassword",
+        first_name="Jane",
+        last_name="Doe",
+    )
+    session.add(user)
+    session.flush()
+    for transform, deduplicated, img_link in (
+        ("original", False, "cat_original.png"),
+        ("rotate:90", False, f"derived/{'a' * 64}/rotate.png"),
+        ("rotate:90", True, f"derived/{'a' * 64}/rotate.png"),
+        ("rotate:180", False, f"derived/{'a' * 64}/rotate180.png"),
+        # Named after the upload, so a later upload may overwrite it
+        ("grayscale", False, "cat_gray.png"),
+    ):
+        image_task = ImageTask(
+            id=uuid4(),
+            task_id=uuid4(),
+            user_id=user.id,
+            img_link=img_link,
+            content_hash="a" * 64,
+            transform=transform,
+            deduplicated=deduplicated,
+        )
+        session.add(image_task)
+        session.flush()
+        session.add(
+            Stats(
+                id=uuid4(),
+                image_id=image_task.id,
+                width=1,
+                height=1,
+                size=1,
+                processing_time=0,
+            )
+        )
+    session.commit()
+
+    result = find_derivatives(
+        session, "a" * 64, transform_keys(default_outputs(90))
+    )
+
+    assert set(result) == {"original", "rotated"}
+    assert not result["rotated"][0].deduplicated
+    assert result["rotated"][0].img_link.startswith("derived/")
+
+
+# ======================= Test augmentation retries ==================
+
+
+def test_augmentation_retries_transient_errors():
+    for task in (augmentation, augmentation_batch):
+        assert task.autoretry_for == TRANSIENT_ERRORS
+        assert task.retry_backoff
+        assert task.retry_jitter
+
+
+def test_augment_resumes_after_failure(
+    session, mock_storage_get, mock_storage_put
+):
+    user = User(
+        id=uuid4(),
+        email="resume_user@example.com",
+        password="securepassword",
+        first_name="Jane",
+        last_name="Doe",
+    )
+    session.add(user)
+    session.commit()
+    # Content no other test rendered, so no output is deduplicated
+    image_bytes = BytesIO()
+    Image.new("RGB", (64, 48), color=(4, 5, 6)).save(image_bytes, "PNG")
+    mock_storage_get.return_value = image_bytes.getvalue()
+    paths = derived_paths(image_bytes.getvalue(), default_outputs(90))
+    task_id = uuid4()
+    filenames = {
+        "original": "resume_original.png",
+        "rotated": "resume_rotated.png",
+        "gray": "resume_gray.png",
+        "scaled": "resume_scaled.png",
+    }
+
+    def flaky_put(bucket_name, object_name, data, length=-1):
+        if f"{bucket_name}/{object_name}" == paths["gray"]:
+            raise ConnectionError("Simulated storage error")
+        return f"{bucket_name}/{object_name}"
+
+    mock_storage_put.side_effect = flaky_put
+    with pytest.raises(ConnectionError), recording(session) as recorder:
+        augment(
+            session,
+            recorder,
+            task_id,
+            user.id,
+            "test_bucket/test_image.png",
+            filenames,
+        )
+    recorded = session.query(ImageTask).filter_by(task_id=task_id).all()
+    assert {row.output for row in recorded} == {
+        "resume_original.png",
+        "resume_rotated.png",
+    }
+
+    # The retry renders and records only the outputs left
+    mock_storage_put.reset_mock(side_effect=True)
+    mock_storage_put.side_effect = (
+        lambda bucket_name, object_name, data, length=-1: (
+            f"{bucket_name}/{object_name}"
+        )
+    )
+    with recording(session) as recorder:
+        result = augment(
+            session,
+            recorder,
+            task_id,
+            user.id,
+            "test_bucket/test_image.png",
+            filenames,
+        )
+    assert result["rotated_image_path"] == paths["rotated"]
+    assert result["gray_image_path"] == paths["gray"]
+    assert {
+        f"{call.args[0]}/{call.args[1]}"
+        for call in mock_storage_put.call_args_list
+    } == {paths["gray"], paths["scaled"]}
+    recorded = session.query(ImageTask).filter_by(task_id=task_id).all()
+    assert len(recorded) == 4
+    assert all(row.stats is not None for row in recorded)
+
+    # Once every output is recorded, nothing is downloaded again
+    mock_storage_get.reset_mock()
+    mock_storage_put.reset_mock()
+    with recording(session) as recorder:
+        augment(
+            session,
+            recorder,
+            task_id,
+            user.id,
+            "test_bucket/test_image.png",
+            filenames,
+        )
+    mock_storage_get.assert_not_called()
+    mock_storage_put.assert_not_called()
+
+
+def test_augment_records_stage_timings(
+    session, mock_storage_get, mock_storage_put
+):
+    user = User(
+        id=uuid4(),
+        email="timing_user@example.com",
+        password="securepassword",
+        first_name="Jane",
+        last_name="Doe",
+    )
+    session.add(user)
+    session.commit()
+    # Content no other test rendered, so no output is deduplicated
+    image_bytes = BytesIO()
+    Image.new("RGB", (64, 48), color=(1, 2, 3)).save(image_bytes, "PNG")
+    mock_storage_get.return_value = image_bytes.getvalue()
+    task_id = uuid4()
+    filenames = {
+        "original": "timing_original.png",
+        "rotated": "timing_rotated.png",
+        "gray": "timing_gray.png",
+        "scaled": "timing_scaled.png",
+    }
+
+    with recording(session, task_id) as recorder:
+        augment(
+            session,
+            recorder,
+            task_id,
+            user.id,
+            "test_bucket/test_image.png",
+            filenames,
+        )
+
+    timings = session.query(StageTiming).filter_by(task_id=task_id).all()
+    stages = {(row.stage, row.output) for row in timings}
+    assert {
+        ("download", None),
+        ("decode", None),
+        ("transform:rotate", None),
+        ("transform:grayscale", None),
+        ("encode", "gray"),
+        ("upload", "scaled"),
+        ("db_write", None),
+    } <= stages
+    assert all(row.duration >= 0 for row in timings)
+    # Sub-millisecond timings are kept
+    assert any(0 < row.duration < 0.001 for row in timings)
+
+
+def test_output_recorder_skips_duplicates(session):
+    user = User(
+        id=uuid4(),
+        email="duplicate_user@example.com",
+        password="securepassword",
+        first_name="Jane",
+        last_name="Doe",
+    )
+    session.add(user)
+    session.commit()
+    task_id = uuid4()
+    recorder = OutputRecorder(session)
+    # Twice in one write, and once more in a later one
+    for count in (2, 1):
+        for _ in range(count):
+            recorder.add(
+                {
+                    "task_id": task_id,
+                    "user_id": user.id,
+                    "img_link": "duplicate.png",
+                    "output": "duplicate.png",
+                },
+                width=1,
+                height=1,
+                size=1,
+                processing_time=0,
+            )
+        recorder.flush()
+    assert session.query(ImageTask).filter_by(task_id=task_id).count() == 1
+    assert session.query(Stats).join(ImageTask).filter(
+        ImageTask.task_id == task_id
+    ).count() == 1
+
+
+# ===================== Test augmentation_too_large ==================
+
+
+def test_augmentation_rejects_sniffed_bomb(mock_storage_get):
+    with pytest.raises(Image.DecompressionBombError):
+        augmentation(
+            minio_path="test_bucket/test_image.png",
+            filenames={},
+            user_id="test_user_id",
+            image_info={"width": 100_000, "height": 100_000},
+        )
+    mock_storage_get.assert_not_called()
+
+
+# ===================== Test augmentation_tiled ======================
+
+
+def test_augmentation_tiled(
+    image_bytes,
+    mock_storage_get,
+    mock_storage_put,
+    mock_sync_sessionmaker,
+    mock_recorder,
+):
+    filenames = {
+        "original": "original_image.png",
+        "rotated": "rotated_image.png",
+        "gray": "gray_image.png",
+        "scaled": "scaled_image.png",
+    }
+
+    with patch("app.tasks.image_settings.TILED_PIXELS", 0):
+        result = augmentation(
+            minio_path="test_bucket/test_image.png",
+            filenames=filenames,
+            user_id="test_user_id",
+        )
+
+    paths = derived_paths(image_bytes, default_outputs(90))
+    assert result["scaled_image_path"] == paths["scaled"]
+    assert mock_storage_put.call_count == 3
+    for call in mock_storage_put.call_args_list:
+        _, _, data, length = call.args
+        assert len(data.read()) == length
+    assert len(mock_recorder.rows) == 4
+    mock_recorder.assert_called_once()
+
+
+def test_augmentation_tiled_above_memory_ceiling(
+    mock_storage_get, mock_storage_put, mock_sync_sessionmaker, mock_db_session
+):
+    with (
+        patch("app.tasks.image_settings.TILED_PIXELS", 0),
+        patch("app.tiling.image_settings.TASK_MEMORY", 1024),
+        pytest.raises(MemoryError),
+    ):
+        augmentation(
+            minio_path="test_bucket/test_image.png",
+            filenames={"original": "original_image.png"},
+            user_id="test_user_id",
+        )
+    mock_storage_put.assert_not_called()
+    mock_db_session.rollback.assert_called_once()
+
+
+def test_augmentation_above_memory_ceiling(
+    mock_storage_get, mock_storage_put, mock_sync_sessionmaker, mock_db_session
+):
+    # Below IMAGE_TILED_PIXELS, an upscale rotated by 45 degrees is still
+    # sized from its operations
+    outputs = [
+        {
+            "name": "large",
+            "operations": [
+                {"op": "resize", "width": 5000, "height": 5000},
+                {"op": "rotate", "degrees": 45},
+            ],
+        }
+    ]
+    with (
+        patch("app.tiling.image_settings.TASK_MEMORY", 256 * 1024**2),
+        pytest.raises(MemoryError),
+    ):
+        augmentation(
+            minio_path="test_bucket/test_image.png",
+            filenames={"original": "original_image.png"},
+            user_id="test_user_id",
+            outputs=outputs,
+        )
+    mock_storage_put.assert_not_called()
+    mock_db_session.rollback.assert_called_once()
+
+
+# ===================== Test augmentation_batch ======================
+
+
+def test_augmentation_batch(
+    image_bytes,
+    mock_storage_get,
+    mock_storage_put,
+    mock_sync_sessionmaker,
+    mock_recorder,
+):
+    uploads = [
+        {
+            "minio_path": f"test_bucket/{name}.png",
+            "filenames": {
+                "original": f"{name}_original.png",
+                "rotated": f"{name}_rotated.png",
+                "gray": f"{name}_gray.png",
+                "scaled": f"{name}_scaled.png",
+            },
+        }
+        for name in ("a", "b")
+    ]
+
+    with patch.object(DecodePlan, "execute") as mock_execute:
+        result = augmentation_batch(uploads=uploads, user_id="test_user_id")
+
+    paths = derived_paths(image_bytes, default_outputs(90))
+    assert result[1]["gray_image_path"] == paths["gray"]
+    assert mock_storage_get.call_count == 2
+    assert mock_storage_put.call_count == 6
+    # Both images were rendered by the batch engine
+    mock_execute.assert_not_called()
+    assert len(mock_recorder.rows) == 8
+    task_ids = {image_task["task_id"] for image_task, _ in mock_recorder.rows}
+    assert len(task_ids) == 1
+    # The rows of both images were written at once
+    mock_recorder.assert_called_once()
+
+
+def test_augmentation_batch_skips_finished_outputs(
+    mock_storage_get,
+    mock_storage_put,
+    mock_sync_sessionmaker,
+    mock_recorder,
+):
+    uploads = [
+        {
+            "minio_path": f"test_bucket/{name}.png",
+            "filenames": {
+                "original": f"{name}_original.png",
+                "rotated": f"{name}_rotated.png",
+                "gray": f"{name}_gray.png",
+                "scaled": f"{name}_scaled.png",
+            },
+        }
+        for name in ("a", "b", "c")
+    ]
+
+    def finished(session, task_id, filenames):
+        # Every output of c was recorded by an earlier attempt
+        if filenames["original"] != "c_original.png":
+            return {}
+        return {
+            name: MagicMock(img_link=filename)
+            for name, filename in filenames.items()
+        }
+
+    with (
+        patch("app.tasks.finished_outputs", side_effect=finished),
+        patch("app.tasks.render_batch", wraps=render_batch) as batch,
+    ):
+        result = augmentation_batch(uploads=uploads, user_id="test_user_id")
+
+    ((images, outputs), _) = batch.call_args
+    assert len(images) == len(outputs) == 2
+    assert mock_storage_get.call_count == 2
+    assert mock_storage_put.call_count == 6
+    assert result[2]["gray_image_path"] == "test_bucket/c_gray.png"
+    assert len(mock_recorder.rows) == 8
+
+
+# ========================= Test run_branches ========================
+
+
+def test_run_branches_keeps_order():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def branch(name):
+        # Both parts must be running at once to pass the barrier
+        barrier.wait()
+        yield name, None, 0.0
+
+    def finish(name, image, processing_time):
+        return name, threading.current_thread().name
+
+    results = list(
+        run_branches([lambda: branch("a"), lambda: branch("b")], finish)
+    )
+
+    assert [name for name, _ in results] == ["a", "b"]
+    assert all(thread.startswith("render") for _, thread in results)
+
+
+def test_run_branches_raises_errors():
+    def branch():
+        raise ValueError("Simulated render error")
+        yield
+
+    with pytest.raises(ValueError, match="Simulated render error"):
+        list(run_branches([branch], lambda *output: output))
+
+
+# ====================== Test render_derivative ======================
+
+
+def test_render_derivative(
+    memory_storage, image_bytes, mock_sync_sessionmaker, mock_recorder
+):
+    memory_storage.put("images", "image_original.png", BytesIO(image_bytes))
+    output = OutputSpec(
+        name="render", operations=[Resize(scale=0.5)], format="WEBP"
+    )
+    original = {
+        "task_id": uuid4(),
+        "user_id": uuid4(),
+        "img_link": "image_original.png",
+        "content_hash": "a" * 64,
+    }
+
+    render_derivative(original, output.model_dump(), "derived/render.webp")
+
+    data = memory_storage.get("images", "derived/render.webp")
+    with Image.open(BytesIO(data)) as image:
+        assert image.format == "WEBP"
+        assert image.size == (50, 50)
+    ((image_task, stats),) = mock_recorder.rows
+    assert image_task["transform"] == "scale:0.5|format:WEBP"
+    assert image_task["task_id"] == original["task_id"]
+    assert stats["size"] == len(data)
+
+    # A render saved meanwhile by another process is not done again
+    mock_recorder.rows.clear()
+    render_derivative(original, output.model_dump(), "derived/render.webp")
+    assert mock_recorder.rows == []
+
+
+def test_render_derivative_checks_memory(
+    memory_storage, image_bytes, mock_sync_sessionmaker, mock_recorder
+):
+    memory_storage.put("images", "image_original.png", BytesIO(image_bytes))
+    output = OutputSpec(name="render", operations=[Rotate(degrees=45)])
+    original = {
+        "task_id": uuid4(),
+        "user_id": uuid4(),
+        "img_link": "image_original.png",
+        "content_hash": "a" * 64,
+    }
+
+    with patch("app.tiling.image_settings.TASK_MEMORY", 1000):
+        with pytest.raises(MemoryError):
+            render_derivative(
+                original, output.model_dump(), "derived/render.png"
+            )
+
+    assert memory_storage.stat("images", "derived/render.png") is None
+    assert mock_recorder.rows == []
\ No newline at end of file
@@ -0,0 +1,323 @@
+import subprocess
+import sys
+import textwrap
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.schemas import OutputSpec
+from app.tiling import (
+    PNGWriter,
+    StripRenderer,
+    check_memory,
+    peak_memory,
+    render_tiled,
+    split_operations,
+    tiled_operations,
+)
+from app.transforms import apply, default_outputs, normalize
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def photo(size=(301, 207), mode="RGB") -> Image.Image:
+    image = Image.effect_noise((size[0] // 8, size[1] // 8), 64)
+    return image.convert(mode).resize(size, Image.Resampling.BICUBIC)
+
+
+def output(*operations: dict, image_format: str | None = None) -> OutputSpec:
+    return OutputSpec(
+        name="out", operations=list(operations), format=image_format
+    )
+
+
+def encoded(image: Image.Image, image_format: str = "PNG") -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+# ========================= Test StripRenderer ======================
+
+
+@pytest.mark.parametrize(
+    "operations",
+    [
+        [{"op": "rotate", "degrees": 90}],
+        [{"op": "rotate", "degrees": 180}],
+        [{"op": "rotate", "degrees": 270}],
+        [{"op": "flip", "direction": "horizontal"}],
+        [{"op": "flip", "direction": "vertical"}, {"op": "grayscale"}],
+        [
+            {"op": "crop", "left": 10, "top": 20, "right": 250, "bottom": 190},
+            {"op": "rotate", "degrees": 90},
+            {"op": "flip", "direction": "horizontal"},
+        ],
+    ],
+)
+def test_strips_match_whole_image(operations):
+    image = photo()
+    spec = output(*operations)
+    parts = split_operations(normalize(spec.operations))
+    renderer = StripRenderer(image.size, image.mode, *parts)
+    expected = image
+    for operation in normalize(spec.operations):
+        expected = apply(operation, expected)
+
+    with patch("app.tiling.STRIP_PIXELS", 1000):
+        strips = list(renderer.strips(image))
+
+    assert len(strips) > 1
+    assert renderer.size == expected.size
+    assert np.array_equal(
+        np.concatenate([np.asarray(strip) for strip in strips]),
+        np.asarray(expected),
+    )
+
+
+def test_strips_of_resize_match_whole_image():
+    image = photo()
+    spec = output({"op": "resize", "scale": 0.4}, {"op": "rotate", "degrees": 90})
+    parts = split_operations(normalize(spec.operations))
+    renderer = StripRenderer(image.size, image.mode, *parts)
+    expected = image
+    for operation in normalize(spec.operations):
+        expected = apply(operation, expected)
+
+    with patch("app.tiling.STRIP_PIXELS", 1000):
+        strips = list(renderer.strips(image))
+
+    difference = np.abs(
+        np.concatenate([np.asarray(strip) for strip in strips]).astype(int)
+        - np.asarray(expected)
+    )
+    assert difference.max() <= 1
+
+
+def test_strips_of_integer_downscale_match_whole_image():
+    image = photo()
+    spec = output(
+        {"op": "crop", "left": 3, "top": 5, "right": 290, "bottom": 200},
+        {"op": "resize", "scale": 1 / 3},
+    )
+    parts = split_operations(normalize(spec.operations))
+    renderer = StripRenderer(image.size, image.mode, *parts)
+    expected = image
+    for operation in normalize(spec.operations):
+        expected = apply(operation, expected)
+
+    with patch("app.tiling.STRIP_PIXELS", 1000):
+        strips = list(renderer.strips(image))
+
+    assert len(strips) > 1
+    assert np.array_equal(
+        np.concatenate([np.asarray(strip) for strip in strips]),
+        np.asarray(expected),
+    )
+
+
+def test_split_operations_rejects_non_strip_operations():
+    assert split_operations(normalize(output({"op": "blur"}).operations)) is None
+    assert (
+        split_operations(
+            normalize(output({"op": "color_jitter", "contrast": 1.5}).operations)
+        )
+        is None
+    )
+    assert (
+        split_operations(
+            normalize(output({"op": "rotate", "degrees": 45}).operations)
+        )
+        is None
+    )
+
+
+# =========================== Test PNGWriter ========================
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+def test_png_writer_round_trips(mode):
+    image = photo(mode=mode)
+    buffer = BytesIO()
+    writer = PNGWriter(buffer, image.size, mode, 6)
+    for top in range(0, image.height, 50):
+        writer.write(image.crop((0, top, image.width, top + 50)))
+    writer.close()
+
+    with Image.open(BytesIO(buffer.getvalue())) as decoded:
+        assert decoded.mode == mode
+        assert np.array_equal(np.asarray(decoded), np.asarray(image))
+
+
+# ========================= Test render_tiled =======================
+
+
+def test_render_tiled_default_outputs():
+    image = photo()
+    outputs = default_outputs()
+
+    rendered = {
+        name: (data, length, size)
+        for name, data, length, size, _ in render_tiled(encoded(image), outputs)
+    }
+
+    assert set(rendered) == {"rotated", "gray", "scaled"}
+    for spec in outputs:
+        data, length, size = rendered[spec.name]
+        expected = image
+        for operation in normalize(spec.operations):
+            expected = apply(operation, expected)
+        content = data.read()
+        assert len(content) == length
+        with Image.open(BytesIO(content)) as decoded:
+            assert decoded.size == size == expected.size
+            assert decoded.mode == expected.mode
+
+
+def test_render_tiled_contrast_matches_whole_image():
+    # A dark top half and a bright bottom half, so every strip has a mean
+    # of its own, far from the mean of the whole image
+    image = photo((120, 200))
+    image.paste(image.crop((0, 0, 120, 100)).point(lambda value: value // 4))
+    spec = output(
+        {"op": "color_jitter", "brightness": 1.2, "contrast": 1.5},
+        {"op": "rotate", "degrees": 90},
+    )
+    expected = image
+    for operation in normalize(spec.operations):
+        expected = apply(operation, expected)
+
+    with patch("app.tiling.STRIP_PIXELS", 1000):
+        ((_, data, _, size, _),) = render_tiled(encoded(image), [spec])
+
+    with Image.open(data) as decoded:
+        assert decoded.size == size == expected.size
+        assert np.array_equal(np.asarray(decoded), np.asarray(expected))
+
+
+def test_render_tiled_formats_and_fallback():
+    image = photo()
+    outputs = [
+        OutputSpec(
+            name="jpeg",
+            operations=[{"op": "grayscale"}],
+            format="JPEG",
+        ),
+        OutputSpec(name="blurred", operations=[{"op": "blur"}]),
+    ]
+
+    rendered = {
+        name: Image.open(data)
+        for name, data, *_ in render_tiled(encoded(image), outputs)
+    }
+
+    assert rendered["jpeg"].format == "JPEG"
+    assert rendered["jpeg"].mode == "L"
+    assert rendered["blurred"].format == "PNG"
+    assert rendered["blurred"].size == image.size
+
+
+# ========================= Test check_memory =======================
+
+
+def test_peak_memory_streams_png_outputs():
+    size = (20_000, 20_000)
+    source = size[0] * size[1] * 4
+    peak = peak_memory(size, "RGB", "PNG", default_outputs())
+    assert source < peak < source * 1.2
+
+    rotated = OutputSpec(
+        name="rotated", operations=[{"op": "rotate", "degrees": 90}]
+    )
+    assert peak_memory(size, "RGB", "JPEG", [rotated]) >= 2 * source
+
+
+def test_peak_memory_uses_reduced_jpeg_decode():
+    outputs = [output({"op": "resize", "scale": 0.25})]
+    operations, reduction = tiled_operations(outputs, (8000, 8000), "JPEG")
+    assert reduction == 4
+    assert operations[0][0].width == 2000
+    # Scales are kept when the decode is not reduced
+    operations, reduction = tiled_operations(outputs, (8000, 8000), "PNG")
+    assert reduction == 1
+    assert operations[0][0].scale == 0.25
+    assert peak_memory((8000, 8000), "RGB", "JPEG", outputs) < (
+        peak_memory((8000, 8000), "RGB", "PNG", outputs) / 3
+    )
+
+
+def test_peak_memory_sizes_whole_image_outputs():
+    size = (10_000, 10_000)
+    source = size[0] * size[1] * 4
+    # Rotated by 45 degrees the bounding box doubles the image, and a
+    # rotation of an upscale of it is larger still
+    rotated = output({"op": "rotate", "degrees": 45})
+    upscaled = output(
+        {"op": "rotate", "degrees": 45},
+        {"op": "resize", "width": 10_000, "height": 10_000},
+        {"op": "rotate", "degrees": 45},
+    )
+    assert peak_memory(size, "RGB", "PNG", [rotated]) > 3 * source
+    assert peak_memory(size, "RGB", "PNG", [upscaled]) > 4 * source
+    # Untiled, parts of the plan render at once
+    assert peak_memory(
+        size, "RGB", "PNG", [rotated, upscaled], tiled=False
+    ) > peak_memory(size, "RGB", "PNG", [upscaled], tiled=False)
+
+
+def test_check_memory_rejects_above_ceiling():
+    with patch("app.tiling.image_settings.TASK_MEMORY", 1024**3):
+        check_memory((10_000, 10_000), "L", "PNG", default_outputs(), 0)
+        with pytest.raises(MemoryError):
+            check_memory((20_000, 20_000), "RGB", "PNG", default_outputs(), 0)
+        upscaled = output(
+            {"op": "resize", "width": 10_000, "height": 10_000},
+            {"op": "rotate", "degrees": 30},
+        )
+        with pytest.raises(MemoryError):
+            check_memory((1000, 1000), "RGB", "PNG", [upscaled], 0, False)
+
+
+# ========================== Test peak RSS ==========================
+
+PEAK_RSS_SCRIPT = """
+import resource
+import sys
+
+from app.tiling import render_tiled
+from app.transforms import default_outputs
+
+data = open(sys.argv[1], "rb").read()
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+for _ in render_tiled(data, default_outputs()):
+    pass
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(baseline * 1024, peak * 1024)
+"""
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="ru_maxrss is in KiB")
+def test_render_tiled_peak_rss(tmp_path):
+    size = (6000, 4000)
+    image = Image.effect_noise((size[0] // 16, size[1] // 16), 64)
+    image.convert("RGB").resize(size).save(tmp_path / "large.png")
+    del image
+
+    result = subprocess.run(
+        [sys.executable, "-c", textwrap.dedent(PEAK_RSS_SCRIPT)]
+        + [str(tmp_path / "large.png")],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    baseline, peak = map(int, result.stdout.split())
+
+    # The decoded source takes 4 bytes per pixel. Rendering the outputs
+    # whole would add at least the rotated copy on top of it.
+    source = size[0] * size[1] * 4
+    assert peak - baseline < source * 1.5
@@ -0,0 +1,415 @@
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+from app import transforms
+from app.schemas import (
+    Blur,
+    ColorJitter,
+    Crop,
+    Flip,
+    Grayscale,
+    Noise,
+    OutputSpec,
+    Resize,
+    Rotate,
+    VariantPolicy,
+    Variants,
+)
+from app.transforms import (
+    DecodePlan,
+    Plan,
+    apply,
+    default_outputs,
+    draft_reduction,
+    normalize,
+    operation_key,
+    operation_size,
+    parse_operation,
+    peak_pixels,
+    sample_variants,
+    transform_key,
+)
+
+# =========================== Test normalize ========================
+
+
+def test_normalize_fuses_rotations():
+    result = normalize([Rotate(degrees=90), Rotate(degrees=180)])
+    assert result == [Rotate(degrees=270)]
+
+
+def test_normalize_drops_identities():
+    operations = [
+        Rotate(degrees=360),
+        Flip(direction="horizontal"),
+        Flip(direction="horizontal"),
+        Rotate(degrees=90),
+        Rotate(degrees=270),
+    ]
+    assert normalize(operations) == []
+
+
+def test_normalize_keeps_other_rotations():
+    operations = [Rotate(degrees=30), Rotate(degrees=-30)]
+    assert normalize(operations) == operations
+    operations = [Rotate(degrees=90), Rotate(degrees=45)]
+    assert normalize(operations) == operations
+
+
+def test_normalize_keeps_resizes():
+    operations = [Resize(scale=0.5), Resize(scale=0.5)]
+    assert normalize(operations) == operations
+    operations = [Resize(scale=0.5), Resize(width=10, height=10)]
+    assert normalize(operations) == operations
+
+
+def test_normalize_crops_before_pointwise_operations():
+    crop = Crop(left=0, top=0, right=10, bottom=10)
+    result = normalize([Grayscale(), ColorJitter(brightness=2), crop])
+    assert result == [crop, Grayscale(), ColorJitter(brightness=2)]
+    result = normalize([Grayscale(), crop, Grayscale()])
+    assert result == [crop, Grayscale()]
+    # Contrast depends on the mean of the whole image
+    operations = [ColorJitter(contrast=1.8), crop]
+    assert normalize(operations) == operations
+    operations = [Grayscale(), Resize(scale=0.5)]
+    assert normalize(operations) == operations
+
+
+def apply_all(operations: list, image: Image.Image) -> Image.Image:
+    for operation in operations:
+        image = apply(operation, image)
+    return image
+
+
+@pytest.mark.parametrize(
+    "operations",
+    [
+        [Rotate(degrees=90), Rotate(degrees=180)],
+        [Rotate(degrees=30), Rotate(degrees=-30)],
+        [Flip(direction="vertical"), Flip(direction="vertical")],
+        [Grayscale(), Grayscale()],
+        [
+            ColorJitter(brightness=1.5, saturation=0.5),
+            Crop(left=5, top=10, right=30, bottom=40),
+        ],
+        [ColorJitter(contrast=1.8), Crop(left=0, top=0, right=20, bottom=20)],
+        [Grayscale(), Crop(left=5, top=10, right=30, bottom=40)],
+        [Grayscale(), Resize(scale=0.5)],
+        [ColorJitter(brightness=1.5), Resize(scale=0.5)],
+        [Resize(scale=0.7), Resize(scale=0.7)],
+        [Resize(scale=0.5), Resize(width=40, height=50)],
+    ],
+)
+def test_normalize_keeps_rendered_image(operations):
+    image = Image.merge(
+        "RGB", [Image.effect_noise((40, 50), 64) for _ in range(3)]
+    )
+    expected = apply_all(operations, image)
+    result = apply_all(normalize(operations), image)
+    assert result.size == expected.size
+    assert result.tobytes() == expected.tobytes()
+
+
+def test_normalize_keeps_blur_order():
+    operations = [Blur(radius=2), Resize(scale=0.5)]
+    assert normalize(operations) == operations
+
+
+# ========================= Test transform_key ======================
+
+
+def test_transform_key():
+    output = OutputSpec(
+        name="thumb",
+        operations=[Grayscale(), Resize(scale=0.5)],
+        format="WEBP",
+    )
+    assert transform_key(output) == "grayscale|scale:0.5|format:WEBP"
+    assert [transform_key(output) for output in default_outputs(90)] == [
+        "rotate:90",
+        "grayscale",
+        "scale:0.5",
+    ]
+    assert transform_key(OutputSpec(name="copy", operations=[])) == "identity"
+
+
+# ======================== Test parse_operation =====================
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        "rotate:90",
+        "scale:0.5",
+        "resize:100x",
+        "resize:x20",
+        "crop:1,2,30,40",
+        "flip:vertical",
+        "grayscale",
+        "blur:2",
+        "jitter:1.2,0.9,1",
+        "noise:5,42",
+    ],
+)
+def test_parse_operation_inverts_operation_key(key):
+    assert operation_key(parse_operation(key)) == key
+
+
+@pytest.mark.parametrize(
+    "key", ["rotate", "bogus:1", "grayscale:1", "crop:1,2", "scale:2"]
+)
+def test_parse_operation_invalid(key):
+    with pytest.raises(ValueError):
+        parse_operation(key)
+
+
+@pytest.mark.parametrize(
+    "key", ["resize:100000x100000", "crop:0,0,200000,200000"]
+)
+def test_parse_operation_too_large(key):
+    with pytest.raises(ValueError):
+        parse_operation(key)
+
+
+# ========================== Test peak_pixels =======================
+
+
+@pytest.mark.parametrize(
+    "operation",
+    [
+        Rotate(degrees=90),
+        Rotate(degrees=45),
+        Rotate(degrees=-17.5),
+        Resize(width=20),
+        Resize(width=70, height=3),
+        Resize(scale=0.3),
+        Crop(left=10, top=5, right=100, bottom=100),
+        Crop(left=50, top=50, right=60, bottom=60),
+    ],
+)
+def test_operation_size_matches_apply(operation):
+    image = Image.new("RGB", (40, 20))
+    size = operation_size(operation, image.size)
+    assert size == apply(operation, image).size
+
+
+def test_peak_pixels():
+    # The intermediate upscale is the largest image of the chain
+    operations = [Resize(width=400), Crop(left=0, top=0, right=10, bottom=10)]
+    assert peak_pixels(operations, (40, 20)) == 400 * 200
+    assert peak_pixels([Grayscale()], (40, 20)) == 800
+
+
+# ============================= Test apply ==========================
+
+
+def test_apply():
+    image = Image.new("RGB", (40, 20), color="red")
+    assert apply(Rotate(degrees=90), image).size == (20, 40)
+    rotated = image.rotate(45, expand=True)
+    assert apply(Rotate(degrees=45), image).size == rotated.size
+    assert apply(Resize(width=20), image).size == (20, 10)
+    assert apply(Resize(scale=0.5), image).size == (20, 10)
+    crop = Crop(left=10, top=5, right=100, bottom=100)
+    assert apply(crop, image).size == (30, 15)
+    assert apply(Grayscale(), image).mode == "L"
+    jitter = ColorJitter(brightness=0.5, contrast=1.5, saturation=0)
+    assert apply(jitter, image).getpixel((0, 0)) != (255, 0, 0)
+
+
+def test_apply_rotation_matches_rotate():
+    image = Image.effect_noise((30, 20), 64).convert("RGB")
+    for degrees in (90, 180, 270, -90):
+        assert (
+            apply(Rotate(degrees=degrees), image).tobytes()
+            == image.rotate(degrees, expand=True).tobytes()
+        )
+
+
+# ============================= Test Plan ===========================
+
+
+def test_plan_shares_intermediate_results():
+    outputs = [
+        OutputSpec(name="small", operations=[Resize(scale=0.5)]),
+        OutputSpec(
+            name="small_gray", operations=[Resize(scale=0.5), Grayscale()]
+        ),
+        OutputSpec(
+            name="small_flip",
+            operations=[Resize(scale=0.5), Flip(direction="vertical")],
+        ),
+    ]
+    image = Image.new("RGB", (40, 20))
+    with patch.object(transforms, "apply", wraps=apply) as mock_apply:
+        results = {
+            name: output_image
+            for name, output_image, _ in Plan(outputs).execute(image)
+        }
+    assert mock_apply.call_count == 3
+    assert results["small"].size == (20, 10)
+    assert results["small_gray"].mode == "L"
+    assert results["small_flip"].size == (20, 10)
+
+
+def test_plan_identity_output():
+    image = Image.new("RGB", (40, 20))
+    plan = Plan([OutputSpec(name="copy", operations=[])])
+    assert list(plan.execute(image)) == [("copy", image, 0.0)]
+
+
+def test_plan_branches():
+    outputs = [
+        OutputSpec(name="copy", operations=[]),
+        OutputSpec(name="small", operations=[Resize(scale=0.5)]),
+        OutputSpec(
+            name="small_flip",
+            operations=[Resize(scale=0.5), Flip(direction="vertical")],
+        ),
+        OutputSpec(name="gray", operations=[Grayscale()]),
+    ]
+    image = Image.new("RGB", (40, 20))
+    branches = Plan(outputs).branches(image, 1.0)
+    names = [[name for name, _, _ in branch()] for branch in branches]
+    assert names == [["copy"], ["small", "small_flip"], ["gray"]]
+    for branch in branches:
+        assert all(elapsed >= 1.0 for _, _, elapsed in branch())
+
+
+# ======================== Test draft_reduction =====================
+
+
+def test_draft_reduction():
+    size = (4000, 3000)
+    assert draft_reduction([Resize(scale=0.5)], size) == 2
+    assert draft_reduction([Resize(scale=0.3)], size) == 2
+    assert draft_reduction([Resize(width=500)], size) == 8
+    assert draft_reduction([Resize(width=501)], size) == 4
+    assert draft_reduction([Resize(scale=0.9)], size) == 1
+    assert draft_reduction([Grayscale(), Resize(width=500)], size) == 1
+    assert draft_reduction([], size) == 1
+
+
+# ========================== Test DecodePlan ========================
+
+
+def make_jpeg(width: int, height: int) -> bytes:
+    buffer = BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(
+        buffer, format="JPEG"
+    )
+    return buffer.getvalue()
+
+
+def test_decode_plan_drafts_downscales():
+    data = make_jpeg(800, 600)
+    plan = DecodePlan(default_outputs(90), (800, 600), "JPEG")
+    assert {
+        reduction: list(plan.outputs) for reduction, plan in plan.plans.items()
+    } == {1: ["rotated", "gray"], 2: ["scaled"]}
+
+    opened = []
+
+    def open_image():
+        opened.append(Image.open(BytesIO(data)))
+        return opened[-1]
+
+    results = {name: image for name, image, _ in plan.execute(open_image)}
+    assert len(opened) == 2
+    assert results["rotated"].size == (600, 800)
+    assert results["gray"].size == (800, 600)
+    assert results["scaled"].size == (400, 300)
+
+
+def test_decode_plan_reuses_cheaper_decodes():
+    outputs = [
+        OutputSpec(name="half", operations=[Resize(scale=0.5)]),
+        OutputSpec(name="quarter", operations=[Resize(scale=0.25)]),
+        OutputSpec(name="eighth", operations=[Resize(scale=0.125)]),
+    ]
+    plan = DecodePlan(outputs, (800, 600), "JPEG")
+    assert {
+        reduction: list(plan.outputs) for reduction, plan in plan.plans.items()
+    } == {2: ["half"], 4: ["quarter", "eighth"]}
+    results = {
+        name: image.size
+        for name, image, _ in plan.execute(
+            lambda: Image.open(BytesIO(make_jpeg(800, 600)))
+        )
+    }
+    assert results == {
+        "half": (400, 300),
+        "quarter": (200, 150),
+        "eighth": (100, 75),
+    }
+
+
+def test_decode_plan_without_draft_support():
+    plan = DecodePlan(default_outputs(90), (800, 600), "PNG")
+    assert list(plan.plans) == [1]
+
+
+# ========================= Test sample_variants ====================
+
+
+def test_sample_variants_is_reproducible():
+    variants = Variants(count=5, seed=42)
+    first = sample_variants(variants, (400, 300))
+    assert sample_variants(variants, (400, 300)) == first
+    more = sample_variants(Variants(count=8, seed=42), (400, 300))
+    assert more[:5] == first
+    assert [output.name for output, _, _ in first] == [
+        f"variant_00{index}" for index in range(5)
+    ]
+    assert len({seed for _, seed, _ in first}) == 5
+
+
+def test_sample_variants_follow_policy():
+    policy = VariantPolicy(
+        rotation=10, crop=0.5, flip=1, brightness=0.1, contrast=0, noise=8
+    )
+    variants = Variants(count=20, seed=1, policy=policy)
+    for output, seed, params in sample_variants(variants, (400, 300)):
+        left, top, right, bottom = params["crop"]
+        assert 0 <= left < right <= 400 and 0 <= top < bottom <= 300
+        assert right - left >= 200 and bottom - top >= 150
+        assert params["flip"] is True
+        assert -10 <= params["rotation"] <= 10
+        assert 0.9 <= params["brightness"] <= 1.1
+        assert params["contrast"] == 1
+        assert 0 <= params["noise"] <= 8
+        assert Flip(direction="horizontal") in output.operations
+        if params["noise"]:
+            assert output.operations[-1] == Noise(
+                sigma=params["noise"], seed=seed
+            )
+
+
+def test_sample_variants_identity_policy():
+    policy = VariantPolicy(
+        rotation=0, crop=1, flip=0, brightness=0, contrast=0
+    )
+    variants = Variants(count=2, seed=1, policy=policy)
+    for output, _, _ in sample_variants(variants, (400, 300)):
+        assert output.operations == []
+
+
+# ============================= Test Noise ==========================
+
+
+def test_noise_is_reproducible():
+    image = Image.new("RGB", (300, 300), color=(128, 128, 128))
+    first = apply(Noise(sigma=10, seed=7), image)
+    assert first.size == image.size and first.mode == "RGB"
+    assert first.tobytes() == apply(Noise(sigma=10, seed=7), image).tobytes()
+    assert first.tobytes() != apply(Noise(sigma=10, seed=8), image).tobytes()
+    assert (
+        transform_key(
+            OutputSpec(name="noisy", operations=[Noise(sigma=10, seed=7)])
+        )
+        == "noise:10,7"
+    )